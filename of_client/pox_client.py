@@ -139,6 +139,15 @@ class BackendChannel(asynchat.async_chat):
         elif msg[0] == 'flow_stats_request':
             switch = msg[1]
             self.of_client.flow_stats_request(switch)
+        elif msg[0] == 'aggregate_stats_request':
+            pred = self.dict2OF(msg[1])
+            request_id = int(msg[2])
+            self.of_client.aggregate_stats_request(pred,request_id)
+        elif msg[0] == 'scoped_flow_stats_request':
+            pred = self.dict2OF(msg[1])
+            tags = set(msg[2])
+            request_id = int(msg[3])
+            self.of_client.scoped_flow_stats_request(pred,tags,request_id)
         else:
             print "ERROR: Unknown msg from frontend %s" % msg
 
@@ -158,6 +167,8 @@ class POXClient(revent.EventMixin):
 
         self.backend_channel = BackendChannel(ip, port, self)
         self.adjacency = {} # From Link to time.time() stamp
+        self.aggregate_requests = {} # (switch, xid) -> pyretic request id
+        self.scoped_requests = {} # (switch, xid) -> (request id, cookie tags)
 
     def packet_from_network(self, **kwargs):
         return kwargs
@@ -449,6 +460,45 @@ class POXClient(revent.EventMixin):
             print ( ("ERROR:flow_stats_request: No connection to switch %d" +
                      " available") % switch )
     
+    def aggregate_stats_request(self,pred,request_id):
+        switch = pred['switch']
+        if 'inport' in pred:
+            inport = pred['inport']
+        else:
+            inport = None
+        sr = of.ofp_stats_request()
+        sr.body = of.ofp_aggregate_stats_request()
+        sr.body.match = self.build_of_match(switch,inport,pred)
+        sr.body.table_id = 0xff
+        sr.body.out_port = of.OFPP_NONE
+        try:
+            self.switches[switch]['connection'].send(sr)
+            self.aggregate_requests[(switch,sr.xid)] = request_id
+        except KeyError, e:
+            print ( ("ERROR:aggregate_stats_request: No connection to switch %d" +
+                     " available") % switch )
+
+    def scoped_flow_stats_request(self,pred,tags,request_id):
+        """Request the stats of the flows selected by pred, of which only
+        those whose cookie carries one of tags are passed on. OpenFlow 1.0
+        stats requests can't filter on cookies, so that is done here."""
+        switch = pred['switch']
+        if 'inport' in pred:
+            inport = pred['inport']
+        else:
+            inport = None
+        sr = of.ofp_stats_request()
+        sr.body = of.ofp_flow_stats_request()
+        sr.body.match = self.build_of_match(switch,inport,pred)
+        sr.body.table_id = 0xff
+        sr.body.out_port = of.OFPP_NONE
+        try:
+            self.switches[switch]['connection'].send(sr)
+            self.scoped_requests[(switch,sr.xid)] = (request_id,tags)
+        except KeyError, e:
+            print ( ("ERROR:scoped_flow_stats_request: No connection to switch %d" +
+                     " available") % switch )
+
     def clear(self,switch=None):
         if switch is None:
             for switch in self.switches.keys():
@@ -567,8 +617,26 @@ class POXClient(revent.EventMixin):
             actions = self.of_actions_to_dicts(flow_stat.actions)
             flow_stat_dict['actions'] = actions
             return flow_stat_dict
-        flow_stats = [handle_ofp_flow_stat(s) for s in event.stats]
-        self.send_to_pyretic(['flow_stats_reply',dpid,flow_stats])
+        scoped = self.scoped_requests.pop((dpid,event.ofp[0].xid), None)
+        if scoped is None:
+            flow_stats = [handle_ofp_flow_stat(s) for s in event.stats]
+            self.send_to_pyretic(['flow_stats_reply',dpid,flow_stats])
+        else:
+            (request_id,tags) = scoped
+            flow_stats = [handle_ofp_flow_stat(s) for s in event.stats
+                          if (s.cookie >> COOKIE_TAG_SHIFT) in tags]
+            self.send_to_pyretic(['scoped_flow_stats_reply',dpid,request_id,
+                                  flow_stats])
+
+    def _handle_AggregateFlowStatsReceived (self, event):
+        dpid = event.connection.dpid
+        request_id = self.aggregate_requests.pop((dpid,event.ofp.xid), None)
+        if request_id is None:
+            return
+        stats = {'packet_count' : event.stats.packet_count,
+                 'byte_count'   : event.stats.byte_count,
+                 'flow_count'   : event.stats.flow_count}
+        self.send_to_pyretic(['aggregate_stats_reply',dpid,request_id,stats])
 
     def _handle_PortStatus(self, event):
         port = event.ofp.desc
@@ -108,6 +108,10 @@ class BackendChannel(asynchat.async_chat):
             self.backend.runtime.handle_packet_in(packet)
         elif msg[0] == 'flow_stats_reply':
             self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2])
+        elif msg[0] == 'aggregate_stats_reply':
+            self.backend.runtime.handle_aggregate_stats_reply(msg[1],msg[2],msg[3])
+        elif msg[0] == 'scoped_flow_stats_reply':
+            self.backend.runtime.handle_scoped_flow_stats_reply(msg[1],msg[2],msg[3])
         elif msg[0] == 'flow_removed':
             self.backend.runtime.handle_flow_removed(msg[1], msg[2])
         else:
@@ -154,6 +158,12 @@ class Backend(object):
     def send_flow_stats_request(self,switch):
         self.send_to_OF_client(['flow_stats_request',switch])
 
+    def send_aggregate_stats_request(self,pred,request_id):
+        self.send_to_OF_client(['aggregate_stats_request',pred,request_id])
+
+    def send_scoped_flow_stats_request(self,pred,tags,request_id):
+        self.send_to_OF_client(['scoped_flow_stats_request',pred,tags,request_id])
+
     def send_barrier(self,switch):
         self.send_to_OF_client(['barrier',switch])
 
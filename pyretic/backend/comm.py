@@ -35,6 +35,7 @@ import json
 
 BACKEND_PORT=41414
 TERM_CHAR='\n'
+COOKIE_TAG_SHIFT=32 # rule cookies: (bucket tag << COOKIE_TAG_SHIFT) | version
 
 def serialize(msg):
     jsonable_msg = to_jsonable_format(msg)
@@ -74,7 +75,8 @@ def deserialize(serialized_msgs):
 def dict_to_ascii(d):
     def convert(h,v):
         if (isinstance(v,str) or
-            isinstance(v,int)):
+            isinstance(v,int) or
+            isinstance(v,long)):
             return v
         else:
             return repr(v)
@@ -34,6 +34,7 @@ import functools
 import itertools
 import struct
 import time
+from thread import get_ident
 from ipaddr import IPv4Network
 from bitarray import bitarray
 import logging
@@ -593,7 +594,9 @@ class FwdBucket(Query):
     def apply(self):
         with self.bucket_lock:
             for pkt in self.bucket:
-                self.log.info('In FwdBucket apply(): packet is:\n' + str(pkt))
+                if self.log.isEnabledFor(logging.INFO):
+                    self.log.info('In FwdBucket apply(): packet is:\n' +
+                                  str(pkt))
                 for callback in self.callbacks:
                     callback(pkt)
             self.bucket.clear()
@@ -612,13 +615,40 @@ class PathBucket(FwdBucket):
     Class for registering callbacks on individual packets sent to controller,
     but in addition to the packet, the entire trajectory of the packet is also
     provided to the callbacks.
+
+    Trajectories are enumerated hop by hop from a transfer function memoized
+    per located packet header (the payload doesn't affect forwarding), which
+    is kept for as long as the forwarding policy and topology stay the same.
+    Enumeration gives up on paths longer than `max_hops` hops and stops after
+    `max_paths` paths, so that flooding or looping policies stay bounded.
+
+    :param require_original_pkt: only report the packet that triggered apply()
+    :type require_original_pkt: bool
+    :param max_hops: longest trajectory to follow (default: class attribute)
+    :type max_hops: int
+    :param max_paths: most trajectories to report per packet (default: class
+        attribute)
+    :type max_paths: int
     """
-    def __init__(self, require_original_pkt=False):
+    max_hops = 64
+    max_paths = 1024
+
+    def __init__(self, require_original_pkt=False, max_hops=None,
+                 max_paths=None):
         super(PathBucket, self).__init__()
         self.runtime_topology_policy_fun = None
         self.runtime_fwding_policy_fun = None
         self.runtime_egress_policy_fun = None
+        self.runtime_policy_version_fun = None
         self.require_original_pkt = require_original_pkt
+        if max_hops is not None:
+            self.max_hops = max_hops
+        if max_paths is not None:
+            self.max_paths = max_paths
+        self.transfer_key = None
+        self.transfer_cache = {}
+        self.mapped_fwding = None
+        self.truncated = False
 
     def generate_classifier(self):
         return Classifier([Rule(identity,{self},[self])])
@@ -646,7 +676,16 @@ class PathBucket(FwdBucket):
     def set_egress_policy_fun(self, egress_pol_fun):
         self.runtime_egress_policy_fun = egress_pol_fun
 
-    def get_trajectories(self, pkt):
+    def set_policy_version_fun(self, policy_version_fun):
+        self.runtime_policy_version_fun = policy_version_fun
+
+    def get_transfer_fun(self):
+        """ Returns the memoized hop transfer function for the current
+        forwarding policy and topology, or None if the runtime hasn't provided
+        them. Maps a located packet to a triple (at_egress, moved, egressed) of
+        whether it is at network egress, the packets it becomes at the next
+        switch ingresses, and the packets it leaves the network as.
+        """
         from pyretic.core.language_tools import ast_map, default_mapper
 
         def data_plane_mapper(parent, children):
@@ -655,52 +694,109 @@ class PathBucket(FwdBucket):
             else:
                 return default_mapper(parent, children)
 
-        def packet_paths(pkt, topo, fwding, egress):
-            """Takes a packet, a topology policy, a forwarding policy, and a
-            filter to detect network egress, and returns a list of "packet
-            paths". A "packet path" is just an ordered list of located packets
-            denoting the trajectory of the input packet at switch ingresses,
-            except for the last element of the packet path which denotes packet
-            state at network egress.
-            """
-            at_egress = egress.eval(pkt)
-            if len(at_egress) == 1: # the pkt is already at network egress
-                return [pkt]
+        if not (self.runtime_topology_policy_fun and
+                self.runtime_fwding_policy_fun and
+                self.runtime_egress_policy_fun):
+            return None
+        topo = self.runtime_topology_policy_fun()
+        fwding_pol = self.runtime_fwding_policy_fun()
+        egress = self.runtime_egress_policy_fun()
+        version = None
+        if self.runtime_policy_version_fun:
+            version = self.runtime_policy_version_fun()
+        # without a policy version, the policy may have changed in place
+        key = (id(fwding_pol), version, id(topo), id(egress))
+        if version is None or key != self.transfer_key:
+            self.transfer_key = key
+            self.transfer_cache = {}
+            self.mapped_fwding = ast_map(data_plane_mapper, fwding_pol)
+        fwding = self.mapped_fwding
+        cache = self.transfer_cache
+
+        def delta(pkt, p):
+            """ Header changes taking pkt to p. """
+            d = dict((h, None) for h in pkt.header if not h in p.header)
+            for (h, v) in p.header.items():
+                if pkt.header.get(h) != v:
+                    d[h] = v
+            return d
+
+        def transfer(pkt):
+            key = pkt.header.remove(content_headers)
+            try:
+                (at_egress, moved, egressed) = cache[key]
+            except KeyError:
+                at_egress = len(egress.eval(pkt)) == 1
+                moved = []
+                egressed = []
+                if not at_egress:
+                    moved = [delta(pkt, p) for p in (fwding >> topo).eval(pkt)]
+                    egressed = [delta(pkt, p)
+                                for p in (fwding >> egress).eval(pkt)]
+                cache[key] = (at_egress, moved, egressed)
+            return (at_egress,
+                    [pkt.modifymany(d) for d in moved],
+                    [pkt.modifymany(d) for d in egressed])
+
+        return transfer
 
+    def get_trajectories(self, pkt):
+        """Returns a list of "packet paths" of pkt. A "packet path" is just an
+        ordered list of located packets denoting the trajectory of the input
+        packet at switch ingresses, except for the last element of the packet
+        path which denotes packet state at network egress. Sets `truncated` if
+        the hop or path limit cut the enumeration short.
+        """
+        transfer = self.get_transfer_fun()
+        if transfer is None:
+            return []
+        full_paths = []
+        self.truncated = False
+
+        def packet_paths(prefix, pkt):
+            if len(full_paths) >= self.max_paths:
+                self.truncated = True
+                return
+            (at_egress, moved, egressed) = transfer(pkt)
+            if at_egress: # the pkt is already at network egress
+                full_paths.append(prefix + [pkt])
+                return
+            if len(prefix) >= self.max_hops:
+                self.truncated = True
+                return
             # Move packet one hop, then recursively enumerate paths.
-            pkts_moved = (fwding >> topo).eval(pkt)
-            full_paths = []
-            for p in pkts_moved:
-                suffix_paths = packet_paths(p, topo, fwding, egress)
-                for sp in suffix_paths:
-                    full_paths.append([pkt] + sp)
-
+            for p in moved:
+                packet_paths(prefix + [pkt], p)
             # Move packet one hop, then terminate paths if necessary
-            pkts_egressed = (fwding >> egress).eval(pkt)
-            for p in pkts_egressed:
-                full_paths.append([pkt, p])
-
-            return full_paths
-
-        if (self.runtime_topology_policy_fun and self.runtime_fwding_policy_fun
-            and self.runtime_egress_policy_fun):
-            topo = self.runtime_topology_policy_fun()
-            fwding = ast_map(data_plane_mapper,
-                             self.runtime_fwding_policy_fun())
-            egress = self.runtime_egress_policy_fun()
-            return packet_paths(pkt, topo, fwding, egress)
-        else:
-            return []
+            for p in egressed:
+                if len(full_paths) >= self.max_paths:
+                    self.truncated = True
+                    return
+                full_paths.append(prefix + [pkt, p])
+
+        packet_paths([], pkt)
+        if self.truncated:
+            self.log.warning('PathBucket trajectories truncated at %d hops / '
+                             '%d paths' % (self.max_hops, self.max_paths))
+        return full_paths
 
 
 class CountBucket(Query):
     """
     Class for registering callbacks on counts of packets sent to
     the controller.
+
+    :param counter_only: count packets sent to the controller as they are
+        evaluated, into a counter shard per evaluating thread, rather than
+        retaining them under the (cross-process) bucket lock until apply()
+    :type counter_only: bool
     """
-    def __init__(self):
+    def __init__(self, counter_only=False):
         super(CountBucket, self).__init__()
-        self.matches = {}
+        self.counter_only = counter_only
+        self.count_shards = {} # thread id -> [packets, bytes] since creation
+        self.count_shards_applied = (0, 0)
+        self.runtime_rule_matches_fun = None
         self.runtime_stats_query_fun = None
         self.runtime_existing_stats_query_fun = None
         self.outstanding_switches = set()
@@ -731,31 +827,64 @@ class CountBucket(Query):
         return self.new_bucket
 
     def get_matches(self):
-        """ Return matches contained in bucket as a string """
+        """ Return matches of the bucket's rules as a string """
         output = ""
         with self.in_update_cv:
             while self.in_update:
                 self.in_update_cv.wait()
-            for m in self.matches:
-                output += str(m) + '\n'
+            if self.runtime_rule_matches_fun:
+                for m in self.runtime_rule_matches_fun():
+                    output += str(m) + '\n'
         return output
 
     def generate_classifier(self):
         return Classifier([Rule(identity,{self},[self])])
 
+    def eval(self, pkt):
+        if not self.counter_only:
+            return super(CountBucket, self).eval(pkt)
+        # Each thread only ever bumps its own shard, so no lock is needed.
+        shard = self.count_shards.get(get_ident())
+        if shard is None:
+            shard = self.count_shards.setdefault(get_ident(), [0, 0])
+        shard[0] += 1
+        shard[1] += pkt['payload_len']
+        return set()
+
+    def fold_count_shards(self):
+        """ The packets and bytes counted in the shards since the last fold.
+        Shards are never reset, so that counting needn't synchronize with
+        folding; folds must hold the bucket lock, so that no two of them
+        count the same packets. """
+        (packets, bytes) = (0, 0)
+        for shard in self.count_shards.values():
+            packets += shard[0]
+            bytes += shard[1]
+        (applied_packets, applied_bytes) = self.count_shards_applied
+        self.count_shards_applied = (packets, bytes)
+        return (packets - applied_packets, bytes - applied_bytes)
+
     def apply(self):
         with self.bucket_lock:
-            for pkt in self.bucket:
-                self.log.info('In CountBucket ' + str(id(self)) + ' apply():'
-                               + ' Packet is:\n' + repr(pkt))
-                self.packet_count_persistent += 1
-                self.byte_count_persistent += pkt['payload_len']
-                self.packet_count_persistent_apply += 1
-                self.byte_count_persistent_apply += pkt['payload_len']
-            self.bucket.clear()
-        self.log.debug('In bucket ' +  str(id(self)) + ' apply(): ' +
-                       'persistent packet count is ' +
-                       str(self.packet_count_persistent))
+            if self.counter_only:
+                (packets, bytes) = self.fold_count_shards()
+            else:
+                (packets, bytes) = (0, 0)
+                for pkt in self.bucket:
+                    if self.log.isEnabledFor(logging.INFO):
+                        self.log.info('In CountBucket ' + str(id(self)) +
+                                      ' apply(): Packet is:\n' + repr(pkt))
+                    packets += 1
+                    bytes += pkt['payload_len']
+                self.bucket.clear()
+            self.packet_count_persistent += packets
+            self.byte_count_persistent += bytes
+            self.packet_count_persistent_apply += packets
+            self.byte_count_persistent_apply += bytes
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('In bucket ' +  str(id(self)) + ' apply(): ' +
+                           'persistent packet count is ' +
+                           str(self.packet_count_persistent))
 
     def start_update(self):
         """
@@ -796,106 +925,40 @@ class CountBucket(Query):
         self.log.info("Updated bucket %d" % id(self))
        
 
-    class match_entry(object):
-        def __init__(self,match,priority,version):
-            self.match = util.frozendict(match)
-            self.priority = priority
-            self.version = version
-
-        def __hash__(self):
-            return hash(self.match) ^ hash(self.priority) ^ hash(self.version)
-
-        def __eq__(self,other):
-            try:
-                return (self.match == other.match and 
-                        self.priority == other.priority and 
-                        self.version == other.version)
-            except:
-                return False
-
-        def __repr__(self):
-            return ('(match=' + repr(self.match) + 
-                    ',priority=' + repr(self.priority) + 
-                    ',version=' + repr(self.version) + ')')
-
-    class match_status(object):
-        def __init__(self,to_be_deleted=False,existing_rule=False):
-            self.to_be_deleted = to_be_deleted
-            self.existing_rule = existing_rule
-
-        def __hash__(self):
-            return hash(self.to_be_deleted) ^ hash(self.existing_rule)
-
-        def __eq__(self,other):
-            try:
-                return (self.to_be_deleted == other.to_be_deleted and 
-                        self.existing_rule == other.existing_rule)
-            except:
-                return False
-            
-        def __repr__(self):
-            return '(to_be_deleted=%s,existing_rule=%s)' % \
-                (self.to_be_deleted,self.existing_rule)
-
-    def add_match(self, match, priority, version):
-        """Add a match to list of classifier rules to be queried for counts,
-        corresponding to a given version of the classifier.
+    def handle_flow_removed(self, packet_count, byte_count,
+                            existing_rule=False):
+        """Act on a flow removed message for one of the bucket's rules by
+        adding its counters into the bucket's persistent counts. The counts of
+        a rule already installed when the bucket was created, and not yet
+        read, are dropped: the bucket never got to discount them.
+
+        :param packet_count: the packet count of the removed rule
+        :type packet_count: int
+        :param byte_count: the byte count of the removed rule
+        :type byte_count: int
+        :param existing_rule: whether the rule predates the bucket
+        :type existing_rule: bool
         """
-        k = self.match_entry(match, priority, version)
-        if not k in self.matches:
-            self.matches[k] = self.match_status() 
-
-    def delete_match(self, match, priority, version, to_be_deleted=False,
-                     existing_rule=False):
-        """If a rule is deleted from the classifier, mark this rule (until we
-        get the flow_removed message with the counters on it).
-        """
-        k = self.match_entry(match, priority,version)
-        if k in self.matches:
-            self.matches[k].to_be_deleted = True
-
-    def handle_flow_removed(self, match, priority, version, flow_stat):
-        """Act on a flow removed message pertaining to a bucket by
-           1. removing the rule from the matches structure, and
-           2. adding its counters into the bucket's persistent counts.
-        """
-        packet_count = flow_stat['packet_count']
-        byte_count   = flow_stat['byte_count']
-        if packet_count > 0:
-            self.log.debug(("In bucket %d handle_flow_removed\n" +
-                            "got counts %d %d\n" +
-                            "match %s") %
-                           (id(self), packet_count, byte_count,
-                            str(match) + ' ' + str(priority) + ' ' +
-                            str(version)) )
+        self.log.debug("In bucket %d handle_flow_removed: got counts %d %d" %
+                       (id(self), packet_count, byte_count))
         with self.in_update_cv:
             while self.in_update:
                 self.in_update_cv.wait()
-            k = self.match_entry(self.str_convert_match(match),
-                                 priority, version)
-            if k in self.matches:
-                self.log.debug("Deleted flow exists in the bucket's matches")
-                status = self.matches[k]
-                assert status.to_be_deleted
-                if not status.existing_rule: # Note: If pre-existing rule was
-                    # removed, then forget that this rule ever
-                    # existed. We don't count it.
-                    if packet_count > 0:
-                        self.log.info(("Adding persistent pkt count %d"
-                                        + " to bucket %d") % (
-                                packet_count, id(self) ) )
-                        self.log.debug(("persistent count is now %d" %
-                                        (self.packet_count_persistent +
-                                         packet_count) ) )
-                    self.packet_count_persistent += packet_count
-                    self.byte_count_persistent += byte_count
-                    self.packet_count_persistent_removed += packet_count
-                    self.byte_count_persistent_removed += byte_count
-                # Note that there is no else action. We just forget
-                # that this rule was ever associated with the bucket
-                # if we get a "flow removed" message before we got
-                # the first ever stats reply from an existing rule.
-                del self.matches[k]
+            if not existing_rule:
+                if packet_count > 0:
+                    self.log.info(("Adding persistent pkt count %d"
+                                   + " to bucket %d") % (
+                            packet_count, id(self) ) )
+                self.packet_count_persistent += packet_count
+                self.byte_count_persistent += byte_count
+                self.packet_count_persistent_removed += packet_count
+                self.byte_count_persistent_removed += byte_count
+
+    def add_rule_matches(self, fun):
+        """Point to function that lists the matches of the bucket's rules,
+        which the runtime keeps track of.
+        """
+        self.runtime_rule_matches_fun = fun
 
     def add_pull_stats(self, fun):
         """
@@ -929,8 +992,10 @@ class CountBucket(Query):
 
     def pull_stats(self):
         """Issue stats queries from the runtime on user program's request."""
-        queries_issued = self.pull_helper(self.runtime_stats_query_fun)
+        # Replies may be served right away from the runtime's stats snapshot,
+        # so let the callbacks through beforehand.
         self.increment_max_num_callbacks()
+        queries_issued = self.pull_helper(self.runtime_stats_query_fun)
         # If no queries were issued, then no matches, so just call userland
         # registered callback routines
         if not queries_issued:
@@ -964,50 +1029,32 @@ class CountBucket(Query):
         self.outstanding_switches.add(switch)
         self.switches_in_query.add(switch)
 
-    def str_convert_match(self, m):
-        """ Convert incoming flow stat matches into a form compatible with
-        stored match entries. """
-        new_dict = {}
-        for k,v in m.iteritems():
-            if not (k == 'srcip' or k == 'dstip'):
-                new_dict[k] = v
-            else:
-                new_dict[k] = str(v)
-        return new_dict
-
     def clear_transient_counters(self):
         self.packet_count_table = 0
         self.byte_count_table   = 0
 
-    def handle_flow_stats_reply(self,switch,flow_stats):
+    def handle_rule_stats(self, switch, packet_count, byte_count,
+                          existing_packet_count=0, existing_byte_count=0):
         """
-        Given a flow_stats_reply from switch s, collect only those
-        counts which are relevant to this bucket.
-
-        Very simple processing for now: just collect all packet and
-        byte counts from rules that have a match that is in the set of
-        matches this bucket is interested in.
+        Count the flow stats from switch s of the bucket's rules, totalled by
+        the runtime. Returns whether the bucket was waiting for them.
+
+        :param switch: the switch that sent the stats reply
+        :type switch: int
+        :param packet_count: packets counted by the bucket's rules on switch
+        :type packet_count: int
+        :param byte_count: bytes counted by the bucket's rules on switch
+        :type byte_count: int
+        :param existing_packet_count: packets counted by those of the rules
+            that were already installed when the bucket was created, read for
+            the first time, and so not to be counted.
+        :type existing_packet_count: int
+        :param existing_byte_count: ditto, for bytes
+        :type existing_byte_count: int
+        :rtype: bool
         """
-        def entries_print_helper(pfx_string=""):
-            """ Pretty print bucket match entries. """
-            out = ""
-            for k in self.matches.keys():
-                out += pfx_string + str(k) + "\n"
-            return out
-
-        def stat_in_bucket(flow_stat, s):
-            """Return a matching entry for the given flow_stat in
-            bucket.matches."""
-            f = copy.copy(flow_stat['match'])
-            f['switch'] = s
-            fme = self.match_entry(self.str_convert_match(f),
-                                   flow_stat['priority'],
-                                   flow_stat['cookie'])
-            if fme in self.matches.keys():
-                return fme
-            return None
-
         self.log.debug("Got a reply from switch %s" % switch)
+        counted = False
         with self.in_update_cv:
             while self.in_update:
                 self.log.debug("Waiting for update to finish.")
@@ -1015,45 +1062,41 @@ class CountBucket(Query):
             self.log.debug("Current set of outstanding switches is:")
             self.log.debug(str(self.outstanding_switches))
             if switch in self.outstanding_switches:
-                for f in flow_stats:
-                    if 'match' in f:
-                        me = stat_in_bucket(f, switch)
-                        extracted_pkts = f['packet_count']
-                        extracted_bytes = f['byte_count']
-                        if extracted_pkts > 0 and not me:
-                            self.log.debug("Packet not counted: \n%s %s %s" %
-                                           (str(f['match']),
-                                            "priority=%d" % f['priority'],
-                                            "version=%d" % f['cookie']))
-                            self.log.debug("Existing keys: \n%s" %
-                                           entries_print_helper())
-                        if me:
-                            if extracted_pkts > 0:
-                                self.log.debug('In bucket ' + str(id(self)) +
-                                               ': found matching stats_reply:')
-                                self.log.debug(str(me))
-                                self.log.debug('packets: ' +
-                                               str(extracted_pkts) + ' bytes: '
-                                               + str(extracted_bytes))
-                            if not self.matches[me].existing_rule:
-                                self.packet_count_table += extracted_pkts
-                                self.byte_count_table   += extracted_bytes
-                            else: # pre-existing rule when bucket was created
-                                self.log.debug(('In bucket %d: removing' +
-                                                'pre-existing rule counts %d' +
-                                                ' %d') % id(self))
-                                self.packet_count_persistent -= extracted_pkts
-                                self.byte_count_persistent -= extracted_bytes
-                                self.packet_count_persistent_existing += (
-                                    extracted_pkts)
-                                self.byte_count_persistent_existing += (
-                                    extracted_bytes)
-                                self.clear_existing_rule_flag(me)
-                    else:
-                        raise RuntimeError("weird flow entry")
+                self.packet_count_table += packet_count
+                self.byte_count_table   += byte_count
+                if existing_packet_count or existing_byte_count:
+                    self.log.debug(('In bucket %d: removing ' +
+                                    'pre-existing rule counts %d' +
+                                    ' %d') % (id(self), existing_packet_count,
+                                              existing_byte_count))
+                    self.packet_count_persistent -= existing_packet_count
+                    self.byte_count_persistent -= existing_byte_count
+                    self.packet_count_persistent_existing += (
+                        existing_packet_count)
+                    self.byte_count_persistent_existing += (
+                        existing_byte_count)
                 self.outstanding_switches.remove(switch)
-                self.log.debug("Current set of outstanding switches is:")
-                self.log.debug(str(self.outstanding_switches))
+                counted = True
+        self.finish_switch_stats()
+        return counted
+
+    def handle_aggregate_stats(self, switch, packet_count, byte_count):
+        """
+        Count the aggregate stats from switch s, which the runtime only asks
+        for when they cover exactly this bucket's rules on s.
+        """
+        self.log.debug("Got an aggregate reply from switch %s" % switch)
+        with self.in_update_cv:
+            while self.in_update:
+                self.in_update_cv.wait()
+            if switch in self.outstanding_switches:
+                self.packet_count_table += packet_count
+                self.byte_count_table   += byte_count
+                self.outstanding_switches.remove(switch)
+        self.finish_switch_stats()
+
+    def finish_switch_stats(self):
+        """ Call user-land callbacks once no switch stats are outstanding. """
         # If have all necessary data, call user-land registered callbacks
         self.log.info( ('*** Bucket %d flow_stats_reply\n' % id(self)) +
                         ('table pktcount %d persistent pktcount %d total %d' % (
@@ -1077,15 +1120,6 @@ class CountBucket(Query):
                                   self.byte_count_persistent)])
             self.clear_transient_counters()
 
-    def clear_existing_rule_flag(self, entry):
-        """Clear the "existing rule" flag for the provided entry in
-        self.matches. This method should only be called in the context of
-        holding the bucket's in_update_cv since it updates the matches
-        structure.
-        """
-        assert k in self.matches
-        self.matches[k].existing_rule = False
-
     def __eq__(self, other):
         # TODO: if buckets eventually have names, equality should
         # be on names.
@@ -1522,33 +1556,58 @@ class DynamicFilter(DynamicPolicy,Filter):
 
 class flood(DynamicPolicy):
     """
-    Policy that floods packets on a minimum spanning tree, recalculated
-    every time the network is updated (set_network).
+    Policy that floods packets on a spanning tree, maintained incrementally
+    every time the network is updated (set_network).  Each switch gets its
+    own dynamic fragment, and only fragments whose tree ports changed are
+    replaced, so the rest keep their compiled classifiers.
     """
     def __init__(self):
         self.mst = None
+        self.topology_fingerprint = None
+        self.fragments = {}
         self.log = logging.getLogger('%s.flood' % __name__)
         super(flood,self).__init__()
 
+    def fragment_policy(self, switch, ports):
+        return match(switch=switch) >> parallel(map(xfwd,sorted(ports)))
+
     def set_network(self, network):
-        changed = False
-        if not network is None:
-            updated_mst = Topology.minimum_spanning_tree(network.topology)
-            if not self.mst is None:
-                if self.mst != updated_mst:
-                    self.mst = updated_mst
-                    changed = True
+        if network is None:
+            return
+        # the tree can only change if the underlying topology did
+        fingerprint = network.topology.fingerprint()
+        if fingerprint == self.topology_fingerprint:
+            return
+        self.topology_fingerprint = fingerprint
+        if self.mst is None:
+            self.mst = SpanningTree()
+        changed = self.mst.update(network.topology)
+        if not changed:
+            return
+        self.log.debug("Printing updated MST:\n %s" % str(self.mst))
+
+        switches_changed = False
+        for switch in changed:
+            ports = self.mst.switch_ports.get(switch)
+            if ports is None:
+                del self.fragments[switch]
+                switches_changed = True
+            elif switch in self.fragments:
+                fragment = self.fragments[switch]
+                fragment.policy = self.fragment_policy(switch,ports)
+                fragment.invalidate_classifier()
             else:
-                self.mst = updated_mst
-                changed = True
-        if changed:
-            self.log.debug("Printing updated MST:\n %s" % str(updated_mst))
-            self.policy = parallel([
-                match(switch=switch) >>
-                parallel(map(xfwd,ports))
-                for switch,ports 
-                in self.mst.switch_with_port_ids_list()])
-                
+                self.fragments[switch] = DynamicPolicy(
+                    self.fragment_policy(switch,ports))
+                switches_changed = True
+
+        if switches_changed:
+            self.policy = parallel([self.fragments[switch]
+                                    for switch in sorted(self.fragments)])
+        else:
+            self.policy.invalidate_classifier()
+        self.invalidate_classifier()
+
     def __repr__(self):
         try:
             return "flood on:\n%s" % self.mst
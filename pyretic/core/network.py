@@ -28,8 +28,11 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
+import copy
+import functools
 import socket
 import struct
+import threading
 from bitarray import bitarray
 import networkx as nx
 
@@ -236,13 +239,246 @@ class Location(object):
         return "%s[%s]" % (self.switch,self.port_no)
 
 
+def _with_update_lock(f):
+    """ Run a Topology method under the topologies' update lock. """
+    @functools.wraps(f)
+    def locked(self,*args,**kwargs):
+        with self.update_lock:
+            return f(self,*args,**kwargs)
+    return locked
+
+
 class Topology(nx.Graph):
+    """
+    A switch-level graph whose nodes carry a `ports` dict of Port objects and
+    whose edges carry the port numbers of each link endpoint.
+
+    Every mutation bumps `version` (via mark_changed) and invalidates the
+    cached fingerprint, so equality checks cost a tuple comparison instead of
+    a graph isomorphism test.
+
+    copy() is copy-on-write: the copy shares every switch's node data, ports
+    and adjacency with the original, and whichever side is changed first
+    copies just the switches it touches.  Node, port and edge data must
+    therefore be changed through Topology methods (add_port, update_port,
+    remove_port, add_edge, ...), never in place.  snapshot() returns a
+    read-only copy.
+
+    Copies may be taken on one thread while another changes the source (e.g.,
+    the debouncer snapshotting ConcreteNetwork.next_topo), so mutators and
+    copies hold update_lock, shared by all topologies, while they hand out or
+    take ownership of switch data.
+    """
+    version = 0
+    _fingerprint = None
+    _routing = None
+    update_lock = threading.RLock()
+
+    @_with_update_lock
+    def __init__(self,data=None,**attr):
+        self.frozen = False
+        self._owned = set()   # switches whose data no other copy shares
+        super(Topology,self).__init__(data,**attr)
+        if not data is None:
+            # the conversion shares port and edge data with the source graph,
+            # so neither side owns it any longer
+            self._owned = set()
+            if isinstance(data,Topology):
+                data._owned = set()
+
+    def mark_changed(self):
+        self.version += 1
+        self._fingerprint = None
+
+    def _writable(self):
+        if self.frozen:
+            raise RuntimeError("topology snapshot is read-only")
+
+    @_with_update_lock
+    def _own(self,switch):
+        """ Give this topology a private copy of switch's data. """
+        self._writable()
+        if switch in self._owned:
+            return
+        attrs = dict(self.node[switch])
+        if 'ports' in attrs:
+            attrs['ports'] = dict((port_no,copy.copy(port))
+                                  for (port_no,port) in attrs['ports'].items())
+        self.node[switch] = attrs
+        self.adj[switch] = dict(self.adj[switch])
+        self._owned.add(switch)
+
+    ### NETWORKX MUTATORS, MADE COPY-ON-WRITE
+    @_with_update_lock
+    def add_node(self,n,attr_dict=None,**attr):
+        self._writable()
+        if n in self.node:
+            self._own(n)
+            super(Topology,self).add_node(n,attr_dict,**attr)
+        else:
+            super(Topology,self).add_node(n,attr_dict,**attr)
+            self._owned.add(n)
+        self.mark_changed()
+
+    def add_nodes_from(self,nodes,**attr):
+        for n in nodes:
+            try:
+                n in self.node
+            except TypeError:
+                (n,ndict) = n
+                newattr = attr.copy()
+                newattr.update(ndict)
+                self.add_node(n,**newattr)
+                continue
+            self.add_node(n,**attr)
+
+    @_with_update_lock
+    def remove_node(self,n):
+        if n in self.adj:
+            for nbr in self.adj[n]:
+                if nbr != n:
+                    self._own(nbr)
+        self._writable()
+        super(Topology,self).remove_node(n)
+        self._owned.discard(n)
+        self.mark_changed()
+
+    def remove_nodes_from(self,nodes):
+        for n in nodes:
+            if n in self.node:
+                self.remove_node(n)
+
+    @_with_update_lock
+    def add_edge(self,u,v,attr_dict=None,**attr):
+        self._writable()
+        for n in (u,v):
+            if n in self.node:
+                self._own(n)
+        if u in self.adj and v in self.adj[u]:
+            # edge data is shared by both endpoints and maybe other copies
+            data = dict(self.adj[u][v])
+            self.adj[u][v] = data
+            self.adj[v][u] = data
+        new = [n for n in (u,v) if not n in self.node]
+        super(Topology,self).add_edge(u,v,attr_dict,**attr)
+        self._owned.update(new)
+        self.mark_changed()
+
+    def add_edges_from(self,ebunch,attr_dict=None,**attr):
+        for e in ebunch:
+            if len(e) == 3:
+                (u,v,dd) = e
+            else:
+                (u,v) = e
+                dd = {}
+            data = dict(attr_dict or {})
+            data.update(attr)
+            data.update(dd)
+            self.add_edge(u,v,data)
+
+    @_with_update_lock
+    def remove_edge(self,u,v):
+        self._writable()
+        for n in (u,v):
+            if n in self.node:
+                self._own(n)
+        super(Topology,self).remove_edge(u,v)
+        self.mark_changed()
+
+    def remove_edges_from(self,ebunch):
+        for e in ebunch:
+            (u,v) = e[:2]
+            if u in self.adj and v in self.adj[u]:
+                self.remove_edge(u,v)
+
+    @_with_update_lock
+    def clear(self):
+        self._writable()
+        super(Topology,self).clear()
+        self._owned = set()
+        self.mark_changed()
+
+    @_with_update_lock
+    def copy(self):
+        """
+        A mutable copy sharing all switch data with this topology until
+        either side changes it.  Costs O(switches) pointer copies.
+
+        :rtype: Topology
+        """
+        topo = self.__class__.__new__(self.__class__)
+        topo.__dict__.update(self.__dict__)
+        topo.graph = dict(self.graph)
+        topo.node = dict(self.node)
+        topo.adj = dict(self.adj)
+        topo.edge = topo.adj
+        topo.frozen = False
+        # from here on, neither side owns the shared switch data
+        topo._owned = set()
+        self._owned = set()
+        # the copy starts from this topology's routing state and updates it
+        # on first use
+        topo._routing = None
+        if not self._routing is None:
+            topo._routing = RoutingCache(self._routing)
+        return topo
+
+    def snapshot(self):
+        """
+        A read-only copy; see copy().  A snapshot of a snapshot is itself.
+
+        :rtype: Topology
+        """
+        if self.frozen:
+            return self
+        topo = self.copy()
+        topo.frozen = True
+        return topo
+
+    def fingerprint(self):
+        """
+        Canonical, hashable summary of the topology: the sorted switch, port
+        and link tuples.  Cached until the next mark_changed().
+
+        :rtype: tuple
+        """
+        if self._fingerprint is None:
+            def port_tuple(port):
+                linked_to = port.linked_to
+                if not linked_to is None:
+                    linked_to = (linked_to.switch, linked_to.port_no)
+                return (port.port_no, port.config, port.status, linked_to)
+            switches = tuple(sorted(
+                (switch, tuple(sorted(port_tuple(p)
+                                      for p in attrs['ports'].values())))
+                for switch,attrs in self.nodes(data=True)))
+            links = tuple(sorted(
+                (min(s1,s2), max(s1,s2), tuple(sorted(data.items())))
+                for (s1,s2,data) in self.edges(data=True)))
+            self._fingerprint = (switches, links)
+        return self._fingerprint
+
     def __eq__(self,other):
-        def exact_node_match(n1,n2):
-            return n1 == n2
-        def exact_edge_match(e1,e2):
-            return e1 == e2
-        return nx.is_isomorphic(self,other,node_match=exact_node_match,edge_match=exact_edge_match)
+        if self is other:
+            return True
+        if not isinstance(other,Topology):
+            return False
+        return self.fingerprint() == other.fingerprint()
+
+    def __ne__(self,other):
+        return not (self == other)
+
+    def routing(self):
+        """
+        Shortest-path routing state for this topology, brought up to date
+        with any changes made since the last call.
+
+        :rtype: RoutingCache
+        """
+        if self._routing is None:
+            self._routing = RoutingCache()
+        self._routing.update(self)
+        return self._routing
 
     def switch_list(self):
         return self.nodes()
@@ -256,15 +492,39 @@ class Topology(nx.Graph):
                 for switch,attrs in self.nodes(data=True)]
 
     def add_switch(self,switch):
-        self.add_node(switch, name=switch, ports={})  
+        self.add_node(switch, name=switch, ports={})
 
-    def add_port(self,switch,port_no,config,status,port_type):
+    @_with_update_lock
+    def add_port(self,switch,port_no,config,status,port_type=[]):
+        self._own(switch)
         self.node[switch]["ports"][port_no] = Port(port_no,config,status,port_type)
-
+        self.mark_changed()
+
+    @_with_update_lock
+    def update_port(self,switch,port_no,**attrs):
+        """
+        Set attributes (config, status, port_type, linked_to) of a port.
+        Raises KeyError if the switch or port does not exist.
+        """
+        self.node[switch]["ports"][port_no]
+        self._own(switch)
+        port = self.node[switch]["ports"][port_no]
+        for (k,v) in attrs.items():
+            setattr(port,k,v)
+        self.mark_changed()
+
+    @_with_update_lock
+    def remove_port(self,switch,port_no):
+        self.node[switch]["ports"][port_no]
+        self._own(switch)
+        del self.node[switch]["ports"][port_no]
+        self.mark_changed()
+
+    @_with_update_lock
     def add_link(self,loc1,loc2):
         self.add_edge(loc1.switch, loc2.switch, {loc1.switch: loc1.port_no, loc2.switch: loc2.port_no})
-        self.node[loc1.switch]['ports'][loc1.port_no].linked_to = loc2
-        self.node[loc2.switch]['ports'][loc2.port_no].linked_to = loc1
+        self.update_port(loc1.switch, loc1.port_no, linked_to=loc2)
+        self.update_port(loc2.switch, loc2.port_no, linked_to=loc1)
 
     def is_connected(self):
         return nx.is_connected(self)
@@ -294,6 +554,7 @@ class Topology(nx.Graph):
                     locs.add(Location(switch,port.port_no))
         return locs
 
+    @_with_update_lock
     def copy_attributes(self,initial_topo):
         """TAKES A TRANSFORMED TOPOLOGY AND COPIES IN ATTRIBUTES FROM INITIAL TOPOLOGY"""
         for s,data in initial_topo.nodes(data=True):
@@ -303,8 +564,11 @@ class Topology(nx.Graph):
                     pass
                 else:
                     # reconcile node data
+                    self._own(s)
                     for (k,v) in data.items():
                         self.node[s][k] = v
+                    # now shared with initial_topo
+                    self._owned.discard(s)
             except KeyError:
                 # removed node
                 pass
@@ -317,11 +581,11 @@ class Topology(nx.Graph):
                     pass
                 else:
                     # copying edge data
-                    for (k,v) in data.items():
-                        self[s1][s2][k] = v
+                    self.add_edge(s1,s2,data)
             except: 
                 # no edge to copy
                 pass
+        self.mark_changed()
 
     ### TAKES A TRANSFORMED TOPOLOGY AND UPDATES ITS ATTRIBUTES
     def reconcile_attributes(self,initial_topo,new_egress=False):
@@ -338,14 +602,14 @@ class Topology(nx.Graph):
                 to_remove = [Location(s1,data[s1]),Location(s2,data[s2])]
                 for loc in to_remove:
                     try:
-                        new_port_nos = self.node[loc.switch]['ports'].copy() 
                         if new_egress:
-                            new_port_nos[loc.port_no].linked_to = None
+                            self.update_port(loc.switch,loc.port_no,
+                                             linked_to=None)
                         else:
-                            del new_port_nos[loc.port_no]
-                            self.node[loc.switch]['ports'] = new_port_nos
+                            self.remove_port(loc.switch,loc.port_no)
                     except KeyError:
                         pass                # node removed
+        self.mark_changed()
 
     def filter_nodes(self, switches=[]):
         remove = [ s for s in self.nodes() if not s in switches] 
@@ -459,6 +723,247 @@ class Topology(nx.Graph):
         return repr(self)
         
 
+class SpanningTree(object):
+    """
+    A spanning forest of a Topology, repaired link by link as the topology
+    changes instead of being rebuilt (and deep-copied) from scratch.
+
+    For every switch it keeps the set of flood ports: all of the switch's
+    ports except those attached to links left out of the tree.  update()
+    reports which switches' flood ports changed, so that callers only have
+    to redo the per-switch work for those.
+    """
+    def __init__(self):
+        self.links = {}         # (s1,s2) -> {s1 : port_no, s2 : port_no}
+        self.tree = {}          # switch -> set of tree neighbors
+        self.switch_ports = {}  # switch -> frozenset of flood port numbers
+
+    @staticmethod
+    def link_key(s1,s2):
+        if s1 <= s2:
+            return (s1,s2)
+        return (s2,s1)
+
+    def tree_component(self,switch):
+        seen = {switch}
+        stack = [switch]
+        while stack:
+            u = stack.pop()
+            for v in self.tree[u]:
+                if not v in seen:
+                    seen.add(v)
+                    stack.append(v)
+        return seen
+
+    def add_tree_link(self,s1,s2):
+        self.tree[s1].add(s2)
+        self.tree[s2].add(s1)
+
+    def remove_tree_link(self,s1,s2):
+        self.tree[s1].discard(s2)
+        self.tree[s2].discard(s1)
+
+    def span_component(self,topology,switch):
+        """
+        Grow the tree around switch until it spans switch's connected
+        component in topology, adding a link whenever it reaches a switch
+        in a different tree component.  Returns the switches spanned.
+        """
+        seen = self.tree_component(switch)
+        stack = list(seen)
+        while stack:
+            u = stack.pop()
+            for v in topology[u]:
+                if not v in seen:
+                    self.add_tree_link(u,v)
+                    absorbed = self.tree_component(v)
+                    seen |= absorbed
+                    stack.extend(absorbed)
+        return seen
+
+    def update(self,topology):
+        """
+        Bring the tree in line with topology.
+
+        :param topology: the current topology
+        :type topology: Topology
+        :rtype: set of switches whose flood ports changed (or that were
+            added or removed)
+        """
+        links = {}
+        for (s1,s2,data) in topology.edges(data=True):
+            links[self.link_key(s1,s2)] = dict(data)
+        removed = [k for (k,d) in self.links.items() if links.get(k) != d]
+        added = [k for (k,d) in links.items() if self.links.get(k) != d]
+        self.links = links
+
+        switches = set(topology.nodes())
+        for switch in switches:
+            self.tree.setdefault(switch,set())
+
+        # drop stale tree links first, so the forest only uses live links
+        cut = []
+        for (s1,s2) in removed:
+            if s2 in self.tree.get(s1,()):
+                self.remove_tree_link(s1,s2)
+                cut.append((s1,s2))
+        for switch in set(self.tree) - switches:
+            for v in self.tree[switch]:
+                self.tree[v].discard(switch)
+            del self.tree[switch]
+
+        # then let every piece cut off from its old tree find its way back
+        spanned = set()
+        for (s1,s2) in cut:
+            for switch in (s1,s2):
+                if switch in switches and not switch in spanned:
+                    spanned |= self.span_component(topology,switch)
+
+        for (s1,s2) in added:
+            if not s2 in self.tree_component(s1):
+                self.add_tree_link(s1,s2)
+
+        changed = set()
+        for switch in set(self.switch_ports) - switches:
+            del self.switch_ports[switch]
+            changed.add(switch)
+        for switch,attrs in topology.nodes(data=True):
+            pruned = set(topology[switch][v][switch] for v in topology[switch]
+                         if not v in self.tree[switch])
+            ports = frozenset(p for p in attrs['ports'] if not p in pruned)
+            if self.switch_ports.get(switch) != ports:
+                self.switch_ports[switch] = ports
+                changed.add(switch)
+        return changed
+
+    def __repr__(self):
+        tree_links = sorted(self.link_key(s1,s2)
+                            for s1 in self.tree for s2 in self.tree[s1])
+        return "SpanningTree(links=%s, flood_ports=%s)" % (
+            sorted(set(tree_links)),
+            sorted((s,sorted(p)) for (s,p) in self.switch_ports.items()))
+
+
+class RoutingCache(object):
+    """
+    Shortest paths over a Topology, kept as one BFS tree per destination
+    switch.  Trees are computed lazily the first time a destination is asked
+    for, and update() only discards the trees a topology change can affect:
+    those using a removed link, and those an added link could shorten.
+
+    The trees double as next-hop tables: a switch's parent in the tree
+    rooted at dst is the neighbor to forward to, so no path lists are
+    materialized unless path() is called.
+
+    :param parent: cache to start from; its trees are shared, not copied
+    :type parent: RoutingCache
+    """
+    def __init__(self,parent=None):
+        if parent is None:
+            self.links = {}     # (s1,s2) -> {s1 : port_no, s2 : port_no}
+            self.adj = {}       # switch -> {neighbor : port_no at switch}
+            self.trees = {}     # dst -> ({switch : parent}, {switch : hops})
+        else:
+            self.links = parent.links
+            self.adj = parent.adj
+            self.trees = dict(parent.trees)
+        self.topology_version = None
+        self.trees_computed = 0
+
+    def update(self,topology):
+        version = (id(topology),topology.version)
+        if version == self.topology_version:
+            return
+        self.topology_version = version
+
+        links = {}
+        adj = dict((switch,{}) for switch in topology.nodes())
+        for (s1,s2,data) in topology.edges(data=True):
+            links[SpanningTree.link_key(s1,s2)] = dict(data)
+            adj[s1][s2] = data[s1]
+            adj[s2][s1] = data[s2]
+        removed = [k for (k,d) in self.links.items() if links.get(k) != d]
+        added = [k for (k,d) in links.items() if self.links.get(k) != d]
+        gone = set(self.adj) - set(adj)
+        self.links = links
+        self.adj = adj
+
+        for (dst,(parents,hops)) in self.trees.items():
+            if dst in gone:
+                stale = True
+            else:
+                stale = False
+                for (s1,s2) in removed:
+                    if parents.get(s1) == s2 or parents.get(s2) == s1:
+                        stale = True
+                        break
+                if not stale:
+                    for (s1,s2) in added:
+                        h1 = hops.get(s1)
+                        h2 = hops.get(s2)
+                        if h1 is None and h2 is None:
+                            continue
+                        if h1 is None or h2 is None or abs(h1-h2) > 1:
+                            stale = True
+                            break
+            if stale:
+                del self.trees[dst]
+
+    def tree(self,dst):
+        try:
+            return self.trees[dst]
+        except KeyError:
+            pass
+        parents = {dst : None}
+        hops = {dst : 0}
+        frontier = [dst]
+        while frontier:
+            next_frontier = []
+            for u in frontier:
+                for v in self.adj[u]:
+                    if not v in parents:
+                        parents[v] = u
+                        hops[v] = hops[u] + 1
+                        next_frontier.append(v)
+            frontier = next_frontier
+        self.trees[dst] = (parents,hops)
+        self.trees_computed += 1
+        return self.trees[dst]
+
+    def next_hop(self,switch,dst):
+        """
+        The port on switch that leads towards dst, or None if switch is dst.
+        Raises KeyError if dst is unreachable from switch.
+        """
+        nxt = self.tree(dst)[0][switch]
+        if nxt is None:
+            return None
+        return self.adj[switch][nxt]
+
+    def next_hop_table(self,dst):
+        """
+        :rtype: dict from each switch that can reach dst to its outgoing port
+        """
+        parents = self.tree(dst)[0]
+        return dict((s,self.adj[s][nxt]) for (s,nxt) in parents.items()
+                    if not nxt is None)
+
+    def path(self,src,dst):
+        """
+        The outgoing Locations from src up to (not including) dst, as in
+        Topology.all_pairs_shortest_path.  Raises KeyError if unreachable.
+        """
+        parents = self.tree(dst)[0]
+        locs = []
+        cur = src
+        nxt = parents[cur]
+        while not nxt is None:
+            locs.append(Location(cur,self.adj[cur][nxt]))
+            cur = nxt
+            nxt = parents[cur]
+        return locs
+
+
 class Network(object):
     """Abstract class for networks"""
     def __init__(self,topology=None):
@@ -484,7 +989,7 @@ class Network(object):
         return self._topology == other._topology
 
     def copy(self):
-        topology = self._topology.copy()
+        topology = self._topology.snapshot()
         network = Network(topology)
         network.inject_packet = self.inject_packet
         return network
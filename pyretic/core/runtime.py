@@ -35,16 +35,23 @@ from pyretic.core.network import *
 from pyretic.core.packet import *
 from pyretic.core.classifier import get_rule_exact_match
 from pyretic.core.classifier import get_rule_derivation_tree
+from pyretic.backend.comm import COOKIE_TAG_SHIFT
 
 from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
-import logging, sys, time
+import logging, sys, time, threading
+from ipaddr import IPv4Network
+from collections import OrderedDict
 from datetime import datetime
+from array import array
 import copy
 
 TABLE_MISS_PRIORITY = 0
 TABLE_START_PRIORITY = 60000
 STATS_REQUERY_THRESHOLD_SEC = 10
-NUM_PATH_TAGS=1022
+STATS_EPOCH_SEC = 1
+STATS_SCOPE_MAX_FRACTION = 0.5 # largest share of a switch's flows to scope
+STATS_BATCH_MERGE_REQUESTS = 2 # batched requests to a switch sent as one
+NUM_PATH_TAGS=1022 # initial size; pathcomp grows the path tag as needed
 
 class Runtime(object):
     """
@@ -106,12 +113,13 @@ class Runtime(object):
         self.in_bucket_apply = False
         self.network_triggered_policy_update = False
         self.bucket_triggered_policy_update = False
-        self.global_outstanding_queries_lock = Lock()
-        self.global_outstanding_queries = {}
-        self.last_queried_time_lock = Lock()
-        self.last_queried_time = {}
-        self.global_outstanding_deletes_lock = Lock()
-        self.global_outstanding_deletes = {}
+        self.stats_scheduler = StatsScheduler(self.request_flow_stats,
+                                              self.request_aggregate_stats,
+                                              self.request_scoped_flow_stats)
+        PollingService.get_shared().set_batch_hooks(
+            self.stats_scheduler.start_batch, self.stats_scheduler.finish_batch)
+        self.switch_flows = {} # switch -> matches of the flows installed
+        self.bucket_registry = CountBucketRegistry()
         self.manager = Manager()
         self.old_rules_lock = Lock()
         # self.old_rules = self.manager.list() # not multiprocess state anymore!
@@ -120,6 +128,9 @@ class Runtime(object):
         self.update_buckets_lock = Lock()
         self.classifier_version_no = 0
         self.classifier_version_lock = Lock()
+        self.policy_version = 0 # bumped on every policy or network change
+        self.topology_policies_version = None
+        self.topology_policies = {}
         self.default_cookie = 0
         self.packet_in_time = 0
         self.num_packet_ins = 0
@@ -195,6 +206,7 @@ class Runtime(object):
         some sub-policy in self.policy changes.
         """
         with self.policy_lock:
+            self.policy_version += 1
 
             # tag stale classifiers as invalid
             recompile_list = on_recompile_path_list(id(sub_pol),
@@ -228,6 +240,7 @@ class Runtime(object):
 
             # otherwise copy the network object
             self.in_network_update = True
+            self.policy_version += 1
             self.prev_network = self.network.copy()
 
             # update the policy w/ the new network object
@@ -309,8 +322,11 @@ class Runtime(object):
         self.update_dynamic_sub_path_pols(self.path_policy)
 
     def handle_path_change_dyn_pred(self, sub_pol, full_pol):
+        from pyretic.lib.path import pathcomp
         recompile_list = on_recompile_path_list(id(sub_pol), full_pol)
         map(lambda p: p.invalidate_classifier(), recompile_list)
+        # the predicate partition built so far no longer holds
+        pathcomp.invalidate()
         self.handle_path_change()
 
     def update_dynamic_sub_path_pols(self, path_pol):
@@ -343,12 +359,14 @@ class Runtime(object):
         """ Recompile DFA based on new path policy, which in turns updates the
         runtime's policy member. """
         from pyretic.lib.path import pathcomp
-        policy_fragments = pathcomp.compile(self.path_policy, NUM_PATH_TAGS)
-        (in_tag, in_cap, out_tag, out_cap) = policy_fragments
-        self.path_in_tagging.policy  = in_tag
-        self.path_in_capture.policy  = in_cap
-        self.path_out_tagging.policy = out_tag
-        self.path_out_capture.policy = out_cap
+        policy_fragments = pathcomp.compile(self.path_policy)
+        dyn_pols = [self.path_in_tagging, self.path_in_capture,
+                    self.path_out_tagging, self.path_out_capture]
+        # pathcomp returns the very same policy when a fragment is unchanged;
+        # leave those alone so they aren't recompiled.
+        for (dyn_pol, pol) in zip(dyn_pols, policy_fragments):
+            if not dyn_pol.policy is pol:
+                dyn_pol.policy = pol
 
 
 #######################
@@ -439,26 +457,30 @@ class Runtime(object):
 # PROACTIVE COMPILATION 
 #########################
 
+    def default_rules(self, s):
+        """ Backup rules installed on switch s by default. """
+        # Fallback "send to controller" rule under table miss
+        return [({'switch' : s},
+                 TABLE_MISS_PRIORITY,
+                 [{'outport' : OFPP_CONTROLLER}],
+                 self.default_cookie,
+                 False),
+                # Send all LLDP packets to controller for topology maintenance
+                ({'switch' : s, 'ethtype': LLDP_TYPE},
+                 TABLE_START_PRIORITY + 2,
+                 [{'outport' : OFPP_CONTROLLER}],
+                 self.default_cookie,
+                 False),
+                # Drop all IPv6 packets by default.
+                ({'switch':s, 'ethtype':IPV6_TYPE},
+                 TABLE_START_PRIORITY + 1,
+                 [],
+                 self.default_cookie,
+                 False)]
+
     def install_defaults(self, s):
         """ Install backup rules on switch s by default. """
-        # Fallback "send to controller" rule under table miss
-        self.install_rule(({'switch' : s},
-                           TABLE_MISS_PRIORITY,
-                           [{'outport' : OFPP_CONTROLLER}],
-                           self.default_cookie,
-                           False))
-        # Send all LLDP packets to controller for topology maintenance
-        self.install_rule(({'switch' : s, 'ethtype': LLDP_TYPE},
-                           TABLE_START_PRIORITY + 2,
-                           [{'outport' : OFPP_CONTROLLER}],
-                           self.default_cookie,
-                           False))
-        # Drop all IPv6 packets by default.
-        self.install_rule(({'switch':s, 'ethtype':IPV6_TYPE},
-                           TABLE_START_PRIORITY + 1,
-                           [],
-                           self.default_cookie,
-                           False))
+        map(self.install_rule, self.default_rules(s))
 
     def install_classifier(self, classifier):
         """
@@ -507,6 +529,7 @@ class Runtime(object):
                         act.set_topology_policy_fun(self.get_topology_policy)
                         act.set_fwding_policy_fun(self.get_fwding_policy)
                         act.set_egress_policy_fun(self.get_egress_policy)
+                        act.set_policy_version_fun(self.get_policy_version)
                         new_acts.append(Controller)
                     else:
                         new_acts.append(act)
@@ -595,15 +618,13 @@ class Runtime(object):
             return Classifier(specialized_rules)
 
         def bookkeep_buckets(diff_lists):
-            """Whenever rules are associated with counting buckets,
-            add a reference to the classifier rule into the respective
-            bucket for querying later. Count bucket actions operate at
-            the pyretic level and are removed before installing rules.
+            """Whenever rules are associated with counting buckets, register
+            the classifier rules with the runtime's bucket registry, which
+            counts them for the buckets. Count bucket actions operate at the
+            pyretic level and are removed before installing rules.
 
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
+            :param diff_lists: difference lists between new and old classifier
+            :type diff_lists: 4 tuple of rule lists.
             """
             def collect_buckets(rules):
                 """
@@ -620,31 +641,18 @@ class Runtime(object):
                 return bucket_list
 
             def update_rules_for_buckets(rule, op):
-                (match, priority, actions, version) = rule
-                hashable_match = util.frozendict(match)
-                rule_key = (hashable_match, priority, version)
-                for act in actions:
-                    if isinstance(act, CountBucket):
-                        if op == "add":
-                            act.add_match(match, priority, version)
-                        elif op == "delete":
-                            act.delete_match(match, priority, version)
-                            self.add_global_outstanding_delete(rule_key, act)
-                        elif op == "stay" or op == "modify":
-                            if act.is_new_bucket():
-                                act.add_match(match, priority, version,
-                                              existing_rule=True)
-
-                # debug: check the existence of entries in outstanding_deletes
-                # for all buckets in actions list, if op is deleting the rule.
-                if op == "delete":
-                    with self.global_outstanding_deletes_lock:
-                        for act in actions:
-                            if isinstance(act, CountBucket):
-                                assert (rule_key in
-                                        self.global_outstanding_deletes)
-                                assert (act in
-                                        self.global_outstanding_deletes[rule_key])
+                (match, priority, actions, cookie) = rule
+                buckets = filter(lambda x: isinstance(x, CountBucket), actions)
+                if not buckets:
+                    return
+                if op == "add":
+                    self.bucket_registry.add(match, priority, cookie, buckets)
+                elif op == "delete":
+                    self.bucket_registry.delete(match, priority, cookie)
+                elif op == "modify" or any([b.is_new_bucket()
+                                            for b in buckets]):
+                    self.bucket_registry.add(match, priority, cookie, buckets,
+                                             installed=True)
 
             with self.update_buckets_lock:
                 """The start_update and finish_update functions per bucket guard
@@ -654,12 +662,23 @@ class Runtime(object):
                 """
                 (to_add, to_delete, to_modify, to_stay) = diff_lists
                 all_rules = to_add + to_delete + to_modify + to_stay
+                switch_flows = {}
+                for s in self.network.switch_list():
+                    switch_flows[s] = [m for (m,_,_,_,_) in self.default_rules(s)]
+                for (m,_,_,_) in to_add + to_modify + to_stay:
+                    switch_flows.setdefault(m.get('switch'), []).append(m)
+                self.switch_flows = switch_flows
+                self.stats_scheduler.invalidate()
                 bucket_list = collect_buckets(all_rules)
                 map(lambda x: x.start_update(), bucket_list.values())
                 map(lambda x: update_rules_for_buckets(x, "add"), to_add)
                 map(lambda x: update_rules_for_buckets(x, "delete"), to_delete)
                 map(lambda x: update_rules_for_buckets(x, "stay"), to_stay)
                 map(lambda x: update_rules_for_buckets(x, "modify"), to_modify)
+                self.bucket_registry.collect_tags()
+                map(lambda x: x.add_rule_matches(
+                        self.rule_matches_for_bucket(x)),
+                    bucket_list.values())
                 map(lambda x: x.add_pull_stats(self.pull_stats_for_bucket(x)),
                     bucket_list.values())
                 map(lambda x: x.add_pull_existing_stats(
@@ -908,9 +927,16 @@ class Runtime(object):
 
         def get_new_rules(classifier, curr_classifier_no):
             def add_version(rules, version):
+                """Append the rule cookie: the classifier version, tagged
+                with the set of counting buckets in the rule's actions. Sets
+                of buckets keep their tag while they have rules."""
                 new_rules = []
                 for r in rules:
-                    new_rules.append(r + (version,))
+                    buckets = [a for a in r[2] if isinstance(a, CountBucket)]
+                    tag = 0
+                    if buckets:
+                        tag = self.bucket_registry.get_tag(buckets)
+                    new_rules.append(r + (rule_cookie.make(version, tag),))
                 return new_rules
 
             switches = self.network.switch_list()
@@ -958,9 +984,16 @@ class Runtime(object):
                     if new is None:
                         to_delete.append(old)
                     else:
-                        (new_match,new_priority,new_actions,_) = new
+                        (new_match,new_priority,new_actions,new_version) = new
                         (_,_,old_actions,old_version) = old
-                        if different_actions(old_actions, new_actions):
+                        if (rule_cookie.tag(new_version) !=
+                            rule_cookie.tag(old_version)):
+                            # The rule's set of buckets changed: reinstall it,
+                            # so that its cookie carries the tag of the new
+                            # set, as modifying it would keep the old cookie.
+                            to_delete.append(old)
+                            to_add.append(new)
+                        elif different_actions(old_actions, new_actions):
                             modified_rule = (new_match, new_priority,
                                              new_actions, old_version)
                             to_modify.append(modified_rule)
@@ -1128,33 +1161,58 @@ class Runtime(object):
             switches."""
             return False
         self.log.debug('Non-empty query switch list.')
+        # The bucket must be waiting on all its switches before any of them is
+        # fed from a snapshot, lest it report back early.
         for s in switch_list:
             bucket.add_outstanding_switch_query(s)
-            already_queried = self.add_global_outstanding_query(s, bucket)
-            need_to_query = not already_queried
-            """ Also check if some time has passed since the switch was last
-            queried. """
-            if already_queried:
-                with self.last_queried_time_lock:
-                    assert s in self.last_queried_time
-                    need_to_query = ((time.time() - self.last_queried_time[s])
-                                       > STATS_REQUERY_THRESHOLD_SEC)
-            if need_to_query:
-                self.request_flow_stats(s)
-                self.add_last_queried_time(s)
-                self.log.debug('in pull_stats: sent out stats query to switch '
+        snapshots = []
+        for s in switch_list:
+            snapshot = self.stats_scheduler.pull(
+                s, bucket, self.get_aggregate_match(bucket, s),
+                self.get_stats_scope(bucket, s))
+            if snapshot is None:
+                self.log.debug('in pull_stats: waiting on stats from switch '
                                + str(s))
             else:
-                self.log.debug("in pull_stats: didn't send stats req to switch"
-                               + str(s))
+                snapshots.append(snapshot)
+        for (key, stats) in snapshots:
+            self.log.debug('in pull_stats: stats from snapshot ' + str(key))
+            self.dispatch_stats(key, stats, [bucket])
         return True
 
+    def get_aggregate_match(self, bucket, s):
+        return StatsScheduler.aggregate_match(
+            self.bucket_registry.switch_rules(bucket, s),
+            self.switch_flows.get(s))
+
+    def get_stats_scope(self, bucket, s):
+        return StatsScheduler.stats_scope(
+            self.bucket_registry.switch_rules(bucket, s),
+            self.switch_flows.get(s))
+
+    def dispatch_stats(self, key, stats, buckets):
+        """ Hand stats for a scheduler request key to the waiting buckets. """
+        switch = key[1]
+        if key[0] in ['flow', 'scoped']:
+            self.bucket_registry.dispatch(switch, stats, buckets)
+        else:
+            for bucket in buckets:
+                bucket.handle_aggregate_stats(switch, stats['packet_count'],
+                                              stats['byte_count'])
+
+    def rule_matches_for_bucket(self, bucket):
+        """
+        Returns a function that lists the matches of the bucket's rules."""
+        def bucket_rule_matches():
+            return self.bucket_registry.bucket_matches(bucket)
+        return bucket_rule_matches
+
     def pull_stats_for_bucket(self,bucket):
         """
         Returns a function that can be used by counting buckets to
         issue queries from the runtime."""
         def pull_bucket_stats():
-            preds = [me.match for me in bucket.matches.keys()]
+            preds = self.bucket_registry.bucket_matches(bucket)
             return self.pull_switches_for_preds(preds, bucket)
         return pull_bucket_stats
 
@@ -1163,36 +1221,11 @@ class Runtime(object):
         at least one rule that was already created in an earlier classifier.
         """
         def pull_existing_bucket_stats():
-            preds = [me.match for me,ms in bucket.matches.items() if ms.existing_rule]
+            preds = self.bucket_registry.bucket_matches(bucket,
+                                                        existing_only=True)
             return self.pull_switches_for_preds(preds, bucket)
         return pull_existing_bucket_stats
 
-    def add_global_outstanding(self, global_dict, global_lock, key, val):
-        """Helper function for adding a mapping for an outstanding query or rule
-        to objects (i.e., buckets) which are waiting for them."""
-        entry_found = False
-        with global_lock:
-            if not key in global_dict:
-                global_dict[key] = [val]
-            else:
-                if not val in global_dict[key]:
-                    global_dict[key].append(val)
-                entry_found = True
-        return entry_found
-
-    def add_global_outstanding_query(self, s, bucket):
-        return self.add_global_outstanding(self.global_outstanding_queries,
-                                           self.global_outstanding_queries_lock,
-                                           s, bucket)
-
-    def add_global_outstanding_delete(self, rule, bucket):
-        return self.add_global_outstanding(self.global_outstanding_deletes,
-                                           self.global_outstanding_deletes_lock,
-                                           rule, bucket)
-
-    def add_last_queried_time(self, s):
-        with self.last_queried_time_lock:
-            self.last_queried_time[s] = time.time()
 
 ####################################
 # PACKET MARSHALLING/UNMARSHALLING 
@@ -1289,6 +1322,17 @@ class Runtime(object):
     def request_flow_stats(self,switch):
         self.backend.send_flow_stats_request(switch)
 
+    def request_aggregate_stats(self, switch, m, request_id):
+        pred = dict(m)
+        pred['switch'] = switch
+        self.backend.send_aggregate_stats_request(pred, request_id)
+
+    def request_scoped_flow_stats(self, switch, m, tags, request_id):
+        pred = dict(m)
+        pred['switch'] = switch
+        self.backend.send_scoped_flow_stats_request(pred, sorted(tags),
+                                                    request_id)
+
     def inject_discovery_packet(self,dpid, port):
         self.backend.inject_discovery_packet(dpid,port)
 
@@ -1343,12 +1387,15 @@ class Runtime(object):
         output += '\n\t cookie: \t' + str(flow_stat['cookie'])
         return output
 
-    def handle_flow_stats_reply(self, switch, flow_stats):
-        self.log.info('received a flow stats reply from switch ' + str(switch))
+    def convert_flow_stats(self, flow_stats):
         flow_stats = [ { f : self.ofp_convert(f,v)
                          for (f,v) in flow_stat.items() }
                        for flow_stat in flow_stats       ]
-        flow_stats = sorted(flow_stats, key=lambda d: -d['priority'])
+        return sorted(flow_stats, key=lambda d: -d['priority'])
+
+    def handle_flow_stats_reply(self, switch, flow_stats):
+        self.log.info('received a flow stats reply from switch ' + str(switch))
+        flow_stats = self.convert_flow_stats(flow_stats)
         self.log.debug(
             '|%s|\n\t%s\n' % (str(datetime.now()),
                 '\n'.join(['flow table for switch='+repr(switch)] + 
@@ -1362,66 +1409,73 @@ class Runtime(object):
                                str(f))
                 self.log.debug('packets: ' + str(extracted_pkts) + ' bytes: ' +
                                str(extracted_bytes))
-        buckets_list = []
-        with self.global_outstanding_queries_lock:
-            if switch in self.global_outstanding_queries:
-                buckets_list = self.global_outstanding_queries[switch]
-                del self.global_outstanding_queries[switch]
-            self.log.debug('in stats_reply: outstanding switches is now:' +
-                           str(self.global_outstanding_queries) )
-        for bucket in buckets_list:
-            bucket.handle_flow_stats_reply(switch, flow_stats)
+        key = StatsScheduler.flow_key(switch)
+        buckets_list = self.stats_scheduler.handle_reply(key, flow_stats)
+        self.dispatch_stats(key, flow_stats, buckets_list)
+
+    def handle_scoped_flow_stats_reply(self, switch, request_id, flow_stats):
+        self.log.info('received a scoped flow stats reply from switch ' +
+                      str(switch) + ' with ' + str(len(flow_stats)) + ' flows')
+        flow_stats = self.convert_flow_stats(flow_stats)
+        (key, buckets_list) = self.stats_scheduler.handle_request_reply(
+            request_id, flow_stats)
+        if key is not None:
+            self.dispatch_stats(key, flow_stats, buckets_list)
+
+    def handle_aggregate_stats_reply(self, switch, request_id, stats):
+        self.log.info('received an aggregate stats reply from switch ' +
+                      str(switch) + ': ' + str(stats))
+        (key, buckets_list) = self.stats_scheduler.handle_request_reply(
+            request_id, stats)
+        if key is not None:
+            self.dispatch_stats(key, stats, buckets_list)
 
     def handle_flow_removed(self, dpid, flow_stat_dict):
-        def str_convert_match(m):
-            """ Convert incoming flow stat matches into a form compatible with
-            stored match entries. """
-            new_dict = {}
-            for k,v in m.iteritems():
-                if not (k == 'srcip' or k == 'dstip'):
-                    new_dict[k] = v
-                else:
-                    new_dict[k] = str(v.ip)
-            return new_dict
         flow_stat = { f : self.ofp_convert(f,v)
                       for (f,v) in flow_stat_dict.items() }
         self.log.debug(
             '|%s|\n\t%s\n\t%s' %
             (str(datetime.now()), "flow removed message: rule:",
              self.flow_stat_str(flow_stat)))
-        with self.global_outstanding_deletes_lock:
-            f = flow_stat
-            rule_match = str_convert_match(
-                match(f['match']).intersect(match(switch=dpid)).map)
-            priority = f['priority']
-            version = f['cookie']
-            match_entry = (util.frozendict(rule_match), priority, version)
-            if f['packet_count'] > 0:
-                self.log.debug("Got removed flow\n%s with counts %d %d" %
-                               (str(match_entry), f['packet_count'],
-                                f['byte_count']) )
-                if version > 0:
-                    self.total_packets_removed += f['packet_count']
-                    self.log.debug("Total packets removed: %d" %
-                                   self.total_packets_removed)
-                self.log.debug('Printing global structure for deleted rules:')
-                for k,v in self.global_outstanding_deletes.iteritems():
-                    self.log.debug(str(k) + " : " + str(v))
-            if match_entry in self.global_outstanding_deletes:
-                if f['packet_count'] > 0:
-                    self.log.debug("Membership test passed; non-zero # packets!")
-                bucket_list = self.global_outstanding_deletes[match_entry]
-                for bucket in bucket_list:
-                    self.log.debug("Sending bucket %d a flow removed msg" %
-                                  id(bucket))
-                    bucket.handle_flow_removed(rule_match, priority, version, f)
-                del self.global_outstanding_deletes[match_entry]
+        # the flow's counts move from the switch to the buckets
+        self.stats_scheduler.invalidate(dpid)
+        f = flow_stat
+        version = rule_cookie.version(f['cookie'])
+        if f['packet_count'] > 0 and version > 0:
+            self.total_packets_removed += f['packet_count']
+            self.log.debug("Total packets removed: %d" %
+                           self.total_packets_removed)
+        if rule_cookie.tag(f['cookie']) == 0:
+            return # not counted by any bucket
+        buckets = self.bucket_registry.remove(dpid, f['priority'], f['cookie'])
+        for (bucket, existing_rule) in buckets:
+            self.log.debug("Sending bucket %d a flow removed msg" %
+                           id(bucket))
+            bucket.handle_flow_removed(f['packet_count'], f['byte_count'],
+                                       existing_rule)
 
 ################################################################################
 # Topology Transfer and Full Policy Functions
 ################################################################################
+    def cached_topology_policy(self, name, make_policy):
+        """ Policies derived from the topology are only rebuilt when the
+        topology changes, so that path buckets can keep their memoized
+        transfer functions. """
+        topo = self.network.topology
+        version = (id(topo), topo.version)
+        if version != self.topology_policies_version:
+            self.topology_policies_version = version
+            self.topology_policies = {}
+        if not name in self.topology_policies:
+            self.topology_policies[name] = make_policy(topo)
+        return self.topology_policies[name]
+
     def get_topology_policy(self):
-        switch_edges = self.network.topology.edges(data=True)
+        return self.cached_topology_policy('topology',
+                                           self.make_topology_policy)
+
+    def make_topology_policy(self, topology):
+        switch_edges = topology.edges(data=True)
         pol = drop
         for (s1, s2, ports) in switch_edges:
             p1 = ports[s1]
@@ -1437,8 +1491,11 @@ class Runtime(object):
         return pol
 
     def get_egress_policy(self):
+        return self.cached_topology_policy('egress', self.make_egress_policy)
+
+    def make_egress_policy(self, topology):
         pol = drop
-        for p in self.network.topology.egress_locations():
+        for p in topology.egress_locations():
             sw_no = p.switch
             port_no = p.port_no
             egress_match = match(switch=sw_no,outport=port_no)
@@ -1451,6 +1508,9 @@ class Runtime(object):
     def get_fwding_policy(self):
         return self.policy
 
+    def get_policy_version(self):
+        return self.policy_version
+
 ##########################
 # VIRTUAL HEADER SUPPORT 
 ##########################
@@ -1483,6 +1543,667 @@ def extended_values_from(packet):
     return util.frozendict(extended_values)
 
 
+################################################################################
+# Rule Cookies
+################################################################################
+
+class rule_cookie(object):
+    """
+    Rule cookies carry the classifier version that installed the rule in their
+    lower bits, and a tag for the rule's set of counting buckets in their
+    upper bits. Flow stats requested for a bucket can then be scoped to the
+    flows tagged with the bucket's tags. Rules without buckets have tag 0.
+    """
+    max_tag = (1 << (64 - COOKIE_TAG_SHIFT)) - 1
+
+    @classmethod
+    def make(cls, version, tag=0):
+        return (tag << COOKIE_TAG_SHIFT) | version
+
+    @classmethod
+    def tag(cls, cookie):
+        return cookie >> COOKIE_TAG_SHIFT
+
+    @classmethod
+    def version(cls, cookie):
+        return cookie & ((1 << COOKIE_TAG_SHIFT) - 1)
+
+
+################################################################################
+# Counting Bucket Registry
+################################################################################
+
+class CountBucketRegistry(object):
+    """
+    Registry of the classifier rules counted by buckets, so that buckets only
+    hold aggregated totals. Each such rule gets an integer rule id, reused once
+    the rule is removed, and its state is kept in arrays indexed by rule id.
+
+    Rules with the same set of buckets share a tag, which the runtime puts in
+    their rule cookies (see rule_cookie): the registry maps tags to their
+    buckets and rules, so that bucket membership is recorded once per set of
+    buckets rather than once per rule and bucket. A rule is known by (switch,
+    priority, cookie), which flow stats and flow removed messages carry as
+    is, and which no two installed rules share, as priorities are distinct
+    within a classifier version on a switch.
+    """
+    DELETED = 1 # rule is deleted, its counts are yet to be removed
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ids = {}  # (switch, priority, cookie) -> rule id
+        self.keys = [] # rule id -> (switch, priority, cookie), None if free
+        self.matches = [] # rule id -> match of the rule
+        self.rule_tags = array('L') # rule id -> tag of its set of buckets
+        self.flags = array('B')
+        self.free_ids = []
+        self.tags = {} # bucket ids of a set of buckets -> its tag
+        self.next_tag = 1
+        self.tag_buckets = {} # tag -> buckets
+        self.tag_rules = {} # tag -> rule ids
+        self.bucket_tags = {} # bucket id -> tags of sets including it
+        self.existing = {} # bucket id -> ids of rules installed before the
+                           # bucket was created, whose counts are yet to be read
+
+    def get_tag(self, buckets):
+        """ The tag of a set of buckets, allocating a fresh one for a set
+        without rules. """
+        buckets = dict((id(b), b) for b in buckets)
+        bucket_ids = frozenset(buckets.keys())
+        with self.lock:
+            tag = self.tags.get(bucket_ids)
+            if tag is None:
+                tag = self.next_tag
+                self.next_tag = (self.next_tag % rule_cookie.max_tag) + 1
+                self.tags[bucket_ids] = tag
+                self.tag_buckets[tag] = buckets.values()
+                self.tag_rules[tag] = set()
+                for bucket_id in bucket_ids:
+                    self.bucket_tags.setdefault(bucket_id, set()).add(tag)
+            return tag
+
+    def drop_tag(self, tag):
+        """ Forget a tag without rules. Must hold the lock. """
+        buckets = self.tag_buckets.pop(tag)
+        del self.tag_rules[tag]
+        bucket_ids = frozenset(map(id, buckets))
+        del self.tags[bucket_ids]
+        for bucket_id in bucket_ids:
+            tags = self.bucket_tags[bucket_id]
+            tags.discard(tag)
+            if not tags:
+                del self.bucket_tags[bucket_id]
+                self.existing.pop(bucket_id, None)
+
+    def collect_tags(self):
+        """ Forget the tags left without rules, e.g., allocated for rules
+        that an incremental update kept with their old cookies. """
+        with self.lock:
+            for (tag, rule_ids) in self.tag_rules.items():
+                if not rule_ids:
+                    self.drop_tag(tag)
+
+    @classmethod
+    def rule_key(cls, match, priority, cookie):
+        return (match.get('switch'), priority, cookie)
+
+    def add(self, match, priority, cookie, buckets, installed=False):
+        """Register a rule counted by buckets, or update the buckets of a
+        registered one. Returns the rule id.
+
+        :param match: the match of the rule, including the switch
+        :type match: dict
+        :param priority: the priority of the rule
+        :type priority: int
+        :param cookie: the cookie of the rule
+        :type cookie: int
+        :param buckets: the buckets counting the rule
+        :type buckets: list CountBucket
+        :param installed: whether the rule is already installed, in which case
+            the buckets that did not count it so far leave out its counts so
+            far
+        :type installed: bool
+        :rtype: int
+        """
+        tag = self.get_tag(buckets)
+        key = self.rule_key(match, priority, cookie)
+        with self.lock:
+            rule_id = self.ids.get(key)
+            counted_by = set() # ids of the buckets counting the rule so far
+            if rule_id is None:
+                if self.free_ids:
+                    rule_id = self.free_ids.pop()
+                    self.keys[rule_id] = key
+                    self.matches[rule_id] = match
+                    self.rule_tags[rule_id] = tag
+                    self.flags[rule_id] = 0
+                else:
+                    rule_id = len(self.keys)
+                    self.keys.append(key)
+                    self.matches.append(match)
+                    self.rule_tags.append(tag)
+                    self.flags.append(0)
+                self.ids[key] = rule_id
+            else:
+                old_tag = self.rule_tags[rule_id]
+                counted_by = set(map(id, self.tag_buckets[old_tag]))
+                self.rule_tags[rule_id] = tag
+                self.flags[rule_id] = 0
+                self.tag_rules[old_tag].discard(rule_id)
+                if not self.tag_rules[old_tag] and old_tag != tag:
+                    self.drop_tag(old_tag)
+            self.tag_rules[tag].add(rule_id)
+            bucket_ids = set(map(id, self.tag_buckets[tag]))
+            for bucket_id in counted_by - bucket_ids:
+                self.existing.get(bucket_id, set()).discard(rule_id)
+            if installed:
+                for bucket_id in bucket_ids - counted_by:
+                    self.existing.setdefault(bucket_id, set()).add(rule_id)
+            return rule_id
+
+    def delete(self, match, priority, cookie):
+        """ Mark a registered rule as deleted: its buckets count it until its
+        flow removed message comes in. """
+        with self.lock:
+            rule_id = self.ids.get(self.rule_key(match, priority, cookie))
+            if rule_id is not None:
+                self.flags[rule_id] |= self.DELETED
+
+    def remove(self, switch, priority, cookie):
+        """Unregister a rule on its flow removed message. Returns the buckets
+        to which the rule's final counts go, each along with whether the rule
+        was installed before the bucket was created and never read since.
+
+        :rtype: list (CountBucket * bool)
+        """
+        with self.lock:
+            rule_id = self.ids.pop((switch, priority, cookie), None)
+            if rule_id is None:
+                return []
+            tag = self.rule_tags[rule_id]
+            buckets = []
+            for bucket in self.tag_buckets[tag]:
+                existing = self.existing.get(id(bucket), ())
+                buckets.append((bucket, rule_id in existing))
+                if rule_id in existing:
+                    existing.discard(rule_id)
+            self.tag_rules[tag].discard(rule_id)
+            if not self.tag_rules[tag]:
+                self.drop_tag(tag)
+            self.keys[rule_id] = None
+            self.matches[rule_id] = None
+            self.free_ids.append(rule_id)
+            return buckets
+
+    def bucket_rule_ids(self, bucket):
+        """ The ids of the bucket's rules. Must hold the lock. """
+        for tag in self.bucket_tags.get(id(bucket), ()):
+            for rule_id in self.tag_rules[tag]:
+                yield rule_id
+
+    def bucket_matches(self, bucket, existing_only=False):
+        """ The matches of the bucket's rules, or only of those installed
+        before the bucket was created. """
+        with self.lock:
+            if existing_only:
+                rule_ids = self.existing.get(id(bucket), ())
+            else:
+                rule_ids = self.bucket_rule_ids(bucket)
+            return [self.matches[rule_id] for rule_id in rule_ids]
+
+    def switch_rules(self, bucket, switch):
+        """The bucket's rules on switch, as (match, cookie, settled) triples,
+        where a settled rule is neither deleted nor installed before the
+        bucket and never read since.
+
+        :rtype: list (dict * int * bool)
+        """
+        with self.lock:
+            existing = self.existing.get(id(bucket), ())
+            rules = []
+            for rule_id in self.bucket_rule_ids(bucket):
+                key = self.keys[rule_id]
+                if key[0] != switch:
+                    continue
+                settled = not (self.flags[rule_id] & self.DELETED or
+                               rule_id in existing)
+                rules.append((self.matches[rule_id], key[2], settled))
+            return rules
+
+    def __len__(self):
+        return len(self.ids)
+
+    def dispatch(self, switch, flow_stats, buckets):
+        """ Total the flow stats from switch by bucket, and hand the totals
+        to the waiting buckets.
+
+        :param switch: the switch that sent the stats reply
+        :type switch: int
+        :param flow_stats: the (converted) flow stats in the reply
+        :type flow_stats: list dict
+        :param buckets: buckets waiting for a reply from switch
+        :type buckets: list CountBucket
+        """
+        # Four counters per waiting bucket: the packets and bytes of its
+        # rules, and of its existing rules read for the first time.
+        slots = dict((id(b), 4 * i) for (i, b) in enumerate(buckets))
+        totals = array('L', [0]) * (4 * len(buckets))
+        read = dict((id(b), []) for b in buckets) # existing rules read
+        with self.lock:
+            for f in flow_stats:
+                rule_id = self.ids.get((switch, f['priority'], f['cookie']))
+                if rule_id is None:
+                    continue
+                for bucket in self.tag_buckets[self.rule_tags[rule_id]]:
+                    slot = slots.get(id(bucket))
+                    if slot is None:
+                        continue
+                    if rule_id in self.existing.get(id(bucket), ()):
+                        slot += 2
+                        read[id(bucket)].append(rule_id)
+                    totals[slot] += f['packet_count']
+                    totals[slot + 1] += f['byte_count']
+        for bucket in buckets:
+            slot = slots[id(bucket)]
+            if (bucket.handle_rule_stats(switch, *totals[slot:slot + 4]) and
+                read[id(bucket)]):
+                with self.lock:
+                    existing = self.existing.get(id(bucket), set())
+                    existing.difference_update(read[id(bucket)])
+
+
+################################################################################
+# Stats Scheduler
+################################################################################
+
+class StatsScheduler(object):
+    """
+    Issues at most one stats request per switch (and request match) per
+    polling epoch. A reply is kept as a snapshot for the rest of its epoch, and
+    all buckets pulling the same stats meanwhile are fed from the snapshot.
+
+    Requests are either full flow stats of a switch, keyed ('flow', switch),
+    aggregate stats of the flows selected by a match, keyed ('aggregate',
+    switch, match), or flow stats scoped to the flows selected by a match and
+    carrying some rule cookie tags, keyed ('scoped', switch, match, tags).
+
+    :param request_flow_stats: sends a flow stats request to a switch
+    :type request_flow_stats: int -> unit
+    :param request_aggregate_stats: sends an aggregate stats request for a
+        match to a switch, tagged with a request id for the reply
+    :type request_aggregate_stats: int -> dict -> int -> unit
+    :param request_scoped_flow_stats: sends a flow stats request for a match
+        and cookie tags to a switch, tagged with a request id for the reply
+    :type request_scoped_flow_stats: int -> dict -> frozenset int -> int -> unit
+    :param epoch: how long (seconds) a snapshot stays fresh
+    :type epoch: float
+    :param requery: how long (seconds) to wait for a reply before re-sending
+    :type requery: float
+    """
+    def __init__(self, request_flow_stats, request_aggregate_stats,
+                 request_scoped_flow_stats=None, epoch=STATS_EPOCH_SEC,
+                 requery=STATS_REQUERY_THRESHOLD_SEC, clock=time.time):
+        self.log = logging.getLogger('%s.StatsScheduler' % __name__)
+        self.request_flow_stats = request_flow_stats
+        self.request_aggregate_stats = request_aggregate_stats
+        self.request_scoped_flow_stats = request_scoped_flow_stats
+        self.epoch = epoch
+        self.requery = requery
+        self.clock = clock
+        self.lock = Lock()
+        self.snapshots = {}   # key -> (time received, stats)
+        self.outstanding = {} # key -> (time sent, [waiting buckets])
+        self.requests = {} # request id -> key, for tagged requests
+        self.batch_depth = 0
+        self.batched = OrderedDict() # key -> request args, held back
+        self.requests_sent = 0
+
+    @classmethod
+    def flow_key(cls, switch):
+        return ('flow', switch)
+
+    @classmethod
+    def aggregate_key(cls, switch, m):
+        return ('aggregate', switch, util.frozendict(m))
+
+    @classmethod
+    def scoped_key(cls, switch, m, tags):
+        return ('scoped', switch, util.frozendict(m), frozenset(tags))
+
+    @classmethod
+    def common_match(cls, matches):
+        """ The fields on which all matches agree. """
+        common = dict(matches[0])
+        for m in matches[1:]:
+            for (k, v) in common.items():
+                if m.get(k) != v:
+                    del common[k]
+        return common
+
+    @classmethod
+    def aggregate_match(cls, rules, flows):
+        """If a bucket's rules on a switch are exactly the flows (given by
+        their matches, which carry the switch) on it that some match selects,
+        return that match, so that the bucket can be served with aggregate
+        stats. Otherwise, return None.
+
+        :param rules: the bucket's rules on the switch, as (match, cookie,
+            settled) triples (see CountBucketRegistry.switch_rules)
+        :type rules: list (dict * int * bool)
+        :param flows: the matches of the flows on the switch
+        :type flows: list dict
+        """
+        if not rules or not flows:
+            return None
+        for (_, _, settled) in rules:
+            if not settled:
+                return None
+        common = cls.common_match([m for (m, _, _) in rules])
+        def selects(flow):
+            for (k, v) in common.items():
+                if not k in flow:
+                    return False
+                if k in ['srcip', 'dstip']:
+                    try:
+                        if not (IPv4Network(str(flow[k])) in
+                                IPv4Network(str(v))):
+                            return False
+                    except ValueError:
+                        return False
+                elif flow[k] != v:
+                    return False
+            return True
+        if len(filter(selects, flows)) == len(rules):
+            return common
+        return None
+
+    @classmethod
+    def stats_scope(cls, rules, flows):
+        """If a bucket's rules cover only a few of the flows on a switch,
+        return the (match, cookie tags) selecting a superset of them: the
+        fields on which the rules agree, and the tags in their cookies. Flow
+        stats of the switch can then be requested for just that scope.
+        Otherwise, return None. Arguments are as for aggregate_match.
+        """
+        if (not rules or not flows or
+            len(rules) > STATS_SCOPE_MAX_FRACTION * len(flows)):
+            return None
+        common = cls.common_match([m for (m, _, _) in rules])
+        tags = frozenset([rule_cookie.tag(cookie) for (_, cookie, _) in rules])
+        return (common, tags)
+
+    def get_snapshot(self, key, now):
+        """ The stats for key, if received during the current epoch. """
+        (t, stats) = self.snapshots.get(key, (None, None))
+        if t is not None and now - t < self.epoch:
+            return stats
+        return None
+
+    def pull(self, switch, bucket, aggregate_match=None, scope=None):
+        """ Get stats from switch for bucket. Returns (key, stats) if a
+        snapshot of this epoch can feed the bucket right away; otherwise the
+        bucket waits for the reply to an outstanding request, sending one if
+        there is none, and None is returned.
+
+        Full flow stats are used whenever they are at hand or on their way,
+        since they serve every bucket; otherwise the aggregate stats of
+        aggregate_match, if given, or else the flow stats of scope, a (match,
+        cookie tags) pair, if given.
+        """
+        now = self.clock()
+        flow_key = self.flow_key(switch)
+        with self.lock:
+            stats = self.get_snapshot(flow_key, now)
+            if stats is not None:
+                return (flow_key, stats)
+            key = flow_key
+            if not flow_key in self.outstanding:
+                if aggregate_match is not None:
+                    key = self.aggregate_key(switch, aggregate_match)
+                elif (scope is not None and
+                      self.request_scoped_flow_stats is not None):
+                    key = self.scoped_key(switch, scope[0], scope[1])
+                stats = self.get_snapshot(key, now)
+                if stats is not None:
+                    return (key, stats)
+            (t, buckets) = self.outstanding.get(key, (None, []))
+            if not bucket in buckets:
+                buckets.append(bucket)
+            send = t is None or now - t > self.requery
+            if send:
+                t = now
+                self.requests_sent += 1
+                request_id = self.requests_sent
+                if key != flow_key:
+                    self.requests[request_id] = key
+                if self.batch_depth > 0:
+                    self.batched[key] = (request_id, aggregate_match, scope)
+                    send = False
+            self.outstanding[key] = (t, buckets)
+        if send:
+            self.send_request(key, request_id, aggregate_match, scope)
+        return None
+
+    def send_request(self, key, request_id, aggregate_match, scope):
+        switch = key[1]
+        if key[0] == 'flow':
+            self.request_flow_stats(switch)
+        elif key[0] == 'aggregate':
+            self.request_aggregate_stats(switch, aggregate_match, request_id)
+        else:
+            self.request_scoped_flow_stats(switch, scope[0], scope[1],
+                                           request_id)
+        self.log.debug('sent stats request %s' % str(key))
+
+    def start_batch(self):
+        """ Hold back the requests of the following pulls until
+        finish_batch(), e.g., while the periodic queries of a polling epoch
+        pull their stats. """
+        with self.lock:
+            self.batch_depth += 1
+
+    def finish_batch(self):
+        """ Send the requests held back since start_batch(). A switch that
+        got several of them is sent a single full flow stats request instead,
+        serving all the buckets waiting on it. """
+        with self.lock:
+            self.batch_depth -= 1
+            if self.batch_depth > 0:
+                return
+            by_switch = OrderedDict()
+            for (key, args) in self.batched.items():
+                by_switch.setdefault(key[1], []).append((key, args))
+            self.batched = OrderedDict()
+            to_send = []
+            for (switch, requests) in by_switch.items():
+                flow_key = self.flow_key(switch)
+                if len(requests) < STATS_BATCH_MERGE_REQUESTS:
+                    to_send += requests
+                    continue
+                (t, buckets) = self.outstanding.get(flow_key, (None, []))
+                # unless already on its way, the full request is sent now
+                send_flow = t is None
+                for (key, (request_id, _, _)) in requests:
+                    if key == flow_key:
+                        send_flow = True
+                        continue
+                    self.requests.pop(request_id, None)
+                    (t_key, waiting) = self.outstanding.pop(key)
+                    t = t_key if t is None else t
+                    for bucket in waiting:
+                        if not bucket in buckets:
+                            buckets.append(bucket)
+                self.outstanding[flow_key] = (t, buckets)
+                if send_flow:
+                    to_send.append((flow_key, (None, None, None)))
+        for (key, (request_id, aggregate_match, scope)) in to_send:
+            self.send_request(key, request_id, aggregate_match, scope)
+
+    def handle_reply(self, key, stats):
+        """ Record the reply for key as its snapshot, and return the buckets
+        that were waiting for it. """
+        with self.lock:
+            self.snapshots[key] = (self.clock(), stats)
+            (_, buckets) = self.outstanding.pop(key, (None, []))
+        return buckets
+
+    def handle_request_reply(self, request_id, stats):
+        """ handle_reply for the aggregate or scoped stats request with
+        request_id. Returns the request key and the waiting buckets. """
+        with self.lock:
+            key = self.requests.pop(request_id, None)
+        if key is None:
+            return (None, [])
+        return (key, self.handle_reply(key, stats))
+
+    def invalidate(self, switch=None):
+        """ Drop the snapshots (of a switch, or of all switches), e.g., when
+        the rules they count change. """
+        with self.lock:
+            if switch is None:
+                self.snapshots = {}
+            else:
+                for key in self.snapshots.keys():
+                    if key[1] == switch:
+                        del self.snapshots[key]
+
+
+################################################################################
+# Query Polling
+################################################################################
+
+class PollingService(object):
+    """
+    A single timer for all periodic queries, e.g., pulling the stats of counts
+    queries. Polls of the same period are aligned to multiples of the period,
+    so that they all run in the same tick, as one batch. The runtime hooks its
+    stats scheduler into batches, to coalesce the stats requests to a switch.
+
+    Batches run on a worker thread of the service, so that polls blocking
+    (e.g., on a bucket being updated) hold up neither the timer wheel nor its
+    other users. A batch falling due while the previous one of its period is
+    still pending is skipped.
+
+    :param timer: the timer wheel to run polls off, if not the shared one
+    :type timer: util.TimerWheel
+    :param start: whether to run batches on a worker thread (otherwise, they
+        run right in the timer callback)
+    :type start: bool
+    :param start_worker: function starting the worker, given its loop, if not
+        on a daemon thread (e.g., to run batches with run_batch instead)
+    :type start_worker: function
+    """
+    shared = None
+    shared_lock = Lock()
+
+    def __init__(self, timer=None, start=True, start_worker=None):
+        self.log = logging.getLogger('%s.PollingService' % __name__)
+        if timer is None:
+            timer = util.TimerWheel.get_shared()
+        self.timer = timer
+        self.lock = Lock()
+        self.groups = {} # period -> (timer, poll id -> poll)
+        self.polls_registered = 0
+        self.batch_hooks = None
+        self.start = start
+        self.pending = OrderedDict() # periods of the batches due, in order
+        self.pending_cv = threading.Condition()
+        self.worker_started = False
+        if start_worker is None:
+            start_worker = self.start_worker_thread
+        self.start_worker = start_worker
+
+    @classmethod
+    def get_shared(cls):
+        """ The service shared by all queries that don't bring their own. """
+        with cls.shared_lock:
+            if cls.shared is None:
+                cls.shared = cls()
+            return cls.shared
+
+    def set_batch_hooks(self, start_batch, finish_batch):
+        """ Functions to call before and after each batch of polls. """
+        self.batch_hooks = (start_batch, finish_batch)
+
+    def register(self, period, poll):
+        """ Call poll every period seconds, at multiples of the period.
+        Returns a handle with which to unregister. """
+        with self.lock:
+            if not period in self.groups:
+                delay = period - (self.timer.clock() % period)
+                t = self.timer.schedule(delay,
+                                        lambda: self.queue_polls(period),
+                                        period)
+                self.groups[period] = (t, OrderedDict())
+            self.polls_registered += 1
+            poll_id = self.polls_registered
+            self.groups[period][1][poll_id] = poll
+        return (period, poll_id)
+
+    def unregister(self, handle):
+        (period, poll_id) = handle
+        with self.lock:
+            (t, polls) = self.groups.get(period, (None, {}))
+            polls.pop(poll_id, None)
+            if t is not None and not polls:
+                self.timer.cancel(t)
+                del self.groups[period]
+
+    def queue_polls(self, period):
+        """ Hand the batch of polls of a period to the worker thread. """
+        if not self.start:
+            self.run_polls(period)
+            return
+        with self.pending_cv:
+            if period in self.pending:
+                self.log.debug('skipping polls every %s s: the previous batch '
+                               'is still pending' % str(period))
+                return
+            self.pending[period] = True
+            if not self.worker_started:
+                self.worker_started = True
+                self.start_worker(self.run_worker)
+            self.pending_cv.notify()
+
+    @staticmethod
+    def start_worker_thread(run):
+        worker = threading.Thread(target=run)
+        worker.daemon = True
+        worker.start()
+
+    def run_worker(self):
+        while True:
+            self.run_batch()
+
+    def run_batch(self):
+        """ Run the first pending batch, waiting for one if there is none. """
+        with self.pending_cv:
+            while not self.pending:
+                self.pending_cv.wait()
+            period = next(iter(self.pending))
+        try:
+            self.run_polls(period)
+        finally:
+            with self.pending_cv:
+                del self.pending[period]
+
+    def run_polls(self, period):
+        with self.lock:
+            polls = self.groups.get(period, (None, {}))[1].values()
+        hooks = self.batch_hooks
+        if hooks:
+            hooks[0]()
+        try:
+            for poll in polls:
+                try:
+                    poll()
+                except Exception, e:
+                    self.log.exception('poll failed: %s' % str(e))
+        finally:
+            if hooks:
+                hooks[1]()
+
+
 ################################################################################
 # Concrete Network
 ################################################################################
@@ -1490,13 +2211,31 @@ def extended_values_from(packet):
 import threading 
 
 class ConcreteNetwork(Network):
-    def __init__(self,runtime=None):
+    """
+    The network as seen through the OpenFlow backend.  Switch, port and link
+    events are applied to next_topo right away; a single debouncer thread
+    then coalesces bursts of them into one topology update.
+
+    :param wait_period: quiet time (s) after the last event before applying
+    :type wait_period: float
+    :param max_wait_period: longest time (s) an event may stay unapplied
+    :type max_wait_period: float
+    """
+    def __init__(self,runtime=None,wait_period=0.25,max_wait_period=2.0):
         super(ConcreteNetwork,self).__init__()
         self.next_topo = self.topology.copy()
         self.runtime = runtime
-        self.wait_period = 0.25
-        self.update_no_lock = threading.Lock()
-        self.update_no = 0
+        self.wait_period = wait_period
+        self.max_wait_period = max_wait_period
+        self.update_cv = threading.Condition()
+        self.debouncer = None
+        self.pending_events = 0
+        self.first_event_time = None
+        self.last_event_time = None
+        self.events_queued = 0
+        self.updates_applied = 0
+        self.last_events_absorbed = 0
+        self.max_events_absorbed = 0
         self.log = logging.getLogger('%s.ConcreteNetwork' % __name__)
         self.debug_log = logging.getLogger('%s.DEBUG_TOPO_DISCOVERY' % __name__)
         self.debug_log.setLevel(logging.DEBUG)
@@ -1509,24 +2248,72 @@ class ConcreteNetwork(Network):
     # Topology Detection
     #
 
-    def queue_update(self,this_update_no):
-        def f(this_update_no):
-            time.sleep(self.wait_period)
-            with self.update_no_lock:
-                if this_update_no != self.update_no:
-                    return
+    def queue_update(self):
+        """
+        Record that next_topo changed.  The debouncer applies it once no new
+        event arrived for wait_period seconds, or once the oldest pending
+        event has waited max_wait_period seconds.
+        """
+        with self.update_cv:
+            now = time.time()
+            if self.pending_events == 0:
+                self.first_event_time = now
+            self.last_event_time = now
+            self.pending_events += 1
+            self.events_queued += 1
+            if self.debouncer is None:
+                self.debouncer = threading.Thread(target=self.debounce_updates)
+                self.debouncer.daemon = True
+                self.debouncer.start()
+            self.update_cv.notify()
+
+    def debounce_updates(self):
+        while True:
+            with self.update_cv:
+                while True:
+                    if self.pending_events == 0:
+                        self.update_cv.wait()
+                        continue
+                    now = time.time()
+                    deadline = min(self.last_event_time + self.wait_period,
+                                   self.first_event_time + self.max_wait_period)
+                    if now >= deadline:
+                        break
+                    self.update_cv.wait(deadline - now)
+                absorbed = self.pending_events
+                self.pending_events = 0
+                self.topology = self.next_topo.snapshot()
+                self.updates_applied += 1
+                self.last_events_absorbed = absorbed
+                self.max_events_absorbed = max(self.max_events_absorbed,
+                                               absorbed)
+            self.log.debug("applying topology update (%d events absorbed)"
+                           % absorbed)
+            try:
+                self.runtime.handle_network_change()
+            except Exception:
+                # the debouncer is the only thread applying updates, so it
+                # must outlive a failed one
+                self.log.exception("error applying topology update")
 
-            self.topology = self.next_topo.copy()
-            self.runtime.handle_network_change()
+    def get_update_stats(self):
+        """
+        Counters describing how well topology events are being coalesced.
 
-        p = threading.Thread(target=f,args=(this_update_no,))
-        p.start()
+        :rtype: dict from strings to numbers
+        """
+        with self.update_cv:
+            if self.updates_applied:
+                mean = float(self.events_queued - self.pending_events) / self.updates_applied
+            else:
+                mean = 0.0
+            return { 'events_queued' : self.events_queued,
+                     'updates_applied' : self.updates_applied,
+                     'pending_events' : self.pending_events,
+                     'last_events_absorbed' : self.last_events_absorbed,
+                     'max_events_absorbed' : self.max_events_absorbed,
+                     'mean_events_absorbed' : mean }
 
-    def get_update_no(self):
-        with self.update_no_lock:
-            self.update_no += 1
-            return self.update_no
-           
     def inject_discovery_packet(self, dpid, port_no):
         self.runtime.inject_discovery_packet(dpid, port_no)
         
@@ -1547,11 +2334,14 @@ class ConcreteNetwork(Network):
                 pass  # ALREADY REMOVED
             # UNLINK LINKED_TO PORT
             try:      
-                self.next_topo.node[port.linked_to.switch]["ports"][port.linked_to.port_no].linked_to = None
+                self.next_topo.update_port(port.linked_to.switch,
+                                           port.linked_to.port_no,
+                                           linked_to=None)
             except KeyError:
                 pass  # LINKED TO PORT ALREADY DELETED
             # UNLINK SELF
-            self.next_topo.node[location.switch]["ports"][location.port_no].linked_to = None
+            self.next_topo.update_port(location.switch,location.port_no,
+                                       linked_to=None)
         
     def handle_switch_part(self, switch):
         self.log.info("OpenFlow switch %s disconnected" % switch)
@@ -1561,24 +2351,23 @@ class ConcreteNetwork(Network):
             self.remove_associated_link(Location(switch,port_no))
         self.next_topo.remove_node(switch)
         self.debug_log.debug(str(self.next_topo))
-        self.queue_update(self.get_update_no())
+        self.queue_update()
         
     def handle_port_join(self, switch, port_no, config, status, port_type):
         self.debug_log.debug("handle_port_joins %s:%s:%s:%s" % (switch, port_no, config, status))
-        this_update_no = self.get_update_no()
         self.next_topo.add_port(switch,port_no,config,status,port_type)
         if config or status:
             self.inject_discovery_packet(switch,port_no)
             self.debug_log.debug(str(self.next_topo))
-            self.queue_update(this_update_no)
+            self.queue_update()
             
     def handle_port_part(self, switch, port_no):
         self.debug_log.debug("handle_port_parts")
         try:
             self.remove_associated_link(Location(switch,port_no))
-            del self.next_topo.node[switch]["ports"][port_no]
+            self.next_topo.remove_port(switch,port_no)
             self.debug_log.debug(str(self.next_topo))
-            self.queue_update(self.get_update_no())
+            self.queue_update()
         except KeyError:
             pass  # THE SWITCH HAS ALREADY BEEN REMOVED BY handle_switch_parts
         
@@ -1595,10 +2384,8 @@ class ConcreteNetwork(Network):
             return
 
         # UPDATE VALUES
-        self.next_topo.node[switch]["ports"][port_no].config = config
-        self.next_topo.node[switch]["ports"][port_no].status = status
-        self.next_topo.node[switch]["ports"][port_no].port_type = port_type
-        
+        self.next_topo.update_port(switch,port_no,config=config,
+                                   status=status,port_type=port_type)
 
         # DETERMINE IF/WHAT CHANGED
         if (prev_config and not config):
@@ -1610,18 +2397,17 @@ class ConcreteNetwork(Network):
             self.port_up(switch, port_no)
 
     def port_up(self, switch, port_no):
-        this_update_no = self.get_update_no()
         self.debug_log.debug("port_up %s:%s" % (switch,port_no))
         self.inject_discovery_packet(switch,port_no)
         self.debug_log.debug(str(self.next_topo))
-        self.queue_update(this_update_no)
+        self.queue_update()
 
     def port_down(self, switch, port_no, double_check=False):
         self.debug_log.debug("port_down %s:%s:double_check=%s" % (switch,port_no,double_check))
         try:
             self.remove_associated_link(Location(switch,port_no))
             self.debug_log.debug(str(self.next_topo))
-            self.queue_update(self.get_update_no())
+            self.queue_update()
             if double_check: self.inject_discovery_packet(switch,port_no)
         except KeyError:  
             pass  # THE SWITCH HAS ALREADY BEEN REMOVED BY handle_switch_parts
@@ -1660,8 +2446,8 @@ class ConcreteNetwork(Network):
         
         # ADD LINK IF PORTS ARE UP
         if p1.possibly_up() and p2.possibly_up():
-            self.next_topo.node[s1]["ports"][p_no1].linked_to = Location(s2,p_no2)
-            self.next_topo.node[s2]["ports"][p_no2].linked_to = Location(s1,p_no1)   
+            self.next_topo.update_port(s1,p_no1,linked_to=Location(s2,p_no2))
+            self.next_topo.update_port(s2,p_no2,linked_to=Location(s1,p_no1))
             pt1 = self.next_topo.node[s1]["ports"][p_no1].port_type 
             pt2 = self.next_topo.node[s2]["ports"][p_no2].port_type 
             if pt1 != pt2:
@@ -1672,19 +2458,125 @@ class ConcreteNetwork(Network):
             
         # IF REACHED, WE'VE REMOVED AN EDGE, OR ADDED ONE, OR BOTH
         self.debug_log.debug(self.next_topo)
-        self.queue_update(self.get_update_no())
+        self.queue_update()
 
 ################################################################################
 # Virtual Fields
 ################################################################################
+class tag_encoding:
+    """
+    Layout of the number that packs the values of all virtual fields
+    (see virtual_field.compress) onto spare packet header space.
+
+    An encoding is a list of (header, radix) slots, and the number is written
+    into them as mixed-radix digits, least significant digit first. Encodings
+    are listed from the fewest header bits to the most; the first one that can
+    hold every combination of virtual field values is used, so that tagging
+    rules match and rewrite as few headers as possible.
+
+    Only the VLAN header is spare on the OpenFlow 1.0 switches we target;
+    other header spaces can be made available by adding encodings here.
+    """
+    log = logging.getLogger('%s.tag_encoding' % __name__)
+    # vlan id 0xfff is reserved by 802.1Q
+    encodings = [[('vlan_id', 4095)],
+                 [('vlan_id', 4095), ('vlan_pcp', 8)]]
+    current = encodings[0]
+    # bumped whenever the encoding changes, since rules built under the old
+    # encoding no longer match the right packets.
+    version = 0
+
+    @classmethod
+    def capacity(cls, encoding):
+        """ Number of distinct values an encoding can hold. """
+        return reduce(lambda acc, (h, radix): acc * radix, encoding, 1)
+
+    @classmethod
+    def max_values(cls):
+        return max(map(cls.capacity, cls.encodings))
+
+    @classmethod
+    def select(cls, num_values):
+        """ Switch to the densest encoding holding `num_values` values.
+
+        :param num_values: number of distinct values to encode
+        :type num_values: int
+        :rtype: list (string * int)
+        """
+        for encoding in cls.encodings:
+            if cls.capacity(encoding) >= num_values:
+                if encoding != cls.current:
+                    cls.log.info("virtual fields now encoded in %s" %
+                                 ', '.join([h for (h, _) in encoding]))
+                    cls.current = encoding
+                    cls.version += 1
+                return encoding
+        raise RuntimeError('Virtual fields need %d values, but at most %d '
+                           'fit in the available headers' %
+                           (num_values, cls.max_values()))
+
+    @classmethod
+    def headers(cls):
+        return [h for (h, _) in cls.current]
+
+    @classmethod
+    def encode(cls, num):
+        """ Header assignments for the number `num` (or no assignments if
+        `num` is -1, i.e., there are no virtual fields to encode). """
+        if num == -1: return {}
+        fields = {}
+        for (header, radix) in cls.current:
+            fields[header] = num % radix
+            num = num / radix
+        return fields
+
+    @classmethod
+    def decode(cls, fields):
+        """ The number held by the headers in `fields`. """
+        num, scale = 0, 1
+        for (header, radix) in cls.current:
+            num += (fields.get(header) or 0) * scale
+            scale *= radix
+        return num
+
 class virtual_field:
-    def __init__(self, name, values, type="string"):
+    """
+    A header field that switches don't have, packed along with the other
+    virtual fields into a single number (see compress) and carried in spare
+    header space (see tag_encoding).
+
+    Fields are the digits of that number, the first declared being the least
+    significant, so a field keeps its numbers as long as no field declared
+    before it changes. Fields declared `most_significant` (e.g., the path tag,
+    which grows with the path DFA) always come after the others. Any change to
+    the fields or their cardinalities bumps `virtual_field.layout`, since
+    rules built under the old layout no longer match the right packets.
+    """
+    def __init__(self, name, values, type="string", most_significant=False):
         self.name   = name
         self.values = values
         # We need a None value as well
         self.cardinality = len(values) + 1
         self.type   = type
-        virtual_field.fields[name] = self
+        self.most_significant = most_significant
+        fields = virtual_field.fields
+        num_values = self.cardinality
+        for (n, vf) in fields.iteritems():
+            if n != name:
+                num_values *= vf.cardinality
+        tag_encoding.select(num_values)
+        old_layout = virtual_field.get_layout()
+        fields[name] = self
+        for n in [n for (n, vf) in fields.items() if vf.most_significant]:
+            fields[n] = fields.pop(n)
+        if virtual_field.get_layout() != old_layout:
+            virtual_field.layout += 1
+
+    @classmethod
+    def get_layout(cls):
+        """ The digits of the virtual field number, as (name, cardinality)
+        pairs from the least significant. """
+        return [(n, vf.cardinality) for (n, vf) in cls.fields.iteritems()]
 
     def index(self,key):
         try:
@@ -1695,12 +2587,9 @@ class virtual_field:
             raise e
 
     def value(self,index):
-        try:
-            return self.values[index-1]
-        except ValueError as e:
-            if index == 0:
-                return None
-            raise e
+        if index == 0:
+            return None
+        return self.values[index-1]
 
     @classmethod
     def compress(cls,fields):
@@ -1717,11 +2606,12 @@ class virtual_field:
             for n in vf_names:
                 if n not in vheaders:
                     vheaders[n] = None
-            ret,temp = 0,1
+            # Fields declared first are the least significant digits (see
+            # virtual_field).
+            ret,scale = 0,1
             for n,vf in virtual_fields.iteritems():
-                ret *= temp
-                ret += vf.index(vheaders[n])
-                temp = vf.cardinality
+                ret += vf.index(vheaders[n]) * scale
+                scale *= vf.cardinality
 
             return ret
         return vhs_to_num(fields)
@@ -1732,16 +2622,12 @@ class virtual_field:
             return {}
 
         virtual_fields = virtual_field.fields
-        vf_names       = virtual_fields.keys()
-        num = fields['vlan_pcp'] << 12 + fields['vlan_id']
+        num = tag_encoding.decode(fields)
 
         def num_to_vhs(num):
-            # If we there are no virtual_fields specified we wouldn't want to match on them at all
-            # Just return -1 so that calling function knows that the predicate doesn't have any virtual
-            # fields on it
             vfs = {}
             tmp = num
-            for n,vf in reversed(virtual_fields.items()):
+            for n,vf in virtual_fields.iteritems():
                 val    = tmp % vf.cardinality
                 tmp    = tmp / vf.cardinality
                 vfs[n] = vf.value(val)
@@ -1751,10 +2637,7 @@ class virtual_field:
 
     @classmethod
     def map_to_vlan(cls,num):
-        if num == -1: return {}
-        return {
-           "vlan_id" : 0b000111111111111 & num,
-           "vlan_pcp": 0b111000000000000 & num
-        }
+        return tag_encoding.encode(num)
 
-virtual_field.fields = {}
+virtual_field.fields = OrderedDict()
+virtual_field.layout = 0
@@ -35,7 +35,11 @@ from functools import wraps
 
 from multiprocessing import Lock
 from logging import StreamHandler
+import logging
+import math
 import sys
+import threading
+import time
 from ipaddr import IPv4Network, AddressValueError, IPv4Address
 
 
@@ -190,3 +194,106 @@ def network_to_string(ip_net):
         return str(ip_net.network) + '/' + str(ip_net.prefixlen)
     else:
         return str(ip_net.ip)
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel. Timers are kept in a ring of slots by the tick (of
+    `tick` seconds) at which they expire, and a single daemon thread advances
+    the wheel tick by tick, running the timers that are due. Periodic timers
+    are re-armed from their previous expiry, so that they don't drift.
+
+    :param tick: granularity of the wheel, in seconds
+    :type tick: float
+    :param num_slots: number of slots in the ring
+    :type num_slots: int
+    :param start: whether to run the wheel on its own thread (otherwise,
+        advance() has to be called)
+    :type start: bool
+    """
+    shared = None
+    shared_lock = threading.Lock()
+
+    class timer(object):
+        def __init__(self, expiry, fn, period):
+            self.expiry = expiry # tick
+            self.fn = fn
+            self.period = period # ticks, or None
+            self.cancelled = False
+
+    def __init__(self, tick=0.05, num_slots=256, clock=time.time, start=True):
+        self.log = logging.getLogger('%s.TimerWheel' % __name__)
+        self.tick = tick
+        self.slots = [[] for i in range(num_slots)]
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.current = self.tick_of(clock()) # last tick advanced to
+        self.start = start
+        self.thread = None
+
+    @classmethod
+    def get_shared(cls):
+        """ The wheel shared by all users that don't bring their own. """
+        with cls.shared_lock:
+            if cls.shared is None:
+                cls.shared = cls()
+            return cls.shared
+
+    def tick_of(self, t):
+        # allow for rounding, e.g., 0.3 / 0.1 < 3
+        return int(math.floor(t / self.tick + 1e-6))
+
+    def to_ticks(self, seconds):
+        return max(1, int(round(seconds / self.tick)))
+
+    def schedule(self, delay, fn, period=None):
+        """ Call fn after delay seconds, and then every period seconds if a
+        period is given. Returns a timer that can be cancelled. """
+        with self.lock:
+            expiry = max(self.tick_of(self.clock() + delay), self.current + 1)
+            if period is not None:
+                period = self.to_ticks(period)
+            t = self.timer(expiry, fn, period)
+            self.slots[expiry % len(self.slots)].append(t)
+            if self.start and self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        return t
+
+    def cancel(self, t):
+        t.cancelled = True
+
+    def advance(self, now=None):
+        """ Run the timers due by now, visiting each slot at most once. """
+        if now is None:
+            now = self.clock()
+        due = []
+        with self.lock:
+            target = self.tick_of(now)
+            for tick in range(self.current + 1,
+                              min(target, self.current + len(self.slots)) + 1):
+                slot = self.slots[tick % len(self.slots)]
+                if slot:
+                    due += [t for t in slot if t.expiry <= target]
+                    slot[:] = [t for t in slot
+                               if t.expiry > target and not t.cancelled]
+            self.current = max(self.current, target)
+        due.sort(key=lambda t: t.expiry)
+        for t in due:
+            if t.cancelled:
+                continue
+            try:
+                t.fn()
+            except Exception, e:
+                self.log.exception('timer callback failed: %s' % str(e))
+            if t.period is not None:
+                with self.lock:
+                    while t.expiry <= self.current:
+                        t.expiry += t.period
+                    self.slots[t.expiry % len(self.slots)].append(t)
+
+    def run(self):
+        while True:
+            time.sleep(max(0.0, (self.current + 1) * self.tick - self.clock()))
+            self.advance()
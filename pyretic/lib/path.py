@@ -28,16 +28,20 @@
 
 from pyretic.core.language import identity, egress_network, Filter, drop, match
 from pyretic.core.language import modify, Query, FwdBucket, CountBucket
-from pyretic.core.language import PathBucket, DynamicFilter
+from pyretic.core.language import PathBucket, DynamicFilter, parallel
 from pyretic.core.language_tools import ast_fold as policy_ast_fold
 from pyretic.core.language_tools import add_dynamic_sub_pols
 
 from pyretic.lib.query import counts, packets
-from pyretic.core.runtime import virtual_field
+from pyretic.core.runtime import virtual_field, tag_encoding, NUM_PATH_TAGS
 
 from pyretic.lib.re import *
+from pyretic.lib.predicate_dd import dd_from_pred, dd_overlap_mode, DD_FALSE
 
+import itertools
+import logging
 import subprocess
+import time
 import pyretic.vendor
 import pydot
 import copy
@@ -153,7 +157,10 @@ class re_tree_gen(object):
     pred_to_symbol = {}
     pred_to_atoms  = {}
     symbol_to_pred = {}
+    symbol_to_atoms = {}
+    symbol_to_dd   = {}
     dyn_preds      = []
+    generation     = 0
 
     @classmethod
     def repr_state(cls):
@@ -170,13 +177,16 @@ class re_tree_gen(object):
         return output
 
     @classmethod
-    def __add_pred__(cls, pred, symbol, atoms):
-        """ Add a new predicate to the global state. """
+    def __add_pred__(cls, pred, symbol, atoms, pred_dd):
+        """ Add a new predicate to the global state, along with the decision
+        diagram `pred_dd` of the packets it matches. """
         assert not pred in cls.pred_to_symbol
         assert not pred in cls.pred_to_atoms
         cls.pred_to_symbol[pred] = symbol
         cls.pred_to_atoms[pred] = atoms
         cls.symbol_to_pred[symbol] = pred
+        cls.symbol_to_atoms[symbol] = atoms
+        cls.symbol_to_dd[symbol] = pred_dd
 
     @classmethod
     def __add_dyn_preds__(cls, preds, atom):
@@ -186,11 +196,13 @@ class re_tree_gen(object):
             cls.dyn_preds.append((pred, atom))
 
     @classmethod
-    def __del_pred__(cls, pred):
-        """ Remove a predicate from existing global state of leaf-level
-        predicates. """
-        sym = cls.pred_to_symbol[pred]
+    def __del_pred__(cls, sym):
+        """ Remove the predicate with symbol `sym` from existing global state of
+        leaf-level predicates. """
+        pred = cls.symbol_to_pred[sym]
         del cls.symbol_to_pred[sym]
+        del cls.symbol_to_atoms[sym]
+        del cls.symbol_to_dd[sym]
         del cls.pred_to_symbol[pred]
         del cls.pred_to_atoms[pred]
 
@@ -204,10 +216,10 @@ class re_tree_gen(object):
             return unichr(cls.token)
 
     @classmethod
-    def __replace_pred__(cls, old_pred, new_preds):
-        """ Replace the re symbol corresponding to `old_pred` with an
-        alternation of predicates in `new_preds`. The metadata from the
-        old_pred's re symbol is copied over to all leaf nodes of its new re AST.
+    def __replace_pred__(cls, old_sym, new_syms):
+        """ Replace the re symbol `old_sym` of a predicate with an alternation of
+        the symbols `new_syms` of other predicates. The metadata from the
+        old re symbol is copied over to all leaf nodes of its new re AST.
         """
         def new_metadata_tree(m, re_tree):
             """ Return a new tree which has a given metadata m on all nodes in
@@ -241,17 +253,14 @@ class re_tree_gen(object):
             else:
                 raise TypeError("Trees are only allowed to have alternation!")
 
-        assert old_pred in cls.pred_to_symbol and old_pred in cls.pred_to_atoms
-        old_sym = cls.pred_to_symbol[old_pred]
+        assert old_sym in cls.symbol_to_atoms
         new_re_tree = re_empty()
         # Construct replacement tree (without metadata first)
-        for pred in new_preds:
-            assert pred in cls.pred_to_symbol
-            assert pred in cls.pred_to_atoms
-            new_sym = cls.pred_to_symbol[pred]
+        for new_sym in new_syms:
+            assert new_sym in cls.symbol_to_pred
             new_re_tree = new_re_tree | re_symbol(new_sym)
-        # For each atom containing old_pred, replace re leaf by new tree.
-        for at in cls.pred_to_atoms[old_pred]:
+        # For each atom containing old_sym, replace re leaf by new tree.
+        for at in cls.symbol_to_atoms[old_sym]:
             new_atom_re_tree = replace_node(at.re_tree, new_re_tree, old_sym)
             at.re_tree = new_atom_re_tree # change the atom objects themselves!
 
@@ -260,20 +269,24 @@ class re_tree_gen(object):
         """ Deal with existing leaf-level predicates, taking different actions
         based on whether the existing predicates are equal, superset, subset, or
         just intersecting, the new predicate.
+
+        Overlaps are computed on decision diagrams of the predicates (see
+        pyretic.lib.predicate_dd), kept alongside each leaf-level predicate,
+        rather than by compiling classifiers of their compositions. Existing
+        predicates are looked up by symbol, since hashing a (possibly deeply
+        nested) predicate is expensive.
         """
         assert isinstance(at, abstract_atom)
         assert isinstance(new_pred, Filter)
 
-        ne_inters   = classifier_utils.has_nonempty_intersection
-        is_not_drop = classifier_utils.is_not_drop
         add_pred = cls.__add_pred__
         new_sym  = re_tree_gen.__new_symbol__
         del_pred = cls.__del_pred__
         replace_pred = cls.__replace_pred__
-        ovlap = classifier_utils.get_overlap_mode
+        new_dd = dd_from_pred(new_pred)
 
         re_tree = re_empty()
-        pred_list = cls.pred_to_symbol.keys()
+        pred_list = cls.pred_to_symbol.items()
 
         """ Record dynamic predicates separately for update purposes."""
         dyn_pols = path_policy_utils.get_dyn_pols(new_pred)
@@ -285,44 +298,51 @@ class re_tree_gen(object):
         """ For each case of overlap between new and existing predicates, do
         actions that will only retain and keep track of non-overlapping
         pieces. """
-        for pred in pred_list:
-            assert pred in cls.pred_to_atoms
-            pred_atoms = cls.pred_to_atoms[pred]
-            pred_symbol = cls.pred_to_symbol[pred]
-            (is_equal,is_superset,is_subset,intersects) = ovlap(pred, new_pred)
+        for (pred, pred_symbol) in pred_list:
+            pred_atoms = cls.symbol_to_atoms[pred_symbol]
+            pred_dd = cls.symbol_to_dd[pred_symbol]
+            (is_equal,is_superset,is_subset,intersects) = dd_overlap_mode(
+                pred_dd, new_dd)
             if is_equal:
                 pred_atoms.append(at)
                 re_tree |= re_symbol(pred_symbol, metadata=at)
                 return re_tree
             elif is_superset:
-                add_pred(pred & ~new_pred, new_sym(), pred_atoms)
-                add_pred(new_pred, new_sym(), pred_atoms + [at])
-                replace_pred(pred, [pred & ~new_pred, new_pred])
-                del_pred(pred)
-                added_sym = cls.pred_to_symbol[new_pred]
+                rest_sym = new_sym()
+                add_pred(pred & ~new_pred, rest_sym, pred_atoms,
+                         pred_dd & ~new_dd)
+                added_sym = new_sym()
+                add_pred(new_pred, added_sym, pred_atoms + [at], new_dd)
+                replace_pred(pred_symbol, [rest_sym, added_sym])
+                del_pred(pred_symbol)
                 re_tree |= re_symbol(added_sym, metadata=at)
                 return re_tree
             elif is_subset:
                 new_pred = new_pred & ~pred
+                new_dd = new_dd & ~pred_dd
                 pred_atoms.append(at)
                 re_tree |= re_symbol(pred_symbol, metadata=at)
             elif intersects:
-                add_pred(pred & ~new_pred, new_sym(), pred_atoms)
-                add_pred(pred &  new_pred, new_sym(), pred_atoms + [at])
-                replace_pred(pred, [pred & ~new_pred, pred & new_pred])
-                del_pred(pred)
-                added_sym = cls.pred_to_symbol[pred & new_pred]
+                rest_sym = new_sym()
+                add_pred(pred & ~new_pred, rest_sym, pred_atoms,
+                         pred_dd & ~new_dd)
+                added_sym = new_sym()
+                add_pred(pred &  new_pred, added_sym, pred_atoms + [at],
+                         pred_dd & new_dd)
+                replace_pred(pred_symbol, [rest_sym, added_sym])
+                del_pred(pred_symbol)
                 re_tree |= re_symbol(added_sym, metadata=at)
                 new_pred = new_pred & ~pred
+                new_dd = new_dd & ~pred_dd
             else:
                 pass
 
-        if is_not_drop(new_pred):
+        if not new_dd is DD_FALSE:
             """ The new predicate should be added if some part of it doesn't
             intersect any existing predicate, i.e., new_pred is not drop.
             """
-            add_pred(new_pred, new_sym(), [at])
-            added_sym = cls.pred_to_symbol[new_pred]
+            added_sym = new_sym()
+            add_pred(new_pred, added_sym, [at], new_dd)
             re_tree |= re_symbol(added_sym, metadata=at)
 
         return re_tree
@@ -331,9 +351,12 @@ class re_tree_gen(object):
     def clear(cls):
         """ Completely reset character generating structures. """
         re_tree_gen.token = TOKEN_START_VALUE
+        cls.generation += 1
         cls.pred_to_symbol  = {}
         cls.pred_to_atoms   = {}
         cls.symbol_to_pred  = {}
+        cls.symbol_to_atoms = {}
+        cls.symbol_to_dd    = {}
         cls.dyn_preds       = []
 
     @classmethod
@@ -950,6 +973,21 @@ class path_inters(path_combinator):
 
 class pathcomp(object):
     """ Functionality related to actual compilation of path queries. """
+    log = logging.getLogger('%s.pathcomp' % __name__)
+    dfa_stats = {}
+    # State kept across compilations, to extend rather than rebuild: the leaf
+    # path policies compiled last, the character generator generations they
+    # were compiled in, the policy fragments generated, and the parallel
+    # compositions of those fragments. Capture fragments are keyed on a serial
+    # number per captured policy, held along with the policy.
+    compiled_leaves = None
+    compiled_generations = None
+    frag_cache = {}
+    composed = {}
+    capture_serials = {}
+    capture_counter = itertools.count()
+    compiled_encoding = None
+
     @classmethod
     def __set_tag__(cls, d, q):
         """ Set tag when going to a state q in a DFA d. """
@@ -994,6 +1032,13 @@ class pathcomp(object):
                     raise TypeError("Symbol can only be in or out typed.")
 
         edge_label = dfa_utils.get_edge_label(edge)
+        in_sym  = __sym_in_class__(__in_re_tree_gen__, edge_label)
+        out_sym = __sym_in_class__(__out_re_tree_gen__, edge_label)
+        if in_sym != out_sym:
+            # the symbol alone tells the type; skip the metadata lookup
+            if in_sym:
+                return (__in_re_tree_gen__.symbol_to_pred[edge_label], __in__)
+            return (__out_re_tree_gen__.symbol_to_pred[edge_label], __out__)
         atoms_list = reduce(lambda a,x: a + x,
                             dfa_utils.get_edge_atoms(dfa,edge),
                             [])
@@ -1068,6 +1113,113 @@ class pathcomp(object):
         else:
             raise TypeError("Can't get re_pols from non-path-policy!")
 
+    @classmethod
+    def __get_leaves__(cls, acc, p):
+        """ A reduce lambda which collects the leaves of the path policy ast.
+        """
+        if (isinstance(p, path_policy) and
+            not isinstance(p, dynamic_path_policy) and
+            not isinstance(p, path_policy_union)):
+            return acc + [p]
+        elif isinstance(p, path_policy):
+            return acc
+        else:
+            raise TypeError("Can't get leaves of non-path-policy!")
+
+    @classmethod
+    def __get_atoms__(cls, leaves):
+        """ Get all abstract atoms in the paths of the given leaf policies. """
+        def add_atoms(acc, x):
+            if isinstance(x, in_out_atom):
+                acc.append(x)
+            return acc
+        fold = path_policy_utils.path_ast_fold
+        return reduce(lambda acc, p: fold(p.path, add_atoms, acc), leaves, [])
+
+    @classmethod
+    def __generations__(cls):
+        return (__in_re_tree_gen__.generation, __out_re_tree_gen__.generation)
+
+    @classmethod
+    def invalidate(cls):
+        """ Forget all state from previous compilations, so that the next
+        compile starts from scratch. Needed whenever existing predicates may
+        have changed, e.g., on an update to a dynamic predicate. """
+        cls.compiled_leaves = None
+        cls.compiled_generations = None
+        cls.frag_cache = {}
+        cls.composed = {}
+        cls.capture_serials = {}
+
+    @classmethod
+    def __prepare_atoms__(cls, leaves):
+        """ Prepare the leaf path policies for compilation, extending the
+        predicate partition of the previous compilation if all of its leaves
+        are still around, and building a new one otherwise. Returns True if the
+        previous partition was extended.
+        """
+        old_leaves = cls.compiled_leaves
+        extend = (old_leaves is not None and
+                  cls.compiled_generations == cls.__generations__() and
+                  set(map(id, old_leaves)) <= set(map(id, leaves)))
+        if extend:
+            old_ids = set(map(id, old_leaves))
+            new_leaves = filter(lambda p: not id(p) in old_ids, leaves)
+            old_atoms = set(map(id, cls.__get_atoms__(old_leaves)))
+            for at in cls.__get_atoms__(new_leaves):
+                if not id(at) in old_atoms:
+                    at.invalidate_re_tree()
+        else:
+            __in_re_tree_gen__.clear()
+            __out_re_tree_gen__.clear()
+            cls.frag_cache = {}
+            for p in leaves:
+                cls.__invalidate_re_trees__(None, p)
+        for p in leaves:
+            cls.__prep_re_trees__(None, p)
+        cls.compiled_leaves = leaves
+        cls.compiled_generations = cls.__generations__()
+        return extend
+
+    @classmethod
+    def __get_frag__(cls, frags, key, make_frag):
+        """ Get the policy fragment for `key` from the previous compilation, or
+        make it with make_frag(). Used fragments are recorded in `frags`. """
+        try:
+            frag = cls.frag_cache[key]
+        except KeyError:
+            frag = make_frag()
+        frags[key] = frag
+        return frag
+
+    @classmethod
+    def __capture_serial__(cls, serials, pol):
+        """ The serial number of a captured policy, kept across compilations
+        while the policy is captured. The policy is held in `serials` along
+        with its number, so that its id() cannot be reused meanwhile. """
+        entry = serials.get(id(pol), cls.capture_serials.get(id(pol)))
+        if entry is None or not entry[0] is pol:
+            entry = (pol, next(cls.capture_counter))
+        serials[id(pol)] = entry
+        return entry[1]
+
+    @classmethod
+    def __compose__(cls, key, pols):
+        """ Parallel composition of `pols`. If they are the same policy objects
+        as in the previous compilation, the previous composition is returned,
+        so that callers can tell nothing changed (and classifiers are reused).
+        """
+        (old_pols, old_pol) = cls.composed.get(key, ([], None))
+        if (len(old_pols) == len(pols) and
+            all([a is b for (a, b) in zip(old_pols, pols)])):
+            return old_pol
+        if len(pols) == 1:
+            pol = pols[0]
+        else:
+            pol = parallel(pols)
+        cls.composed[key] = (list(pols), pol)
+        return pol
+
     @classmethod
     def init(cls, numvals):
         """ Initialize path-related structures, namely:
@@ -1076,71 +1228,183 @@ class pathcomp(object):
         """
         virtual_field(name="path_tag",
                       values=range(0, numvals),
-                      type="integer")
+                      type="integer",
+                      most_significant=True)
         __in_re_tree_gen__.clear()
         __out_re_tree_gen__.clear()
+        cls.invalidate()
 
     @classmethod
-    def compile(cls, path_pol, max_states=1022):
+    def __reserve_tags__(cls, num_states):
+        """ Grow the path tag declared in init() to hold `num_states` DFA
+        states, dropping cached fragments if the virtual field layout or
+        encoding changed since they were built. """
+        tag_field = virtual_field.fields.get('path_tag')
+        if tag_field is None:
+            # not declared by init(): DFAs are capped at the default number
+            # of path tags, as before path tags could grow
+            if num_states > NUM_PATH_TAGS:
+                raise RuntimeError('path DFA has %d states, more than the %d '
+                                   'path tags available without '
+                                   'pathcomp.init()' %
+                                   (num_states, NUM_PATH_TAGS))
+        elif len(tag_field.values) < num_states:
+            virtual_field(name="path_tag",
+                          values=range(0, num_states),
+                          type="integer",
+                          most_significant=True)
+        encoding = (virtual_field.layout, tag_encoding.version)
+        if cls.compiled_encoding != encoding:
+            cls.frag_cache = {}
+            cls.composed = {}
+            cls.compiled_encoding = encoding
+
+    @classmethod
+    def __count_rules__(cls, dfa):
+        """ Count the tagging and capture fragments that compile() generates
+        from the edges of a DFA. """
+        du = dfa_utils
+        tagging = 0
+        capture = 0
+        dead = du.get_dead_state(dfa)
+        dead_index = du.get_state_index(dfa, dead) if dead else None
+        for edge in du.get_edges(dfa):
+            src = du.get_edge_src(dfa, edge)
+            dst = du.get_edge_dst(dfa, edge)
+            if du.get_state_index(dfa, src) != dead_index:
+                tagging += 1
+            if du.is_accepting(dfa, dst):
+                capture += len(du.get_accepting_exps(dfa, dst))
+        return (tagging, capture)
+
+    @classmethod
+    def __minimize__(cls, dfa):
+        """ Minimize the DFA, recording state and rule counts before and after
+        in cls.dfa_stats. """
+        du = dfa_utils
+        min_dfa = minimizeDFA_vector(dfa)
+        (tag_before, cap_before) = cls.__count_rules__(dfa)
+        (tag_after, cap_after) = cls.__count_rules__(min_dfa)
+        cls.dfa_stats = {'states_before' : du.get_num_states(dfa),
+                         'states_after'  : du.get_num_states(min_dfa),
+                         'tagging_rules_before' : tag_before,
+                         'tagging_rules_after'  : tag_after,
+                         'capture_rules_before' : cap_before,
+                         'capture_rules_after'  : cap_after}
+        cls.log.info("path DFA minimized: %(states_before)d -> "
+                     "%(states_after)d states, %(tagging_rules_before)d -> "
+                     "%(tagging_rules_after)d tagging rules, "
+                     "%(capture_rules_before)d -> %(capture_rules_after)d "
+                     "capture rules" % cls.dfa_stats)
+        return min_dfa
+
+    @classmethod
+    def compile(cls, path_pol, max_states=None, minimize=True):
         """ Compile the list of paths along with the forwarding policy `fwding`
         into a single classifier to be installed on switches.
+
+        Compilation is incremental when path policies are only added: if every
+        leaf path policy of the previous compile is still present (and the
+        character generators weren't cleared in between), the existing
+        predicate partition is extended with the new atoms only, and tagging
+        and capture fragments that come out the same are reused, along with
+        their classifiers. The DFA itself is rebuilt, reusing memoized
+        derivatives. Call invalidate() to force a rebuild from scratch.
+
+        The path tag virtual field from init() grows to fit the DFA if needed,
+        which may switch virtual fields to an encoding spanning more headers
+        (see tag_encoding). Fragments built before any change to the virtual
+        fields or their encoding are dropped. Without init(), the DFA may have
+        at most NUM_PATH_TAGS states, or RuntimeError is raised.
+
+        :param max_states: optional cap on the number of DFA states
+        :type max_states: int
+        :param minimize: merge equivalent DFA states before generating tags
+        :type minimize: bool
         """
         du = dfa_utils
         in_cg = __in_re_tree_gen__
         out_cg = __out_re_tree_gen__
         ast_fold = path_policy_utils.path_policy_ast_fold
         re_pols  = cls.__get_re_pols__
-        inv_trees = cls.__invalidate_re_trees__
-        prep_trees = cls.__prep_re_trees__
 
-        in_cg.clear()
-        out_cg.clear()
-
-        ast_fold(path_pol, inv_trees, None)
-        ast_fold(path_pol, prep_trees, None)
+        leaves = ast_fold(path_pol, cls.__get_leaves__, [])
+        extended = cls.__prepare_atoms__(leaves)
         (re_list, pol_list) = ast_fold(path_pol, re_pols, ([], []))
         dfa = du.regexes_to_dfa(re_list)
-        assert du.get_num_states(dfa) <= max_states
+        if minimize:
+            dfa = cls.__minimize__(dfa)
+        if max_states is not None:
+            assert du.get_num_states(dfa) <= max_states
+        cls.__reserve_tags__(du.get_num_states(dfa))
         match_tag = lambda q: cls.__match_tag__(dfa, q)
         set_tag   = lambda q: cls.__set_tag__(dfa, q)
         get_pred  = lambda e: cls.__get_pred__(dfa, e)
+        index     = lambda q: du.get_state_index(dfa, q)
+        frags = {}
+        get_frag  = lambda key, f: cls.__get_frag__(frags, key, f)
+        serials = {}
+        capture_serial = lambda p: cls.__capture_serial__(serials, p)
 
         """ Initialize tagging and capture policies. """
-        in_tagging = (((in_cg.get_unaffected_pred() &
-                        ~(cls.__get_dead_state_pred__(dfa)))
-                       >> cls.__set_dead_state_tag__(dfa)) +
-                      cls.__get_dead_state_pred__(dfa))
-        out_tagging = (((out_cg.get_unaffected_pred() &
-                         ~(cls.__get_dead_state_pred__(dfa)))
-                        >> cls.__set_dead_state_tag__(dfa)) +
-                       cls.__get_dead_state_pred__(dfa))
-        in_capture = drop
-        out_capture = drop
+        dead = du.get_dead_state(dfa)
+        dead_index = index(dead) if dead else None
+        def tagging_head(cg):
+            return ((cg.get_unaffected_pred() &
+                     ~(cls.__get_dead_state_pred__(dfa)))
+                    >> cls.__set_dead_state_tag__(dfa))
+        dead_pred = get_frag(('dead', dead_index),
+                             lambda: cls.__get_dead_state_pred__(dfa))
+        in_tagging = [get_frag(('head', __in__, dead_index,
+                                frozenset(in_cg.symbol_to_pred)),
+                               lambda: tagging_head(in_cg)),
+                      dead_pred]
+        out_tagging = [get_frag(('head', __out__, dead_index,
+                                 frozenset(out_cg.symbol_to_pred)),
+                                lambda: tagging_head(out_cg)),
+                       dead_pred]
+        in_capture = [drop]
+        out_capture = [drop]
 
         """ Generate transition/accept rules from DFA """
         edges = du.get_edges(dfa)
         for edge in edges:
             src = du.get_edge_src(dfa, edge)
             dst = du.get_edge_dst(dfa, edge)
+            sym = du.get_edge_label(edge)
             (pred, typ) = get_pred(edge)
             assert typ in [__in__, __out__]
-            if not du.is_dead(dfa, src):
-                tag_frag = ((match_tag(src) & pred) >> set_tag(dst))
+            if index(src) != dead_index:
+                tag_frag = get_frag(('tag', typ, sym, index(src), index(dst)),
+                                    lambda: ((match_tag(src) & pred) >>
+                                             set_tag(dst)))
                 if typ == __in__:
-                    in_tagging += tag_frag
+                    in_tagging.append(tag_frag)
                 elif typ == __out__:
-                    out_tagging += tag_frag
+                    out_tagging.append(tag_frag)
 
             if du.is_accepting(dfa, dst):
                 ords = du.get_accepting_exps(dfa, dst)
                 for i in ords:
-                    cap_frag = ((match_tag(src) & pred) >> pol_list[i])
+                    cap_frag = get_frag(('cap', typ, sym, index(src),
+                                         capture_serial(pol_list[i])),
+                                        lambda: ((match_tag(src) & pred) >>
+                                                 pol_list[i]))
                     if typ == __in__:
-                        in_capture += cap_frag
+                        in_capture.append(cap_frag)
                     elif typ == __out__:
-                        out_capture += cap_frag
-
-        return (in_tagging, in_capture, out_tagging, out_capture)
+                        out_capture.append(cap_frag)
+
+        reused = len(filter(lambda k: k in cls.frag_cache, frags.keys()))
+        cls.log.info("path compile (%s): %d of %d fragments reused" %
+                     ('extended' if extended else 'rebuilt', reused,
+                      len(frags)))
+        cls.frag_cache = frags
+        cls.capture_serials = serials
+        return (cls.__compose__('in_tagging', in_tagging),
+                cls.__compose__('in_capture', in_capture),
+                cls.__compose__('out_tagging', out_tagging),
+                cls.__compose__('out_capture', out_capture))
 
     class policy_frags:
         def __init__(self):
@@ -1199,7 +1463,7 @@ class pathcomp(object):
         
         # initialize virtual fields
         virtual_field(name="path_tag", values=range(0, du.get_num_states(dfa)),
-                      type="integer")
+                      type="integer", most_significant=True)
 
         def get_hook_atoms(edge_label):
             hook_atoms = []
@@ -1379,6 +1643,17 @@ class pathcomp(object):
 
 class dfa_utils(object):
     """ Utilities to generate DFAs and access various properties. """
+    log = logging.getLogger('%s.dfa_utils' % __name__)
+    # Set to True to dump every DFA built (as a DOT graph) and the leaf-level
+    # predicates to the files below. Rendering the DOT graph can cost more than
+    # building the DFA, so this is meant for debugging only.
+    debug_dump = False
+    dot_file = '/tmp/pyretic-regexes.txt.dot'
+    symbols_file = '/tmp/symbols.txt'
+    # Called with a dict of statistics on every DFA built, see get_dfa_stats.
+    stats_hook = None
+    last_stats = {}
+
     @classmethod
     def print_dfa(cls, d):
         """ Print a DFA object d. """
@@ -1498,9 +1773,30 @@ class dfa_utils(object):
         if not symlist:
             symlist = (__in_re_tree_gen__.get_symlist() +
                        __out_re_tree_gen__.get_symlist())
+        start = time.time()
         dfa = makeDFA_vector(re_exps, symlist)
-        cls.__dump_file__(dfa.dot_repr(), '/tmp/pyretic-regexes.txt.dot')
-        leaf_preds = (__in_re_tree_gen__.get_leaf_preds() +
-                      __out_re_tree_gen__.get_leaf_preds())
-        cls.__dump_file__(leaf_preds, '/tmp/symbols.txt')
+        stats = cls.get_dfa_stats(dfa)
+        stats.update({'expressions' : len(re_exps),
+                      'symbols' : len(symlist),
+                      'build_time' : time.time() - start})
+        cls.last_stats = stats
+        cls.log.debug("built path DFA: %(states)d states, %(transitions)d "
+                      "transitions, %(expressions)d expressions, %(symbols)d "
+                      "symbols in %(build_time)f s" % stats)
+        if cls.stats_hook:
+            cls.stats_hook(stats)
+        if cls.debug_dump:
+            cls.__dump_file__(dfa.dot_repr(), cls.dot_file)
+            leaf_preds = (__in_re_tree_gen__.get_leaf_preds() +
+                          __out_re_tree_gen__.get_leaf_preds())
+            cls.__dump_file__(leaf_preds, cls.symbols_file)
         return dfa
+
+    @classmethod
+    def get_dfa_stats(cls, d):
+        """ Cheap statistics on a DFA: a dict with the number of states and
+        transitions. """
+        assert isinstance(d, dfa_base)
+        tt = d.transition_table.re_to_transitions
+        return {'states' : d.all_states.get_num_states(),
+                'transitions' : sum(map(len, tt.values()))}
@@ -0,0 +1,253 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+# Decision diagrams over packet header fields, used to compare and refine     #
+# predicates without composing and compiling classifiers.                      #
+################################################################################
+
+import itertools
+import weakref
+
+from pyretic.core.language import match, identity, drop, negate, union
+from pyretic.core.language import intersection, DynamicFilter
+
+# Decision diagrams are hash-consed: every node is unique for its structure,
+# so two diagrams represent the same set of packets exactly when they are the
+# same object, and emptiness is a comparison against DD_FALSE.
+#
+# An internal node tests one variable. Fields matched on exact values (switch,
+# port, ethtype, ...) are a single variable (field, -1), whose node has one
+# branch per value mentioned and a default child for all other values. Fields
+# matched on prefixes (srcip, dstip) are one binary variable (field, i) per
+# address bit, whose node has a single branch on 1 and the default on 0.
+# Variables are ordered by (field, index) along every path.
+#
+# The table of nodes only holds a node while some diagram (or memo entry)
+# refers to it. Idents are never reused, so the memo keys of a dropped node
+# never match a node built later.
+dd_nodes = weakref.WeakValueDictionary()
+dd_ident_counter = itertools.count()
+DD_APPLY_MEMO_MAX = 200000
+dd_apply_memo = {}
+dd_negate_memo = {}
+
+class dd_node(object):
+    """ A node in a header-space decision diagram. Use the module functions to
+    build these; never instantiate directly.
+    """
+    __slots__ = ['var', 'branches', 'default', 'ident', '__weakref__']
+
+    def __init__(self, var, branches, default):
+        self.var = var
+        self.branches = branches
+        self.default = default
+        self.ident = next(dd_ident_counter)
+
+    def is_terminal(self):
+        return self.var is None
+
+    def __and__(self, other):
+        return dd_and(self, other)
+
+    def __or__(self, other):
+        return dd_or(self, other)
+
+    def __invert__(self):
+        return dd_negate(self)
+
+    def __repr__(self):
+        if self is DD_TRUE:
+            return 'true'
+        elif self is DD_FALSE:
+            return 'false'
+        out = '(%s ? ' % repr(self.var)
+        for (value, child) in self.branches.items():
+            out += '%s: %s, ' % (repr(value), repr(child))
+        return out + 'else: %s)' % repr(self.default)
+
+DD_FALSE = dd_node(None, {}, None)
+DD_TRUE  = dd_node(None, {}, None)
+
+def dd_var_less(v1, v2):
+    """ Variable order; terminals (None) come after every variable. """
+    if v1 is None:
+        return False
+    if v2 is None:
+        return True
+    return v1 < v2
+
+def make_node(var, branches, default):
+    """ Return the unique node testing `var`, with children `branches` (a dict
+    from value to node) and `default` for every other value.
+    """
+    branches = dict((v, c) for (v, c) in branches.items() if not c is default)
+    if not branches:
+        return default
+    key = (var, frozenset((v, c.ident) for (v, c) in branches.items()),
+           default.ident)
+    node = dd_nodes.get(key)
+    if node is None:
+        node = dd_nodes.setdefault(key, dd_node(var, branches, default))
+    return node
+
+def __cofactors__(n, var):
+    """ The (branches, default) of node n with respect to variable var. """
+    if n.var == var:
+        return (n.branches, n.default)
+    return ({}, n)
+
+def __apply__(op, a, b):
+    """ Combine two diagrams with the boolean operator op ('and' or 'or'). """
+    if op == 'and':
+        if a is DD_FALSE or b is DD_FALSE:
+            return DD_FALSE
+        if a is DD_TRUE or a is b:
+            return b
+        if b is DD_TRUE:
+            return a
+    else:
+        if a is DD_TRUE or b is DD_TRUE:
+            return DD_TRUE
+        if a is DD_FALSE or a is b:
+            return b
+        if b is DD_FALSE:
+            return a
+    if a.ident > b.ident:
+        (a, b) = (b, a)
+    key = (op, a.ident, b.ident)
+    try:
+        return dd_apply_memo[key]
+    except KeyError:
+        pass
+    var = a.var if dd_var_less(a.var, b.var) or a.var == b.var else b.var
+    (a_br, a_def) = __cofactors__(a, var)
+    (b_br, b_def) = __cofactors__(b, var)
+    branches = {}
+    for value in set(a_br.keys()) | set(b_br.keys()):
+        branches[value] = __apply__(op, a_br.get(value, a_def),
+                                    b_br.get(value, b_def))
+    res = make_node(var, branches, __apply__(op, a_def, b_def))
+    if len(dd_apply_memo) >= DD_APPLY_MEMO_MAX:
+        dd_apply_memo.clear()
+    dd_apply_memo[key] = res
+    return res
+
+def dd_and(a, b):
+    return __apply__('and', a, b)
+
+def dd_or(a, b):
+    return __apply__('or', a, b)
+
+def dd_negate(a):
+    if a is DD_TRUE:
+        return DD_FALSE
+    elif a is DD_FALSE:
+        return DD_TRUE
+    try:
+        return dd_negate_memo[a.ident]
+    except KeyError:
+        pass
+    branches = dict((v, dd_negate(c)) for (v, c) in a.branches.items())
+    res = make_node(a.var, branches, dd_negate(a.default))
+    if len(dd_negate_memo) >= DD_APPLY_MEMO_MAX:
+        dd_negate_memo.clear()
+    dd_negate_memo[a.ident] = res
+    return res
+
+def dd_overlap_mode(a, b):
+    """ Returns a tuple (is_equal, is_superset, is_subset, intersects) of
+    booleans, depending on whether the packets in `a` are equal to, a superset
+    of, a subset of, or just intersect the packets in `b`. At most one of them
+    is True. This mirrors classifier_utils.get_overlap_mode.
+    """
+    if a is b:
+        return (True, False, False, False)
+    inters = dd_and(a, b)
+    if inters is b:
+        return (False, True, False, False)
+    elif inters is a:
+        return (False, False, True, False)
+    return (False, False, False, not inters is DD_FALSE)
+
+### Conversion from predicates
+
+def dd_from_field(field, value):
+    """ The diagram of packets whose `field` matches `value`. """
+    if hasattr(value, 'prefixlen') and hasattr(value, 'max_prefixlen'):
+        bits = int(value.network)
+        width = value.max_prefixlen
+        node = DD_TRUE
+        for i in reversed(range(0, value.prefixlen)):
+            if (bits >> (width - 1 - i)) & 1:
+                node = make_node((field, i), {1: node}, DD_FALSE)
+            else:
+                node = make_node((field, i), {1: DD_FALSE}, node)
+        return node
+    return make_node((field, -1), {value: DD_TRUE}, DD_FALSE)
+
+def dd_from_map(m):
+    """ The diagram of packets matching all field values in the map `m`. """
+    return reduce(lambda acc, (f, v): dd_and(acc, dd_from_field(f, v)),
+                  m.items(), DD_TRUE)
+
+def dd_from_classifier(c):
+    """ The diagram of packets that a filter's classifier `c` lets through. """
+    res = DD_FALSE
+    for rule in reversed(c.rules):
+        if isinstance(rule.match, match):
+            m = dd_from_map(rule.match.map)
+        elif rule.match == identity:
+            m = DD_TRUE
+        else:
+            m = DD_FALSE
+        if len(rule.actions) > 0:
+            res = dd_or(m, res)
+        else:
+            res = dd_and(dd_negate(m), res)
+    return res
+
+def dd_from_pred(p):
+    """ The diagram of packets that the predicate `p` lets through. Filter
+    combinators are converted structurally, and everything else (including
+    matches, whose classifiers are built on creation and have virtual fields
+    translated) from its compiled classifier.
+    """
+    if p == identity:
+        return DD_TRUE
+    elif p == drop:
+        return DD_FALSE
+    elif isinstance(p, negate):
+        return dd_negate(dd_from_pred(p.policies[0]))
+    elif isinstance(p, union):
+        return reduce(lambda acc, x: dd_or(acc, dd_from_pred(x)),
+                      p.policies, DD_FALSE)
+    elif isinstance(p, intersection):
+        return reduce(lambda acc, x: dd_and(acc, dd_from_pred(x)),
+                      p.policies, DD_TRUE)
+    elif isinstance(p, DynamicFilter):
+        return dd_from_pred(p.policy)
+    else:
+        return dd_from_classifier(p.compile())
@@ -26,47 +26,192 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
+from __future__ import absolute_import
+
 from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, Query, FwdBucket, CountBucket, DynamicPolicy
+from pyretic.core.runtime import PollingService
+from pyretic.core.classifier import Rule
+from pyretic.core.network import IP_TYPE
+from pyretic.core.packet import TCP_PROTO, UDP_PROTO
 import time
 import copy
 import re
-from threading import Thread
+import sre_parse
+import math
+from collections import OrderedDict, deque
+import threading
+import weakref
 from multiprocessing import Lock
 
+def group_fields(pkt, group_by):
+    """The (field, value) pairs by which pkt is grouped: those of the group_by
+    fields if given, otherwise those of all available fields."""
+    if group_by:    # MATCH ON PROVIDED GROUP_BY
+        return [(field,pkt[field]) for field in group_by]
+    else:           # OTHERWISE, MATCH ON ALL AVAILABLE GROUP_BY
+        return [(field,pkt[field]) for field in pkt.available_fields()]
+
+
 class LimitFilter(DynamicFilter):
     """A DynamicFilter that matches the first limit packets in a specified grouping.
 
+    Groups that reached the limit are blocked by a negated union of their
+    group_by matches, which is grown one group at a time: the negation's
+    classifier is kept, and gets one rule dropping the new group prepended.
+    Without group_by, packets are counted per all their available fields, and
+    once any such group reaches the limit, all packets are blocked.
+
+    With a ttl, a group not seen for ttl seconds is forgotten, and a blocked
+    group is let through again, to be counted anew, ttl seconds after it was
+    blocked; the negated union is then rebuilt from scratch. With max_groups,
+    at most that many groups are counted and at most that many are blocked,
+    evicting the least recently seen, resp. blocked, ones first. Groups age
+    out as packets arrive and, with a ttl, every ttl seconds off the runtime's
+    polling service, until stop() or the filter is garbage collected: the
+    service only holds a weak reference to it.
+
     :param limit: the number of packets to be matched in each grouping.
     :type limit: int
     :param group_by: the fields by which to group packets.
     :type group_by: list string
+    :param ttl: seconds after which the state of a group ages out, if any.
+    :type ttl: float
+    :param max_groups: the most groups to count, and to block, if any.
+    :type max_groups: int
+    :param poller: the polling service to age groups out with, if not the
+        shared one
+    :type poller: PollingService
     """
-    def __init__(self,limit=None,group_by=[]):
+    def __init__(self,limit=None,group_by=[],ttl=None,max_groups=None,
+                 clock=time.time,poller=None):
         self.limit = limit
         self.group_by = group_by
-        self.seen = {}
-        self.done = []
+        self.ttl = ttl
+        self.max_groups = max_groups
+        self.clock = clock
+        self.seen = OrderedDict() # group -> (count, last seen), LRU first
+        self.done = OrderedDict() # blocked group -> time blocked, oldest first
+        self.blocked = None       # union of the blocked groups' matches
+        self.lock = threading.RLock()
         super(LimitFilter,self).__init__(identity)
+        self.expire_handle = None
+        if ttl is not None:
+            if poller is None:
+                poller = PollingService.get_shared()
+            self.poller = poller
+            # the poll mustn't keep the filter alive: it goes with the filter
+            handle = []
+            ref = weakref.ref(self, lambda _: poller.unregister(handle[0]))
+            expire_ref = self.expire_ref
+            handle.append(poller.register(ttl, lambda: expire_ref(ref)))
+            self.expire_handle = handle[0]
+
+    @staticmethod
+    def expire_ref(ref):
+        """Age out the groups of a filter, unless it is gone."""
+        lf = ref()
+        if lf is not None:
+            lf.expire()
 
     def get_pred_from_pkt(self, pkt):
-        if self.group_by:    # MATCH ON PROVIDED GROUP_BY
-            return match([(field,pkt[field]) for field in self.group_by])
-        else:              # OTHERWISE, MATCH ON ALL AVAILABLE GROUP_BY
-            return match([(field,pkt[field])
-                              for field in pkt.available_fields()])
+        return match(group_fields(pkt, self.group_by))
+
+    def get_block_pred_from_pkt(self, pkt):
+        return match([(field,pkt[field]) for field in self.group_by])
 
     def update_policy(self,pkt):
+        with self.lock:
+            self.update_groups(pkt)
+
+    def update_groups(self,pkt):
+        now = self.clock()
+        unblocked = self.age_out(now)
+        block_pred = self.get_block_pred_from_pkt(pkt)
+        if block_pred in self.done:
+            # packets of a group may still arrive while it is being blocked
+            if unblocked:
+                self.rebuild_policy()
+            return
         pred = self.get_pred_from_pkt(pkt)
         # INCREMENT THE NUMBER OF TIMES MATCHING PKT SEEN
-        try:
-            self.seen[pred] += 1
-        except KeyError:
-            self.seen[pred] = 1
+        (count, _) = self.seen.pop(pred, (0, None))
+        count += 1
+        if count != self.limit:
+            self.seen[pred] = (count, now)
+            if self.max_groups is not None:
+                while len(self.seen) > self.max_groups:
+                    self.seen.popitem(last=False)
+            if unblocked:
+                self.rebuild_policy()
+            return
+        self.done[block_pred] = now
+        if self.max_groups is not None:
+            while len(self.done) > self.max_groups:
+                self.done.popitem(last=False)
+                unblocked = True
+        if unblocked:
+            self.rebuild_policy()
+        else:
+            self.block(block_pred)
+
+    def age_out(self, now):
+        """Forget the groups not seen for ttl seconds, and unblock those
+        blocked for ttl seconds. Returns whether any group was unblocked."""
+        if self.ttl is None:
+            return False
+        while self.seen:
+            (pred, (_, last_seen)) = next(self.seen.iteritems())
+            if now - last_seen < self.ttl:
+                break
+            del self.seen[pred]
+        unblocked = False
+        while self.done:
+            (pred, blocked_at) = next(self.done.iteritems())
+            if now - blocked_at < self.ttl:
+                break
+            del self.done[pred]
+            unblocked = True
+        return unblocked
+
+    def expire(self):
+        """Age out groups, updating the policy if any group got unblocked."""
+        with self.lock:
+            if self.age_out(self.clock()):
+                self.rebuild_policy()
+
+    def stop(self):
+        """Stop aging out groups off the polling service."""
+        if self.expire_handle is not None:
+            self.poller.unregister(self.expire_handle)
+            self.expire_handle = None
+
+    def block(self, pred):
+        """Add one group to the blocked union, prepending a rule dropping it
+        to the classifier of the union's negation."""
+        if self.blocked is None:
+            self.set_blocked(union([pred]))
+            return
+        classifier = self.policy.compile()
+        self.blocked.policies.append(pred)
+        self.blocked.invalidate_classifier()
+        classifier.prepend(Rule(pred, set()))
+        self.invalidate_classifier()
+        self.changed()
+
+    def rebuild_policy(self):
+        """Rebuild the blocked union from scratch, after groups left it."""
+        if self.done:
+            self.set_blocked(union(self.done.keys()))
+        else:
+            self.set_blocked(None)
 
-        if self.seen[pred] == self.limit:
-            val = {h : pkt[h] for h in self.group_by}
-            self.done.append(match(val))
-            self.policy = ~union(self.done)
+    def set_blocked(self, blocked):
+        self.blocked = blocked
+        self.invalidate_classifier()
+        if blocked is None:
+            self.policy = identity
+        else:
+            self.policy = ~blocked
 
     def __repr__(self):
         return "LimitFilter\n%s" % repr(self.policy)
@@ -125,26 +270,20 @@ class counts(DynamicPolicy):
         self.queried_preds_lock = Lock()
 
     def set_up_polling(self,interval):
-        """Setup polling of stats from switches every `interval` seconds. If
-        interval is None, the application needs to call pull_stats directly."""
+        """Setup polling of stats from switches every `interval` seconds, with
+        the runtime's polling service. If interval is None, the application
+        needs to call pull_stats directly."""
+        self.poll_handle = None
         if interval:
-            self.qt = Thread(target=self.query_thread, args=(interval,))
-            self.qt.daemon = True
-            self.qt.start()
-
-    def query_thread(self, interval):
-        """Thread that calls pull_stats every `interval` seconds."""
-        time.sleep(interval)
-        while True:
-            self.pull_stats()
-            time.sleep(interval)
+            self.poll_handle = PollingService.get_shared().register(
+                interval, self.pull_stats)
 
     def init_countbucket(self, pkt):
         """When a packet from a previously unseen grouping arrives, set up new
         count buckets for the same.
         """
         pred = self.groupby_filter.get_pred_from_pkt(pkt)
-        cb = CountBucket()
+        cb = CountBucket(counter_only=True)
         cb.register_callback(self.collect_pred(pred))
         self.bucket_policies.append(pred >> cb)
         self.bucket_dict[pred] = cb
@@ -194,47 +333,243 @@ class counts(DynamicPolicy):
         return "counts\n%s" % repr(self.policy)
 
 
+class count_min_sketch(object):
+    """A count-min sketch: depth rows of width counters, into each of which
+    every key is hashed once. The estimate of a key's count is never below the
+    true count, and exceeds it by at most epsilon times the total count with
+    probability at least 1 - delta.
+
+    :param epsilon: the error bound, relative to the total count
+    :type epsilon: float
+    :param delta: the probability of exceeding the error bound
+    :type delta: float
+    """
+    def __init__(self, epsilon=0.001, delta=0.01):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.clear()
+
+    def clear(self):
+        self.rows = [[0] * self.width for i in range(self.depth)]
+        self.total = 0
+
+    def indices(self, key):
+        """ The counter of key in each row. """
+        h = hash(key)
+        return [hash((i, h)) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1, indices=None):
+        if indices is None:
+            indices = self.indices(key)
+        for (row, i) in zip(self.rows, indices):
+            row[i] += count
+        self.total += count
+
+    def estimate(self, key, indices=None):
+        if indices is None:
+            indices = self.indices(key)
+        return min([row[i] for (row, i) in zip(self.rows, indices)])
+
+
+class approx_counts(DynamicPolicy):
+    """Approximate packet and byte counts per grouping, in the manner of
+    counts but with no count bucket, predicate or switch rule per group.
+    Packets are sent to the controller, where they are counted in count-min
+    sketches, so memory stays bounded no matter how many groups there are.
+    Counts of sampled traffic (e.g., scaled up by the sampling rate) can be
+    added with add_counts.
+
+    This bounds controller memory, not controller traffic: as a FwdBucket
+    underlies the sketches, every packet the query sees still goes to the
+    controller, unlike with counts, whose switch rules count packets in place.
+    Restrict it to a small share of the traffic (e.g., with a match), or feed
+    it sampled counts through add_counts rather than applying it to packets.
+
+    Callbacks receive the estimated [packet, byte] counts of the top_k groups
+    with the most packets, as a dictionary keyed like that of counts.
+
+    :param interval: time period between successive callbacks, if any
+    :type interval: float
+    :param group_by: list of grouping fields, as for LimitFilter
+    :type group_by: string list
+    :param epsilon: error bound of the counts, relative to the total counts
+    :type epsilon: float
+    :param delta: probability of a count exceeding its error bound
+    :type delta: float
+    :param top_k: number of heavy-hitter groups to report
+    :type top_k: int
+    """
+    def __init__(self, interval=None, group_by=[], epsilon=0.001, delta=0.01,
+                 top_k=100):
+        self.group_by = group_by
+        self.top_k = top_k
+        self.packet_sketch = count_min_sketch(epsilon, delta)
+        self.byte_sketch = count_min_sketch(epsilon, delta)
+        self.heavy = {} # group -> estimated packet count when last counted
+        self.heavy_min = 0 # least of those, once there are top_k groups
+        self.lock = Lock()
+        self.callbacks = []
+        self.fb = FwdBucket()
+        self.fb.register_callback(self.count_packet)
+        super(approx_counts,self).__init__(self.fb)
+        self.set_up_polling(interval)
+
+    def set_up_polling(self,interval):
+        """Call back every `interval` seconds, with the runtime's polling
+        service. If interval is None, the application needs to call pull_stats
+        directly."""
+        self.poll_handle = None
+        if interval:
+            self.poll_handle = PollingService.get_shared().register(
+                interval, self.pull_stats)
+
+    def count_packet(self, pkt):
+        self.add_counts(tuple(group_fields(pkt, self.group_by)), 1,
+                        pkt['header_len'] + pkt['payload_len'])
+
+    def add_counts(self, group, packets, bytes):
+        """Count packets and bytes for a group, given by its (field, value)
+        pairs in group_by order."""
+        with self.lock:
+            indices = self.packet_sketch.indices(group)
+            self.packet_sketch.add(group, packets, indices)
+            self.byte_sketch.add(group, bytes, indices)
+            estimate = self.packet_sketch.estimate(group, indices)
+            if group in self.heavy or len(self.heavy) < self.top_k:
+                # estimates only grow, so the least changes only if this
+                # group was the least, or the top_k groups just filled up
+                old = self.heavy.get(group)
+                self.heavy[group] = estimate
+                if (len(self.heavy) == self.top_k and
+                    (old is None or old == self.heavy_min)):
+                    self.heavy_min = min(self.heavy.values())
+            elif estimate > self.heavy_min:
+                # replace the group that looked the lightest when last counted
+                lightest = min(self.heavy, key=self.heavy.get)
+                del self.heavy[lightest]
+                self.heavy[group] = estimate
+                self.heavy_min = min(self.heavy.values())
+
+    def get_counts(self):
+        """The estimated [packet, byte] counts of the heavy-hitter groups."""
+        with self.lock:
+            return { match(group).map :
+                         [self.packet_sketch.estimate(group),
+                          self.byte_sketch.estimate(group)]
+                     for group in self.heavy }
+
+    def register_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def pull_stats(self):
+        counts = self.get_counts()
+        for f in self.callbacks:
+            f(counts)
+
+    def clear(self):
+        with self.lock:
+            self.packet_sketch.clear()
+            self.byte_sketch.clear()
+            self.heavy = {}
+            self.heavy_min = 0
+
+    def __repr__(self):
+        return "approx_counts\n%s" % repr(self.policy)
+
+
 class AggregateFwdBucket(FwdBucket):
     """An abstract FwdBucket which calls back all registered routines every interval
     seconds (can take positive fractional values) with an aggregate value/dict.
     If group_by is empty, registered routines are called back with a single aggregate
     value.  Otherwise, group_by defines the set of headers used to group counts which
-    are then returned as a dictionary."""
+    are then returned as a dictionary.
+
+    Each callback gets a snapshot of the aggregate over the last window seconds,
+    which defaults to interval (tumbling windows); a longer window slides by
+    interval. Aggregates are kept per interval ("pane"), and those of the panes
+    in a window are added up, so aggregators must be additive. The last
+    `retention` snapshots are kept in history, as (time, snapshot) pairs.
+    Callbacks are run by the runtime's polling service.
+
+    :param interval: seconds between callbacks
+    :type interval: float
+    :param group_by: headers by which to group the aggregate
+    :type group_by: list string
+    :param window: seconds of traffic each snapshot aggregates, a multiple
+        of interval
+    :type window: float
+    :param retention: number of snapshots kept in history
+    :type retention: int
+    :param poller: the polling service to run callbacks off, if not the
+        shared one
+    :type poller: PollingService
+    """
     ### init : int -> List String
-    def __init__(self, interval, group_by=[]):
+    def __init__(self, interval, group_by=[], window=None, retention=16,
+                 poller=None):
         FwdBucket.__init__(self)
         self.interval = interval
         self.group_by = group_by
-        if group_by:
-            self.aggregate = {}
+        if window is None:
+            window = interval
+        self.window = window
+        self.aggregate_lock = threading.Lock()
+        self.aggregate = self.empty_aggregate() # of the current pane
+        self.panes = deque(maxlen=max(1, int(round(window / interval))))
+        self.history = deque(maxlen=retention)
+        if poller is None:
+            poller = PollingService.get_shared()
+        self.poller = poller
+        self.report_handle = poller.register(interval, self.report_aggregate)
+
+    def empty_aggregate(self):
+        if self.group_by:
+            return {}
         else:
-            self.aggregate = 0
-        
-        def report_count(callbacks,aggregate,interval):
-            while(True):
-                for callback in callbacks:
-                    callback(aggregate)
-                time.sleep(interval)
-
-        self.query_thread = Thread(target=report_count,args=(self.callbacks,self.aggregate,self.interval))
-        self.query_thread.daemon = True
-        self.query_thread.start()
+            return 0
 
     def aggregator(self,aggregate,pkt):
         raise NotImplementedError
 
     ### update : Packet -> unit
     def update_aggregate(self,pkt):
-        if self.group_by:
-            from pyretic.core.language import match
-            groups = set(self.group_by) & set(pkt.available_fields())
-            pred = match([(field,pkt[field]) for field in groups])
-            try:
-                self.aggregate[pred] = self.aggregator(self.aggregate[pred],pkt)
-            except KeyError:
-                self.aggregate[pred] = self.aggregator(0,pkt)
-        else:
-            self.aggregate = self.aggregator(self.aggregate,pkt)
+        with self.aggregate_lock:
+            if self.group_by:
+                from pyretic.core.language import match
+                groups = set(self.group_by) & set(pkt.available_fields())
+                pred = match([(field,pkt[field]) for field in groups])
+                try:
+                    self.aggregate[pred] = self.aggregator(self.aggregate[pred],pkt)
+                except KeyError:
+                    self.aggregate[pred] = self.aggregator(0,pkt)
+            else:
+                self.aggregate = self.aggregator(self.aggregate,pkt)
+
+    def window_snapshot(self):
+        """ The aggregate over the panes in the window, as a new value. """
+        if not self.group_by:
+            return sum(self.panes)
+        snapshot = {}
+        for pane in self.panes:
+            for (pred, value) in pane.items():
+                snapshot[pred] = snapshot.get(pred, 0) + value
+        return snapshot
+
+    def report_aggregate(self):
+        """ Close the current pane, and call back with the window's snapshot. """
+        with self.aggregate_lock:
+            self.panes.append(self.aggregate)
+            self.aggregate = self.empty_aggregate()
+            snapshot = self.window_snapshot()
+            self.history.append((self.poller.timer.clock(), snapshot))
+        for callback in self.callbacks:
+            callback(snapshot)
+
+    def stop(self):
+        """ Stop calling back. """
+        self.poller.unregister(self.report_handle)
 
     def eval(self, pkt):
         self.update_aggregate(pkt)
@@ -299,5 +634,205 @@ class RegexpQuery(Query):
         return isinstance(other, RegexpQuery) and (other.re == self.re)
 
 
+class MultiRegexpQuery(FwdBucket):
+    """
+    A query matching many patterns against packet payloads at once. Payloads
+    are reassembled per flow, in arrival order, keeping the last `window`
+    bytes of each flow so that matches can span packets. Every pattern is
+    reported, however its matches overlap those of others, as with separate
+    RegexpQuery objects; each pattern's matches don't overlap one another.
+
+    Each flow keeps, per pattern, the offset in its reassembled data past the
+    last match reported, so that no match is reported twice. A match is
+    reported once it can't grow any more: with the packet in which it ends,
+    unless it reaches the end of the data and its pattern can match strings
+    of different lengths. Such a match is held until the next packet of the
+    flow, and reported (extended, if the packet extends it) with that one, or
+    when the flow is evicted or flush() is called. At most `max_flows` flows
+    are tracked, evicting the least recently active first.
+
+    Patterns without flags, inline flags or backreferences are also merged
+    into one precompiled alternation, which skips them all in one pass over
+    data that none of them matches.
+
+    Callbacks registered for a pattern id are called with the packet and the
+    pattern's match object over the reassembled data, as for RegexpQuery;
+    those registered for all patterns also get the pattern id, in between.
+    Like other queries, it only sees the packets sent to it, e.g., with
+    match(dstport=80) >> MultiRegexpQuery(patterns).
+
+    :param patterns: patterns to add, with ids in list order
+    :type patterns: list string
+    :param window: bytes kept per flow for matches spanning packets
+    :type window: int
+    :param max_flows: the most flows to keep reassembly state for
+    :type max_flows: int
+    """
+    flow_fields = ['srcip', 'dstip', 'protocol', 'srcport', 'dstport']
+
+    def __init__(self, patterns=[], window=1024, max_flows=10000):
+        super(MultiRegexpQuery, self).__init__()
+        self.window = window
+        self.max_flows = max_flows
+        self.patterns = []          # compiled, by pattern id
+        self.fixed_width = []       # whether all matches have one length
+        self.pattern_callbacks = {} # pattern id -> callbacks
+        self.scanner = None
+        self.separate = []          # ids of the patterns not merged
+        self.scanner_stale = True
+        # flow -> (last window bytes, pattern id -> (offset, held), packet)
+        self.flows = OrderedDict()
+        for pattern in patterns:
+            self.add_pattern(pattern)
+
+    def add_pattern(self, pattern, callback=None):
+        """Add a pattern (a string or a compiled regular expression), and
+        return its id."""
+        if not isinstance(pattern, re._pattern_type):
+            pattern = re.compile(pattern, re.S)
+        pattern_id = len(self.patterns)
+        self.patterns.append(pattern)
+        (lo, hi) = sre_parse.parse(pattern.pattern, pattern.flags).getwidth()
+        self.fixed_width.append(lo == hi)
+        if callback is not None:
+            self.register_callback(callback, pattern_id)
+        self.scanner_stale = True
+        return pattern_id
+
+    def register_callback(self, fn, pattern_id=None):
+        if pattern_id is None:
+            self.callbacks.append(fn)
+        else:
+            self.pattern_callbacks.setdefault(pattern_id, []).append(fn)
+
+    @classmethod
+    def mergeable(cls, pattern):
+        return (pattern.flags & ~re.U == re.S and
+                not re.search(r'\(\?P=|\\[1-9]|\(\?[iLmsux]+\)',
+                              pattern.pattern))
+
+    def build_scanner(self):
+        """Merge the patterns that can be into one alternation. The patterns'
+        own groups lose their names, so that these can't clash."""
+        merged = []
+        self.separate = []
+        for (pattern_id, pattern) in enumerate(self.patterns):
+            if self.mergeable(pattern):
+                source = re.sub(r'\(\?P<\w+>', '(', pattern.pattern)
+                merged.append('(?:%s)' % source)
+            else:
+                self.separate.append(pattern_id)
+        self.scanner = None
+        if merged:
+            self.scanner = re.compile('|'.join(merged), re.S)
+        self.scanner_stale = False
+
+    def scan(self, data, start=0, offsets=None, final=True):
+        """The (pattern id, match) of the matches in data ending after start,
+        in order of position. Each pattern picks up at its (offset, held)
+        pair in `offsets`, if any, which is moved past the last match
+        reported: a held match starts at the offset, and is reported wherever
+        it ends. Unless final, a match reaching the end of data is held
+        rather than reported if its pattern can match longer strings."""
+        if self.scanner_stale:
+            self.build_scanner()
+        if offsets is None:
+            offsets = {}
+        separate = set(self.separate)
+        skip_merged = False
+        if self.scanner is not None:
+            lowest = min([offsets.get(i, (0, False))[0]
+                          for i in range(len(self.patterns))
+                          if not i in separate])
+            skip_merged = self.scanner.search(data, lowest) is None
+        hits = []
+        for (pattern_id, pattern) in enumerate(self.patterns):
+            if skip_merged and not pattern_id in separate:
+                continue
+            (offset, held) = offsets.get(pattern_id, (0, False))
+            for m in pattern.finditer(data, offset):
+                if m.start() == m.end():
+                    continue
+                if (not final and m.end() == len(data) and
+                    not self.fixed_width[pattern_id]):
+                    offsets[pattern_id] = (m.start(), True)
+                    break
+                offsets[pattern_id] = (m.end(), False)
+                if m.end() > start or (held and m.start() == offset):
+                    hits.append((m.start(), pattern_id, m))
+        hits.sort(key=lambda h: h[:2])
+        return [(pattern_id, m) for (_, pattern_id, m) in hits]
+
+    @classmethod
+    def transport_payload(cls, pkt):
+        """The TCP or UDP payload of pkt, if it has one, or else as much of
+        its raw data past the known headers as can be told apart."""
+        raw = pkt['raw']
+        try:
+            data = raw[pkt['header_len']:]
+            if pkt['ethtype'] != IP_TYPE:
+                return data
+            proto = ord(data[9])
+            transport = data[(ord(data[0]) & 0x0f) * 4:]
+            if proto == TCP_PROTO:
+                return transport[(ord(transport[12]) >> 4) * 4:]
+            elif proto == UDP_PROTO:
+                return transport[8:]
+            return transport
+        except (KeyError, IndexError):
+            return raw
+
+    def flow_of(self, pkt):
+        return tuple([pkt.header.get(f) for f in self.flow_fields])
+
+    def scan_packet(self, pkt):
+        """Scan pkt's payload after the data kept for its flow. Returns the
+        (packet, pattern id, match) of the matches to report, including those
+        held in flows evicted meanwhile."""
+        flow = self.flow_of(pkt)
+        (tail, offsets, _) = self.flows.pop(flow, ('', {}, None))
+        data = tail + self.transport_payload(pkt)
+        hits = [(pkt, pattern_id, m) for (pattern_id, m) in
+                self.scan(data, len(tail), offsets, final=self.window <= 0)]
+        if self.window > 0:
+            tail = data[-self.window:]
+            dropped = len(data) - len(tail)
+            offsets = dict([(k, (max(0, offset - dropped), held))
+                            for (k, (offset, held)) in offsets.items()])
+            self.flows[flow] = (tail, offsets, pkt)
+            while len(self.flows) > self.max_flows:
+                hits += self.flush_flow(self.flows.popitem(last=False)[1])
+        return hits
+
+    def flush_flow(self, state):
+        """The matches held in a flow's state, with its last packet."""
+        (tail, offsets, pkt) = state
+        if not [k for (k, (_, held)) in offsets.items() if held]:
+            return []
+        return [(pkt, pattern_id, m) for (pattern_id, m) in
+                self.scan(tail, len(tail), offsets)]
+
+    def report(self, hits):
+        for (pkt, pattern_id, m) in hits:
+            for callback in self.callbacks:
+                callback(pkt, pattern_id, m)
+            for callback in self.pattern_callbacks.get(pattern_id, []):
+                callback(pkt, m)
+
+    def apply(self):
+        with self.bucket_lock:
+            pkts = list(self.bucket)
+            self.bucket.clear()
+        for pkt in pkts:
+            self.report(self.scan_packet(pkt))
 
+    def flush(self):
+        """Report the matches held until more data comes in for their flows,
+        e.g., once the flows are over."""
+        hits = []
+        for state in self.flows.values():
+            hits += self.flush_flow(state)
+        self.report(hits)
 
+    def __repr__(self):
+        return "MultiRegexpQuery %s" % str(id(self))
@@ -29,7 +29,9 @@
 # for regular expressions.                                                     #
 ################################################################################
 
+import itertools
 import string
+import weakref
 try:
     import pyretic.vendor
     import pydot as dot
@@ -44,6 +46,35 @@ KEY_ALTER   = -4
 KEY_STAR    = -5
 KEY_INTERS  = -6
 KEY_NEGATE  = -7
+KEY_SYMBOL  = -8
+
+# Hash-consing of expression structure. Every expression carries an `ident`,
+# an integer shared by exactly the expressions that are structurally equal
+# (ignoring metadata), so equality is O(1). The table only holds a structure
+# while some expression refers to it, and idents are never reused, so that an
+# ident left over in a memo key never names another structure.
+class re_structure(object):
+    """ The interned structure shared by structurally equal expressions. """
+    def __init__(self, ident):
+        self.ident = ident
+
+re_structures = weakref.WeakValueDictionary()
+re_ident_counter = itertools.count()
+
+def intern_structure(key):
+    """ Return the structure for a structural key, allocating one if
+    needed. Expressions keep it alive by holding it. """
+    structure = re_structures.get(key)
+    if structure is None:
+        structure = re_structures.setdefault(
+            key, re_structure(next(re_ident_counter)))
+    return structure
+
+# Memo table for deriv: (ident, symbol) -> derivative. Derivatives only
+# depend on structure, so results are shared between structurally equal
+# expressions; use deriv_consumed where metadata matters.
+DERIV_MEMO_MAX = 200000
+deriv_memo = {}
 
 # Data type definitions
 # These are basic elements to be used by applications to construct regular
@@ -77,12 +108,21 @@ class re_deriv(object):
         class should override this method."""
         raise NotImplementedError
 
+    _hash = None
+
     def __hash__(self):
-        return hash(self.re_string_repr())
+        # Hash the string representation rather than the ident, so that the
+        # iteration order of state and transition tables (and hence the
+        # order of compiled path policies) does not depend on the order in
+        # which structures were interned. Computed once per node.
+        if self._hash is None:
+            self._hash = hash(self.re_string_repr())
+        return self._hash
 
     def __eq__(self, other):
-        """ Each child class should override this method. """
-        raise NotImplementedError
+        """ Structural equality, ignoring metadata. """
+        return (self is other or
+                (isinstance(other, re_deriv) and self.ident == other.ident))
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -142,12 +182,13 @@ class re_base(re_deriv):
 
 class re_epsilon(re_base):
     """ A regular expression that is equivalent to a zero-length string. """
+    structure = intern_structure((KEY_EPSILON,))
+    ident = structure.ident
+    null = True
+
     def __init__(self, metadata=None, lst=True):
         super(re_epsilon, self).__init__(metadata, lst)
 
-    def __eq__(self, other):
-        return isinstance(other, re_epsilon)
-
     def sort_key(self):
         return KEY_EPSILON
 
@@ -156,12 +197,13 @@ class re_epsilon(re_base):
 
 class re_empty(re_base):
     """ The null regular expression, which matches nothing. """
+    structure = intern_structure((KEY_EMPTY,))
+    ident = structure.ident
+    null = False
+
     def __init__(self, metadata=None, lst=True):
         super(re_empty, self).__init__(metadata, lst)
 
-    def __eq__(self, other):
-        return isinstance(other, re_empty)
-
     def sort_key(self):
         return KEY_EMPTY
 
@@ -170,13 +212,13 @@ class re_empty(re_base):
 
 class re_symbol(re_base):
     """ A symbol of the character set used by the regular language. """
+    null = False
+
     def __init__(self, char, metadata=None, lst=True):
         super(re_symbol, self).__init__(metadata, lst)
         self.char = char
-
-    def __eq__(self, other):
-        return (isinstance(other, re_symbol) and
-                other.char == self.char)
+        self.structure = intern_structure((KEY_SYMBOL, char))
+        self.ident = self.structure.ident
 
     def sort_key(self):
         return ord(self.char)
@@ -192,6 +234,9 @@ class re_combinator(re_deriv):
     simpler regular expressions. """
     def __init__(self, re_list):
         self.re_list = re_list
+        self.structure = intern_structure((self.sort_key(),
+                                           tuple(r.ident for r in re_list)))
+        self.ident = self.structure.ident
         super(re_combinator, self).__init__()
 
     def equals_meta_structural(self, other):
@@ -222,14 +267,9 @@ class re_concat(re_combinator):
     def __init__(self, re1, re2):
         self.re1 = re1
         self.re2 = re2
+        self.null = re1.null and re2.null
         super(re_concat, self).__init__([re1, re2])
 
-    def __eq__(self, other):
-        return (isinstance(other, re_concat) and
-                self.re1 == other.re1 and
-                self.re2 == other.re2 and
-                self.re_list == other.re_list)
-
     def sort_key(self):
         return KEY_CONCAT
 
@@ -244,12 +284,9 @@ class re_concat(re_combinator):
 class re_alter(re_combinator):
     """ Class for regular expressions with a topmost alternation operator. """
     def __init__(self, re_list):
+        self.null = any(r.null for r in re_list)
         super(re_alter, self).__init__(re_list)
 
-    def __eq__(self, other):
-        return (isinstance(other, re_alter) and
-                self.re_list == other.re_list)
-
     def sort_key(self):
         return KEY_ALTER
 
@@ -263,15 +300,12 @@ class re_alter(re_combinator):
 
 class re_star(re_combinator):
     """ Class for regular expressions with a topmost Kleene star operator. """
+    null = True
+
     def __init__(self, re):
         self.re = re
         super(re_star, self).__init__([re])
 
-    def __eq__(self, other):
-        return (isinstance(other, re_star) and
-                self.re == other.re and
-                self.re_list == other.re_list)
-
     def sort_key(self):
         return KEY_STAR
 
@@ -284,12 +318,9 @@ class re_star(re_combinator):
 class re_inters(re_combinator):
     """ Class for regular expressions with a topmost intersection operator. """
     def __init__(self, re_list):
+        self.null = all(r.null for r in re_list)
         super(re_inters, self).__init__(re_list)
 
-    def __eq__(self, other):
-        return (isinstance(other, re_inters) and
-                self.re_list == other.re_list)
-
     def sort_key(self):
         return KEY_INTERS
 
@@ -305,13 +336,9 @@ class re_negate(re_combinator):
     """ Class for regular expressions with a topmost negation operator. """
     def __init__(self, re):
         self.re = re
+        self.null = not re.null
         super(re_negate, self).__init__([re])
 
-    def __eq__(self, other):
-        return (isinstance(other, re_negate) and
-                self.re == other.re and
-                self.re_list == other.re_list)
-
     def sort_key(self):
         return KEY_NEGATE
 
@@ -324,45 +351,17 @@ class re_negate(re_combinator):
 # Nullable function
 def nullable(r):
     """ Return re_epsilon if a regular expression r is nullable, else
-    re_empty.
+    re_empty. Nullability is computed once, when r is constructed.
 
     :param r: the regex which is tested.
     :type r: re_deriv
     """
-    def bool_to_re(b):
-        return re_epsilon() if b else re_empty()
-    def re_to_bool(r):
-        if isinstance(r, re_epsilon):
-            return True
-        elif isinstance(r, re_empty):
-            return False
-        else:
-            raise TypeError('re_to_bool expects re_epsilon or re_empty')
-    
     assert isinstance(r, re_deriv)
-    if isinstance(r, re_epsilon):
-        return re_epsilon()
-    elif isinstance(r, re_symbol):
-        return re_empty()
-    elif isinstance(r, re_empty):
-        return re_empty()
-    elif isinstance(r, re_concat):
-        f = lambda x: re_to_bool(nullable(x))
-        return bool_to_re(f(r.re1) and f(r.re2))
-    elif isinstance(r, re_alter):
-        return bool_to_re(reduce(lambda acc, s: acc or re_to_bool(nullable(s)),
-                                 r.re_list,
-                                 False))
-    elif isinstance(r, re_star):
-        return re_epsilon()
-    elif isinstance(r, re_inters):
-        return bool_to_re(reduce(lambda acc, s: acc and re_to_bool(nullable(s)),
-                                 r.re_list,
-                                 True))
-    elif isinstance(r, re_negate):
-        return bool_to_re(not re_to_bool(nullable(r.re)))
-    else:
-        raise TypeError('unexpected type for nullable!')
+    return re_epsilon() if r.null else re_empty()
+
+def is_nullable(r):
+    """ Return True if a regular expression r accepts the empty string. """
+    return r.null
 
 # Smart constructors, which enforce some useful representation invariants in the regular
 # expressions they construct. In particular, the RE is flattened out as much as
@@ -607,31 +606,40 @@ def deriv(r, a):
     assert isinstance(r, re_deriv)
     assert isinstance(a, re_symbol)
     asym = a.char
+    key = (r.ident, asym)
+    try:
+        return deriv_memo[key]
+    except KeyError:
+        pass
     if isinstance(r, re_empty):
-        return re_empty()
+        d = re_empty()
     elif isinstance(r, re_epsilon):
-        return re_empty()
+        d = re_empty()
     elif isinstance(r, re_symbol):
         rsym = r.char
-        return re_epsilon() if rsym == asym else re_empty()
+        d = re_epsilon() if rsym == asym else re_empty()
     elif isinstance(r, re_star):
-        return smart_concat(deriv(r.re, a), smart_star(r.re))
+        d = smart_concat(deriv(r.re, a), smart_star(r.re))
     elif isinstance(r, re_negate):
-        return smart_negate(deriv(r.re, a))
+        d = smart_negate(deriv(r.re, a))
     elif isinstance(r, re_concat):
-        return smart_alter(
+        d = smart_alter(
             smart_concat(deriv(r.re1, a), r.re2),
             smart_concat(nullable(r.re1), deriv(r.re2, a)))
     elif isinstance(r, re_alter):
-        return foldl(lambda rs, s: smart_alter(rs, deriv(s, a)),
-                     r.re_list,
-                     re_empty())
+        d = foldl(lambda rs, s: smart_alter(rs, deriv(s, a)),
+                  r.re_list,
+                  re_empty())
     elif isinstance(r, re_inters):
-        return foldl(lambda rs, s: smart_inters(rs, deriv(s, a)),
-                     r.re_list,
-                     re_negate(re_empty()))
+        d = foldl(lambda rs, s: smart_inters(rs, deriv(s, a)),
+                  r.re_list,
+                  re_negate(re_empty()))
     else:
         raise TypeError('unknown type in deriv')
+    if len(deriv_memo) >= DERIV_MEMO_MAX:
+        deriv_memo.clear()
+    deriv_memo[key] = d
+    return d
 
 def deriv_consumed(r, a):
     """ A version of the derivative function that also returns the list of
@@ -663,7 +671,7 @@ def deriv_consumed(r, a):
         return (smart_alter(
             smart_concat(d1, r.re2),
             smart_concat(nullable(r.re1), d2)),
-                s1 + (s2 if nullable(r.re1) == re_epsilon() else []))
+                s1 + (s2 if is_nullable(r.re1) else []))
     elif isinstance(r, re_alter):
         dslist = map(lambda x: deriv_consumed(x, a), r.re_list)
         return (foldl(lambda rs, s: smart_alter(rs, s[0]),
@@ -698,7 +706,7 @@ def match_string(r, s):
     assert isinstance(r, re_deriv)
     assert isinstance(s, str)
     if len(s) == 0:
-        return True if nullable(r) == re_epsilon() else False
+        return is_nullable(r)
     else:
         a = re_symbol(s[0])
         return match_string(deriv(r, a), s[1:])
@@ -758,16 +766,16 @@ class dfa_transition_table(object):
     def contains_state(self, state):
         """ Return True if the DFA contains the argument state. """
         assert self.state_type_check_fun(state, self.state_type)
-        return state in self.re_to_transitions.keys()
+        return state in self.re_to_transitions
 
     def lookup_state_symbol(self, q, c):
         """ Lookup a transition from state `q` on symbol `c` """
         assert self.state_type_check_fun(q, self.state_type)
         assert self.symbol_type_check_fun(c, self.symbol_type)
-        if q in self.re_to_transitions.keys():
-            if c in self.re_to_transitions[q].keys():
-                return self.re_to_transitions[q][c]
-        return None
+        try:
+            return self.re_to_transitions[q][c]
+        except KeyError:
+            return None
 
     def dot_add_transitions_to_graph(self, g, re_map):
         """ Add transitions in this table to the pydot graph object provided
@@ -961,7 +969,7 @@ class re_state_table(dfa_state_table):
     """ A table of RE states in the DFA """
     def __init__(self, states=None, re_to_exp=None,
                  state_type=re_deriv, state_type_check_fun=isinstance,
-                 final_state_check_fun=lambda x: nullable(x) == re_epsilon(),
+                 final_state_check_fun=is_nullable,
                  dead_state_check_fun=lambda x: x == re_empty()):
         super(re_state_table, self).__init__(states,
                                              state_type,
@@ -1159,13 +1167,11 @@ def typecheck_goto(q, c, tt, states, alphabet_list,
                        alphabet_list))
             == len(alphabet_list))
 
-def goto(q, c, tt, states, alphabet_list):
-    """ Explore the state q on the transition through the symbol c, and update
-    the state transition table accordingly.
+def goto_step(q, c, tt, states):
+    """ Take the transition from state q on the symbol c, and update the state
+    transition table accordingly. Returns the destination state if it needs
+    to be explored (it is new, or gained new expressions), else None.
     """
-    typecheck_goto(q, c, tt, states, alphabet_list, re_deriv, isinstance,
-                   re_transition_table, re_state_table)
-
     sc = re_symbol(c)
     qc = deriv(q, sc)
     (exps, meta) = get_transition_exps_metadata(q, c, states)
@@ -1175,7 +1181,36 @@ def goto(q, c, tt, states, alphabet_list):
     tt.add_transition(q, c, qc)
     tt.add_metadata(q, c, meta)
     if added_exps: # true if new state, or new expressions on existing state.
-        explore(states, tt, qc, alphabet_list)
+        return qc
+    return None
+
+def explore_worklist(states, tt, q, alphabet_list, step):
+    """ Explore all states reachable from q, using an explicit stack instead of
+    one Python frame per discovered state. States and symbols are visited in
+    the same depth-first order as a recursive explore/goto would visit them,
+    so states get the same indices.
+
+    :param step: function (q, c, tt, states) -> state to explore, or None
+    """
+    stack = [(q, 0)]
+    num_symbols = len(alphabet_list)
+    while stack:
+        (q, i) = stack.pop()
+        if i < num_symbols:
+            stack.append((q, i+1))
+            qc = step(q, alphabet_list[i], tt, states)
+            if not qc is None:
+                stack.append((qc, 0))
+
+def goto(q, c, tt, states, alphabet_list):
+    """ Explore the state q on the transition through the symbol c, and update
+    the state transition table accordingly.
+    """
+    typecheck_goto(q, c, tt, states, alphabet_list, re_deriv, isinstance,
+                   re_transition_table, re_state_table)
+    qc = goto_step(q, c, tt, states)
+    if not qc is None:
+        explore_worklist(states, tt, qc, alphabet_list, goto_step)
 
 def typecheck_explore(states, tt, q, alphabet_list, state_table_type, tt_type,
                       state_type, state_type_check_fun):
@@ -1193,8 +1228,7 @@ def explore(states, tt, q, alphabet_list):
     """
     typecheck_explore(states, tt, q, alphabet_list, re_state_table,
                       re_transition_table, re_deriv, isinstance)
-    for symbol in alphabet_list:
-        goto(q, symbol, tt, states, alphabet_list)
+    explore_worklist(states, tt, q, alphabet_list, goto_step)
 
 def make_null_DFA():
     """ This is a "null" DFA, which is returned if there are no input regular
@@ -1232,8 +1266,7 @@ class re_vector_state_table(dfa_state_table):
         """ Class for table of states which are vectors of regular
         expressions. """
         def tuple_has_final_state(qtuple):
-            return reduce(lambda acc, x: acc or nullable(x) == re_epsilon(),
-                          qtuple, False)
+            return any(is_nullable(x) for x in qtuple)
 
         def tuple_is_dead_state(qtuple):
             return reduce(lambda acc, x: acc and x == re_empty(), qtuple, True)
@@ -1259,14 +1292,21 @@ class re_vector_state_table(dfa_state_table):
         ordinal_list = []
         for index in range(0, len(q)):
             qcomp = q[index]
-            if nullable(qcomp) == re_epsilon():
+            if is_nullable(qcomp):
                 ordinal_list.append(index)
         return ordinal_list
 
 class re_vector_transition_table(dfa_transition_table):
-    def __init__(self, component_dfas):
+    def __init__(self, re_list, alphabet_list, component_dfas=None):
         """ Transition table class when the states are vectors of regular
-        expressions. """
+        expressions.
+
+        The scalar DFA of each component expression in `re_list` is only
+        needed to look up transition metadata, so it is built the first time
+        it is asked for. `component_dfas` is a list with one (possibly None)
+        entry per component, and may be shared with other tables over the
+        same components.
+        """
         def symcheck(c, typ):
             return isinstance(c, typ) and len(c) == 1
         super(re_vector_transition_table, self).__init__(
@@ -1274,7 +1314,27 @@ class re_vector_transition_table(dfa_transition_table):
             list_isinstance,
             str,
             symcheck)
-        self.component_dfas = component_dfas
+        self.re_list = tuple_from_list(re_list)
+        self.alphabet_list = alphabet_list
+        if component_dfas is None:
+            component_dfas = [None] * len(self.re_list)
+        assert len(component_dfas) == len(self.re_list)
+        self.component_dfas_cache = component_dfas
+
+    def get_component_dfa(self, i):
+        """ Get the scalar DFA of the i'th component expression, building it if
+        it hasn't been built yet.
+        """
+        dfa = self.component_dfas_cache[i]
+        if dfa is None:
+            dfa = makeDFA(self.re_list[i], self.alphabet_list)
+            self.component_dfas_cache[i] = dfa
+        return dfa
+
+    @property
+    def component_dfas(self):
+        return tuple_from_list(map(self.get_component_dfa,
+                                   range(0, len(self.re_list))))
 
     def get_metadata(self, qvec, c):
         """ Get metadata on a vector transition using the scalar DFAs & their
@@ -1284,9 +1344,7 @@ class re_vector_transition_table(dfa_transition_table):
         meta_list = []
         for i in range(0, len(qvec)):
             q = qvec[i]
-            dfa = self.component_dfas[i]
-            states = dfa.all_states
-            tt = dfa.transition_table
+            tt = self.get_component_dfa(i).transition_table
             meta_list.append(tt.get_metadata(q, c))
         return tuple_from_list(meta_list)
 
@@ -1313,21 +1371,30 @@ def deriv_vector(r, a):
         s.append(deriv(exp, a))
     return tuple_from_list(s)
 
-def goto_vector(q, c, tt, states, alphabet_list):
-    """ Explore the (vector) state q on the transition through the symbol c, and
-    update the (vector) state transition table accordingly.
+def goto_vector_step(q, c, tt, states):
+    """ Take the transition from (vector) state q on the symbol c, and update
+    the (vector) state transition table accordingly. Returns the destination
+    state if it is new, else None.
     """
-    typecheck_goto(q, c, tt, states, alphabet_list, re_deriv, list_isinstance,
-                   re_vector_transition_table, re_vector_state_table)
-
     sc = re_symbol(c)
     qc = deriv_vector(q, sc)
     if states.contains_state(qc):
         tt.add_transition(q, c, qc)
+        return None
     else:
         states.add_state(qc)
         tt.add_transition(q, c, qc)
-        explore_vector(states, tt, qc, alphabet_list)
+        return qc
+
+def goto_vector(q, c, tt, states, alphabet_list):
+    """ Explore the (vector) state q on the transition through the symbol c, and
+    update the (vector) state transition table accordingly.
+    """
+    typecheck_goto(q, c, tt, states, alphabet_list, re_deriv, list_isinstance,
+                   re_vector_transition_table, re_vector_state_table)
+    qc = goto_vector_step(q, c, tt, states)
+    if not qc is None:
+        explore_worklist(states, tt, qc, alphabet_list, goto_vector_step)
 
 def explore_vector(states, tt, q, alphabet_list):
     """ Explore all the transitions through any symbol in alphabet_list on the
@@ -1335,19 +1402,109 @@ def explore_vector(states, tt, q, alphabet_list):
     """
     typecheck_explore(states, tt, q, alphabet_list, re_vector_state_table,
                       re_vector_transition_table, re_deriv, list_isinstance)
-    for symbol in alphabet_list:
-        goto_vector(q, symbol, tt, states, alphabet_list)
+    explore_worklist(states, tt, q, alphabet_list, goto_vector_step)
 
 def makeDFA_vector(re_list, alphabet_list):
     """ Make a DFA from a list of regular expressions `re_list`. """
     assert list_isinstance(re_list, re_deriv)
     if len(re_list) == 0:
         return make_null_DFA()
-    component_dfas = tuple_from_list(map(lambda x: makeDFA(x, alphabet_list),
-                                         re_list))
     q0 = tuple_from_list(re_list)
-    tt = re_vector_transition_table(component_dfas)
+    tt = re_vector_transition_table(re_list, alphabet_list)
     states = re_vector_state_table([q0])
     explore_vector(states, tt, q0, alphabet_list)
     f = states.get_final_states()
     return re_vector_dfa(states, q0, f, tt, alphabet_list)
+
+def minimizeDFA_vector(dfa):
+    """ Minimize a vector DFA with Hopcroft's partition refinement algorithm.
+    Two states are only merged if they accept the same strings for every
+    component expression, i.e., the initial partition separates states by
+    their list of accepting ordinals. Each block of equivalent states is
+    represented by one of its original states (the dead state, if it is in
+    the block, and else the earliest-numbered one), and blocks are numbered
+    in order of their earliest member, so the initial state keeps index 0.
+
+    Any DFA that is not a re_vector_dfa is returned unchanged.
+    """
+    if not isinstance(dfa, re_vector_dfa):
+        return dfa
+    all_states = dfa.all_states
+    states = all_states.state_list
+    index = all_states.re_map
+    n = len(states)
+    symbols = list(dfa.symbol_list)
+    transitions = dfa.transition_table.get_transitions()
+
+    # inverse transition function: symbol -> dst index -> src indices
+    inverse = dict((c, [[] for i in range(n)]) for c in symbols)
+    for (q, r, c) in transitions:
+        inverse[c][index[r]].append(index[q])
+
+    # initial partition, by the expressions each state accepts
+    by_ordinals = {}
+    for i in range(n):
+        ords = tuple(all_states.get_accepting_exps_ordinal(states[i]))
+        by_ordinals.setdefault(ords, []).append(i)
+    blocks = sorted([set(b) for b in by_ordinals.values()], key=min)
+    block_of = [0] * n
+    for b in range(len(blocks)):
+        for i in blocks[b]:
+            block_of[i] = b
+
+    # refinement
+    worklist = range(len(blocks))
+    in_worklist = set(worklist)
+    while worklist:
+        splitter = worklist.pop()
+        in_worklist.discard(splitter)
+        for c in symbols:
+            preds = set()
+            for i in blocks[splitter]:
+                preds.update(inverse[c][i])
+            touched = {}
+            for i in preds:
+                touched.setdefault(block_of[i], []).append(i)
+            for (b, members) in touched.items():
+                if len(members) == len(blocks[b]):
+                    continue
+                new_block = set(members)
+                blocks[b] -= new_block
+                nb = len(blocks)
+                blocks.append(new_block)
+                for i in new_block:
+                    block_of[i] = nb
+                if b in in_worklist or len(new_block) <= len(blocks[b]):
+                    worklist.append(nb)
+                    in_worklist.add(nb)
+                else:
+                    worklist.append(b)
+                    in_worklist.add(b)
+
+    if len(blocks) == n:
+        return dfa
+
+    # build the quotient automaton out of block representatives
+    dead = all_states.get_dead_state()
+    def representative(block):
+        if not dead is None and index[dead] in block:
+            return states[index[dead]]
+        return states[min(block)]
+    ordered = sorted(blocks, key=min)
+    rep_of_block = {}
+    new_states = re_vector_state_table()
+    for block in ordered:
+        rep = representative(block)
+        new_states.add_state(rep)
+        for i in block:
+            rep_of_block[i] = rep
+    old_tt = dfa.transition_table
+    tt = re_vector_transition_table(old_tt.re_list, old_tt.alphabet_list,
+                                    old_tt.component_dfas_cache)
+    for (q, r, c) in transitions:
+        rq = rep_of_block[index[q]]
+        if rq == q:
+            tt.add_transition(q, c, rep_of_block[index[r]])
+    q0 = rep_of_block[index[dfa.init_state]]
+    f = new_states.get_final_states()
+    return re_vector_dfa(new_states, q0, f, tt, dfa.symbol_list)
@@ -0,0 +1,214 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+# Offline hop-by-hop simulation of a compiled policy over a topology, used to #
+# test and benchmark path queries without a network.                          #
+################################################################################
+
+from pyretic.core import util
+from pyretic.core.language import Controller, Query, identity, match, modify
+from pyretic.core.packet import Packet
+from pyretic.core.runtime import virtual_field
+
+import logging
+
+class trajectory_result(object):
+    """ What the simulator saw of a single input packet.
+
+    `paths` lists the packet's trajectories, in the format of PathBucket: the
+    located packets at each switch ingress, followed by the packet at network
+    egress. `captures` lists (packet, query) pairs of the packets sent to
+    buckets or the controller, located at the switch that sent them.
+    `truncated` is set if the hop limit cut some trajectory short.
+    """
+    def __init__(self):
+        self.paths = []
+        self.captures = []
+        self.truncated = False
+
+    def get_tags(self, path):
+        """ The path tag carried by the packet at each hop of `path`. """
+        return [virtual_field.expand(p.header).get('path_tag') for p in path]
+
+    def __repr__(self):
+        return "trajectory_result: %d paths, %d captures%s" % (
+            len(self.paths), len(self.captures),
+            ' (truncated)' if self.truncated else '')
+
+class simulator(object):
+    """ Simulates the forwarding of batches of packets by a compiled policy.
+
+    The classifier is split into per-switch tables, with each rule's match
+    turned into a list of field tests. Packets move through the network one
+    hop at a time for the whole batch at once: all branches at the same
+    located header share a single table lookup, and lookups are memoized
+    across hops and batches, so the cost grows with the number of distinct
+    headers rather than the number of packets.
+
+    :param classifier: compiled network policy, e.g., from policy.compile()
+    :type classifier: Classifier
+    :param topology: the network topology
+    :type topology: Topology
+    :param max_hops: longest trajectory to follow
+    :type max_hops: int
+    """
+    log = logging.getLogger('%s.simulator' % __name__)
+
+    def __init__(self, classifier, topology, max_hops=64):
+        self.classifier = classifier
+        self.max_hops = max_hops
+        self.links = {}
+        for (s1, s2, ports) in topology.edges(data=True):
+            self.links[(s1, ports[s1])] = (s2, ports[s2])
+            self.links[(s2, ports[s2])] = (s1, ports[s1])
+        self.egresses = set((l.switch, l.port_no)
+                            for l in topology.egress_locations())
+        self.tables = {}
+        self.step_cache = {}
+
+    @classmethod
+    def compile_match(cls, m):
+        """ Turn a match into a list of (field, pattern, is_prefix) tests,
+        leaving out the switch, which the per-switch tables take care of. """
+        if not isinstance(m, match):
+            return []
+        return [(f, p, f in ['srcip', 'dstip'])
+                for (f, p) in m.map.iteritems() if f != 'switch']
+
+    @classmethod
+    def eval_tests(cls, tests, header):
+        """ Same semantics as match.eval, on a header dictionary. """
+        for (f, pattern, is_prefix) in tests:
+            if not f in header:
+                if pattern is not None:
+                    return False
+                continue
+            v = header[f]
+            if pattern is None:
+                return False
+            if is_prefix:
+                if not util.string_to_IP(str(v)) in pattern:
+                    return False
+            elif pattern != v:
+                return False
+        return True
+
+    def get_table(self, switch):
+        """ The rules of the classifier that may apply at `switch`, in order,
+        with their matches compiled. """
+        try:
+            return self.tables[switch]
+        except KeyError:
+            table = []
+            for rule in self.classifier.rules:
+                m = rule.match
+                if (isinstance(m, match) and 'switch' in m.map and
+                    m.map['switch'] != switch):
+                    continue
+                table.append((self.compile_match(m), rule.actions))
+            self.tables[switch] = table
+            return table
+
+    def step(self, pkt):
+        """ Apply the table of the packet's switch to a located packet.
+        Returns the triple (captured, moved, egressed) of queries the packet is
+        sent to, packets at the next switch ingresses, and packets leaving the
+        network. Memoized per packet.
+        """
+        try:
+            return self.step_cache[pkt]
+        except KeyError:
+            pass
+        captured = []
+        moved = []
+        egressed = []
+        header = pkt.header
+        for (tests, actions) in self.get_table(header['switch']):
+            if not self.eval_tests(tests, header):
+                continue
+            for act in actions:
+                if act is Controller or isinstance(act, Query):
+                    captured.append(act)
+                    continue
+                if isinstance(act, modify):
+                    outs = [pkt.modifymany(act.map)]
+                elif act is identity:
+                    outs = [pkt]
+                else:
+                    outs = act.eval(pkt)
+                for out in outs:
+                    loc = (out.header['switch'], out.header.get('outport'))
+                    if loc in self.links:
+                        (s, p) = self.links[loc]
+                        moved.append(out.modifymany({'switch': s,
+                                                     'inport': p,
+                                                     'outport': None}))
+                    elif loc in self.egresses:
+                        egressed.append(out)
+            break
+        res = (captured, moved, egressed)
+        self.step_cache[pkt] = res
+        return res
+
+    def run(self, fields, batch):
+        """ Simulate a batch of packets.
+
+        :param fields: header names, which must include switch and inport
+        :type fields: list string
+        :param batch: header values of each packet, in the order of `fields`
+        :type batch: list tuple
+        :returns: one result per packet, in batch order
+        :rtype: list trajectory_result
+        """
+        results = [trajectory_result() for _ in batch]
+        # branches: (result index, path so far, current located packet)
+        frontier = [(i, [], Packet(dict(zip(fields, values))))
+                    for (i, values) in enumerate(batch)]
+        hops = 0
+        while frontier:
+            groups = {}
+            for (i, prefix, pkt) in frontier:
+                groups.setdefault(pkt, []).append((i, prefix))
+            frontier = []
+            for (pkt, branches) in groups.iteritems():
+                (captured, moved, egressed) = self.step(pkt)
+                for (i, prefix) in branches:
+                    res = results[i]
+                    path = prefix + [pkt]
+                    for q in captured:
+                        res.captures.append((pkt, q))
+                    for out in egressed:
+                        res.paths.append(path + [out])
+                    if moved and hops >= self.max_hops:
+                        res.truncated = True
+                        continue
+                    for out in moved:
+                        frontier.append((i, path, out))
+            hops += 1
+        if any(res.truncated for res in results):
+            self.log.warning('simulated trajectories truncated at %d hops' %
+                             self.max_hops)
+        return results
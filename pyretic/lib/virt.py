@@ -150,7 +150,7 @@ class vmap(object):
 
     def shortest_path_fabric_policy(self,topo):
         fabric_policy = drop
-        paths = Topology.all_pairs_shortest_path(topo)
+        routing = topo.routing()
         # ITERATE THROUGH ALL PAIRS OF VIRTUAL PORTS
         for (d1,[u1]) in self.d2u.items():
             for (d2,[u2]) in self.d2u.items():
@@ -169,7 +169,7 @@ class vmap(object):
                 # FINALLY ADD A RULE THAT FORWARDS OUT THE CORRECT PHYSICAL PORT AT THE LAST PHYSICAL SWITCH ON THE PATH
                 else:
                     try:
-                        for loc in paths[u1.switch][u2.switch]:
+                        for loc in routing.path(u1.switch,u2.switch):
                             fabric_policy += (match(vswitch=d1.switch,
                                                     vinport=d1.port_no,
                                                     voutport=d2.port_no,
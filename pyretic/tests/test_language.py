@@ -473,6 +473,37 @@ def test_flood_compilation():
         Rule(match(switch='s1'), [modify(outport=1), modify(outport=2)]),
         Rule(identity, [drop]) ]
 
+def test_flood_incremental_update():
+    topo = Topology()
+    for s in [1, 2, 3]:
+        topo.add_switch(s)
+        for p in [1, 2, 3]:
+            topo.add_port(s, p, True, True)
+    topo.add_link(Location(1, 3), Location(2, 2))
+    topo.add_link(Location(2, 3), Location(3, 2))
+    pol = flood()
+    pol.set_network(FakeNetwork(topo))
+    pol.compile()
+    fragments = dict(pol.fragments)
+    top = pol.policy
+
+    topo.add_port(3, 4, True, True)
+    pol.set_network(FakeNetwork(topo))
+    # only switch 3's fragment is recompiled
+    assert pol.policy is top
+    assert pol.fragments == fragments
+    assert fragments[1]._classifier is not None
+    assert fragments[3]._classifier is None
+
+    fresh = flood()
+    fresh.set_network(FakeNetwork(topo))
+    rules = pol.compile().rules
+    fresh_rules = fresh.compile().rules
+    assert len(rules) == len(fresh_rules)
+    for (r1, r2) in zip(rules, fresh_rules):
+        assert r1.match == r2.match
+        assert sorted(map(repr, r1.actions)) == sorted(map(repr, r2.actions))
+
 # Optimization
 
 def test_remove_shadow_cover_single():
@@ -490,3 +521,54 @@ def test_optimize_bug_1():
     print 'classifier.optimize():'
     print classifier.optimize()
     assert classifier == classifier.optimize()
+
+# Path buckets
+
+def two_switch_path_bucket(fwding, **kwargs):
+    """ Switches 1 and 2 linked on ports 1.2 <-> 2.1, hosts on 1.1 and 2.2. """
+    topo = ((match(switch=1,outport=2) >>
+             modify(switch=2,inport=1,outport=None)) +
+            (match(switch=2,outport=1) >>
+             modify(switch=1,inport=2,outport=None)))
+    egress = match(switch=1,outport=1) + match(switch=2,outport=2)
+    version = [0]
+    pb = PathBucket(**kwargs)
+    pb.set_topology_policy_fun(lambda: topo)
+    pb.set_fwding_policy_fun(lambda: fwding)
+    pb.set_egress_policy_fun(lambda: egress)
+    pb.set_policy_version_fun(lambda: version[0])
+    return (pb, version)
+
+def test_path_bucket_trajectories():
+    fwding = ((match(switch=1,inport=1) >> modify(outport=2)) +
+              (match(switch=2,inport=1) >> modify(outport=2)))
+    (pb, version) = two_switch_path_bucket(fwding)
+    pkt = Packet({'switch': 1, 'inport': 1, 'srcip': '10.0.0.1', 'raw': 'a'})
+    paths = pb.get_trajectories(pkt)
+    at_2 = pkt.modify(switch=2, inport=1)
+    assert paths == [[pkt, at_2, at_2.modify(outport=2)]]
+    assert not pb.truncated
+    # the transfer function is memoized regardless of the payload
+    cached = len(pb.transfer_cache)
+    other = pkt.modify(raw='b')
+    other_paths = pb.get_trajectories(other)
+    assert len(pb.transfer_cache) == cached
+    assert [p['raw'] for p in other_paths[0]] == ['b', 'b', 'b']
+    # ... until the policy changes
+    version[0] += 1
+    pb.get_trajectories(pkt)
+    assert pb.transfer_key[1] == 1
+
+def test_path_bucket_limits():
+    # switches bounce every packet back and forth, besides egressing it
+    fwding = ((match(switch=1) >> (modify(outport=1) + modify(outport=2))) +
+              (match(switch=2) >> (modify(outport=1) + modify(outport=2))))
+    (pb, _) = two_switch_path_bucket(fwding, max_hops=5, max_paths=100)
+    pkt = Packet({'switch': 1, 'inport': 1, 'raw': ''})
+    paths = pb.get_trajectories(pkt)
+    assert pb.truncated
+    assert len(paths) == 5
+    assert max(map(len, paths)) == 6
+    (pb, _) = two_switch_path_bucket(fwding, max_hops=50, max_paths=3)
+    assert len(pb.get_trajectories(pkt)) == 3
+    assert pb.truncated
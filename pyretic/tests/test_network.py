@@ -0,0 +1,306 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.network import *
+
+import pytest
+
+def line_topology(n):
+    """ Switches 1..n, each with host port 1, linked in a line on ports 2/3. """
+    topo = Topology()
+    for s in range(1, n+1):
+        topo.add_switch(s)
+        for p in [1, 2, 3]:
+            topo.add_port(s, p, True, True, [])
+    for s in range(1, n):
+        topo.add_link(Location(s, 3), Location(s+1, 2))
+    return topo
+
+### Topology change detection ###
+
+def test_topology_copy_equality():
+    t1 = line_topology(4)
+    t2 = t1.copy()
+    assert t1 == t2
+    assert not t1 != t2
+    assert t1.fingerprint() == t2.fingerprint()
+
+def test_topology_version_bumps():
+    t = line_topology(2)
+    v = t.version
+    f = t.fingerprint()
+    assert t.fingerprint() is f
+    t.add_port(1, 4, True, True, [])
+    assert t.version == v + 1
+    assert t.fingerprint() != f
+    t.add_switch(3)
+    assert t.version == v + 2
+
+def test_topology_port_status_change():
+    t1 = line_topology(3)
+    t2 = t1.copy()
+    t2.update_port(2, 1, config=False, status=False)
+    assert t1 != t2
+
+def test_topology_link_change():
+    t1 = line_topology(3)
+    t2 = t1.copy()
+    t2.remove_edge(1, 2)
+    t2.update_port(1, 3, linked_to=None)
+    t2.update_port(2, 2, linked_to=None)
+    assert t1 != t2
+    assert t1 != line_topology(4)
+    assert t1 == line_topology(3)
+
+def test_topology_egress_unaffected_by_fingerprint():
+    t = line_topology(3)
+    t.fingerprint()
+    assert t.egress_locations() == set([Location(s, 1) for s in [1, 2, 3]] +
+                                       [Location(1, 2), Location(3, 3)])
+
+### Debounced topology updates ###
+
+import time
+from pyretic.core.runtime import ConcreteNetwork
+
+class FakeRuntime(object):
+    def __init__(self):
+        self.changes = 0
+    def handle_network_change(self):
+        self.changes += 1
+
+def wait_for_updates(network, n, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if network.get_update_stats()['updates_applied'] >= n:
+            return
+        time.sleep(0.01)
+
+def test_queue_update_coalesces_burst():
+    runtime = FakeRuntime()
+    network = ConcreteNetwork(runtime, wait_period=0.1, max_wait_period=5.0)
+    for i in range(50):
+        network.queue_update()
+    wait_for_updates(network, 1)
+    time.sleep(0.2)
+    stats = network.get_update_stats()
+    assert runtime.changes == 1
+    assert stats['events_queued'] == 50
+    assert stats['updates_applied'] == 1
+    assert stats['last_events_absorbed'] == 50
+    assert stats['mean_events_absorbed'] == 50.0
+
+def test_queue_update_max_latency():
+    runtime = FakeRuntime()
+    network = ConcreteNetwork(runtime, wait_period=0.1, max_wait_period=0.2)
+    end = time.time() + 0.5
+    while time.time() < end:
+        network.queue_update()
+        time.sleep(0.02)
+    # a steady trickle of events must not postpone updates forever
+    assert network.get_update_stats()['updates_applied'] >= 1
+    wait_for_updates(network, runtime.changes + 1)
+    assert network.get_update_stats()['pending_events'] == 0
+
+class FailingRuntime(FakeRuntime):
+    def handle_network_change(self):
+        super(FailingRuntime, self).handle_network_change()
+        if self.changes == 1:
+            raise RuntimeError("failed update")
+
+def test_debouncer_survives_failed_update():
+    runtime = FailingRuntime()
+    network = ConcreteNetwork(runtime, wait_period=0.05, max_wait_period=1.0)
+    network.queue_update()
+    wait_for_updates(network, 1)
+    time.sleep(0.1)
+    network.queue_update()
+    wait_for_updates(network, 2)
+    time.sleep(0.1)
+    assert runtime.changes == 2
+
+### Incremental spanning tree ###
+
+def ring_topology(n):
+    topo = line_topology(n)
+    topo.add_link(Location(n, 3), Location(1, 2))
+    return topo
+
+def check_spanning(tree, topo):
+    tree_links = set(SpanningTree.link_key(s1, s2)
+                     for s1 in tree.tree for s2 in tree.tree[s1])
+    assert len(tree_links) == len(topo.nodes()) - 1
+    assert tree.tree_component(topo.nodes()[0]) == set(topo.nodes())
+    return tree_links
+
+def test_spanning_tree_ring():
+    topo = ring_topology(4)
+    tree = SpanningTree()
+    assert tree.update(topo) == set([1, 2, 3, 4])
+    links = check_spanning(tree, topo)
+    # exactly one ring link is left out, pruning one port on each end
+    assert sum(len(p) for p in tree.switch_ports.values()) == 4*3 - 2
+    assert tree.update(topo) == set()
+
+    # cutting a tree link makes the spare ring link take over
+    (s1, s2) = sorted(links)[0]
+    topo.remove_edge(s1, s2)
+    topo.mark_changed()
+    changed = tree.update(topo)
+    check_spanning(tree, topo)
+    assert changed <= set([1, 2, 3, 4])
+    assert all(len(p) == 3 for p in tree.switch_ports.values())
+
+def test_spanning_tree_host_port_change():
+    topo = line_topology(3)
+    tree = SpanningTree()
+    tree.update(topo)
+    topo.add_port(3, 4, True, True, [])
+    assert tree.update(topo) == set([3])
+    assert tree.switch_ports[3] == frozenset([1, 2, 3, 4])
+
+def test_spanning_tree_switch_removal():
+    topo = ring_topology(4)
+    tree = SpanningTree()
+    tree.update(topo)
+    topo.remove_node(2)
+    topo.mark_changed()
+    changed = tree.update(topo)
+    assert 2 in changed
+    assert not 2 in tree.switch_ports
+    check_spanning(tree, topo)
+
+### Routing cache ###
+
+def test_routing_matches_all_pairs_shortest_path():
+    topo = ring_topology(5)
+    paths = Topology.all_pairs_shortest_path(topo)
+    routing = topo.routing()
+    for s1 in topo.nodes():
+        for s2 in topo.nodes():
+            assert len(routing.path(s1, s2)) == len(paths[s1][s2])
+    assert routing.path(1, 3) == [Location(1, 3), Location(2, 3)]
+    assert routing.next_hop(1, 3) == 3
+    assert routing.next_hop(3, 3) is None
+    assert routing.next_hop_table(1) == {2: 2, 3: 2, 4: 3, 5: 3}
+
+def test_routing_incremental_invalidation():
+    topo = line_topology(4)
+    routing = topo.routing()
+    for dst in topo.nodes():
+        routing.tree(dst)
+    assert routing.trees_computed == 4
+
+    # a new host port leaves every tree alone
+    topo.add_port(4, 4, True, True, [])
+    assert topo.routing() is routing
+    assert len(routing.trees) == 4
+
+    # closing the ring can only shorten paths to/from the far ends
+    topo.add_link(Location(4, 4), Location(1, 1))
+    topo.routing()
+    assert set(routing.trees) == set([2, 3])
+    assert routing.path(4, 1) == [Location(4, 4)]
+
+    topo.remove_edge(4, 1)
+    topo.update_port(4, 4, linked_to=None)
+    topo.update_port(1, 1, linked_to=None)
+    assert len(topo.routing().path(4, 1)) == 3
+
+def test_routing_survives_copy():
+    topo = line_topology(3)
+    routing = topo.routing()
+    routing.tree(1)
+    copied = topo.copy()
+    copied_routing = copied.routing()
+    assert not copied_routing is routing
+    assert copied_routing.tree(1) is routing.tree(1)
+    with pytest.raises(KeyError):
+        copied_routing.path(1, 7)
+
+### Copy-on-write snapshots ###
+
+def test_copy_shares_untouched_switches():
+    t1 = line_topology(4)
+    t2 = t1.copy()
+    assert t2.node[1] is t1.node[1]
+    t2.update_port(2, 1, config=False, status=False)
+    # only the touched switch was copied, and the original is unchanged
+    assert not t2.node[2] is t1.node[2]
+    assert t2.node[1] is t1.node[1]
+    assert t1.node[2]['ports'][1].config
+    assert not t2.node[2]['ports'][1].config
+
+def test_copy_on_write_links():
+    t1 = line_topology(3)
+    t2 = t1.copy()
+    t2.remove_edge(2, 3)
+    t2.update_port(2, 3, linked_to=None)
+    t2.update_port(3, 2, linked_to=None)
+    assert t1.has_edge(2, 3)
+    assert t1.node[2]['ports'][3].linked_to == Location(3, 2)
+    assert t1 == line_topology(3)
+    t1.add_edge(1, 2, {1: 3, 2: 2, 'type': 'x'})
+    assert not 'type' in t2[1][2]
+    t3 = t2.copy()
+    t3.remove_node(1)
+    assert t2.has_edge(1, 2)
+    assert sorted(t2.nodes()) == [1, 2, 3]
+
+def test_snapshot_is_read_only():
+    t1 = line_topology(2)
+    snap = t1.snapshot()
+    assert snap.snapshot() is snap
+    with pytest.raises(RuntimeError):
+        snap.add_port(1, 4, True, True)
+    with pytest.raises(RuntimeError):
+        snap.remove_edge(1, 2)
+    t1.add_port(1, 4, True, True)
+    assert not 4 in snap.node[1]['ports']
+    t2 = snap.copy()
+    t2.add_port(1, 4, True, True)
+    assert t2 == t1
+
+def test_network_copy_is_snapshot():
+    network = Network(line_topology(2).snapshot())
+    copied = network.copy()
+    assert copied.topology is network.topology
+    assert copied == network
+
+def test_filter_out_nodes_leaves_original():
+    t1 = line_topology(3)
+    filtered = t1.filter_out_nodes([3])
+    assert filtered.node[2]['ports'][3].linked_to is None
+    assert t1.node[2]['ports'][3].linked_to == Location(3, 2)
+
+def test_conversion_leaves_source_copy_on_write():
+    t1 = line_topology(3)
+    t2 = Topology(t1)
+    t1.update_port(2, 1, config=False, status=False)
+    assert t2.node[2]['ports'][1].config
+    t2.update_port(1, 1, config=False, status=False)
+    assert t1.node[1]['ports'][1].config
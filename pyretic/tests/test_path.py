@@ -587,6 +587,178 @@ def test_in_out_compile_2():
     # assert out_tag._classifier == ref_out_tag._classifier
     assert out_cap._classifier == ref_out_cap._classifier
 
+def test_path_compile_incremental():
+    in_cg.clear()
+    out_cg.clear()
+    pathcomp.invalidate()
+    a1 = atom(match(srcip=ip1))
+    a2 = atom(match(dstip=ip2))
+    pathcomp.compile(a1)
+    gens = (in_cg.generation, out_cg.generation)
+    pols = pathcomp.compile(a1 + a2)
+    # adding a path policy extends the existing predicate partition
+    assert (in_cg.generation, out_cg.generation) == gens
+    # nothing changed: the same policies come back
+    for (x, y) in zip(pols, pathcomp.compile(a1 + a2)):
+        assert x is y
+    # ... and the result is the same as compiling from scratch
+    pathcomp.invalidate()
+    ref_pols = pathcomp.compile(a1 + a2)
+    assert (in_cg.generation, out_cg.generation) != gens
+    assert pols == ref_pols
+    # removing a path policy rebuilds the partition
+    gens = (in_cg.generation, out_cg.generation)
+    pathcomp.compile(a2)
+    assert (in_cg.generation, out_cg.generation) != gens
+    assert in_cg.pred_to_symbol.keys() == [match(dstip=ip2)]
+
+def test_path_compile_capture_serials():
+    in_cg.clear()
+    out_cg.clear()
+    pathcomp.invalidate()
+    a1 = atom(match(srcip=ip1))
+    fb1 = FwdBucket()
+    p1 = path_policy(a1, fb1)
+    pols = pathcomp.compile(p1)
+    serial = pathcomp.capture_serials[id(fb1)][1]
+    # the same captured policy keeps its serial, and its fragments
+    for (x, y) in zip(pols, pathcomp.compile(p1)):
+        assert x is y
+    assert pathcomp.capture_serials[id(fb1)] == (fb1, serial)
+    # another one gets a fresh serial, even if it comes to have the same id()
+    fb2 = FwdBucket()
+    pathcomp.compile(path_policy(a1, fb2))
+    assert pathcomp.capture_serials.keys() == [id(fb2)]
+    assert pathcomp.capture_serials[id(fb2)][1] != serial
+
+def test_path_compile_stats_and_dumps(tmpdir):
+    in_cg.clear()
+    out_cg.clear()
+    stats = []
+    dot_file = str(tmpdir.join('regexes.dot'))
+    old = (du.dot_file, du.symbols_file, du.stats_hook)
+    du.dot_file = dot_file
+    du.symbols_file = str(tmpdir.join('symbols.txt'))
+    du.stats_hook = stats.append
+    try:
+        a1 = atom(match(srcip=ip1))
+        pathcomp.compile(a1)
+        # no diagnostics are written out unless asked for
+        assert not tmpdir.join('regexes.dot').check()
+        assert len(stats) == 1
+        assert stats[0] == du.last_stats
+        assert stats[0]['expressions'] == 1
+        assert stats[0]['states'] == 4
+        assert stats[0]['transitions'] == 4 * stats[0]['symbols']
+        assert stats[0]['build_time'] >= 0
+        du.debug_dump = True
+        pathcomp.invalidate()
+        pathcomp.compile(a1)
+        assert tmpdir.join('regexes.dot').check()
+        assert tmpdir.join('symbols.txt').check()
+    finally:
+        du.debug_dump = False
+        (du.dot_file, du.symbols_file, du.stats_hook) = old
+
+@pytest.fixture
+def virtual_fields():
+    """ Restore the virtual fields, their layout and their encoding after a
+    test. """
+    from pyretic.core.runtime import virtual_field, tag_encoding
+    old = (copy.copy(virtual_field.fields), virtual_field.layout,
+           tag_encoding.current, tag_encoding.version)
+    yield
+    virtual_field.fields.clear()
+    virtual_field.fields.update(old[0])
+    virtual_field.layout = old[1]
+    (tag_encoding.current, tag_encoding.version) = old[2:]
+    pathcomp.invalidate()
+
+def test_path_tag_encoding():
+    from pyretic.core.runtime import virtual_field, tag_encoding
+    old = (copy.copy(virtual_field.fields), tag_encoding.current,
+           tag_encoding.version, virtual_field.layout)
+    try:
+        virtual_field.fields.clear()
+        virtual_field(name="acl", values=["permit", "deny"])
+        pathcomp.init(1022)
+        # the densest encoding fits everything into the vlan id
+        assert tag_encoding.headers() == ['vlan_id']
+        vlan = virtual_field.map_to_vlan(
+            virtual_field.compress({'acl': 'deny', 'path_tag': 7}))
+        assert vlan == {'vlan_id': 2 + 3 * 8}
+        assert virtual_field.expand(vlan) == {'acl': 'deny', 'path_tag': 7}
+        # a DFA too large for the vlan id spills over into the vlan pcp
+        version = tag_encoding.version
+        pathcomp.__reserve_tags__(5000)
+        assert tag_encoding.version == version + 1
+        assert tag_encoding.headers() == ['vlan_id', 'vlan_pcp']
+        assert len(virtual_field.fields['path_tag'].values) == 5000
+        assert pathcomp.compiled_encoding == (virtual_field.layout,
+                                              tag_encoding.version)
+        vlan = virtual_field.map_to_vlan(
+            virtual_field.compress({'acl': 'deny', 'path_tag': 4999}))
+        assert vlan['vlan_pcp'] > 0
+        assert virtual_field.expand(vlan) == {'acl': 'deny', 'path_tag': 4999}
+        # other virtual fields keep their numbers when the path tag grows
+        assert virtual_field.map_to_vlan(
+            virtual_field.compress({'acl': 'permit'})) == {'vlan_id': 1,
+                                                           'vlan_pcp': 0}
+        with pytest.raises(RuntimeError):
+            pathcomp.__reserve_tags__(tag_encoding.max_values())
+    finally:
+        virtual_field.fields.clear()
+        virtual_field.fields.update(old[0])
+        tag_encoding.current = old[1]
+        tag_encoding.version = old[2]
+        virtual_field.layout = old[3]
+        pathcomp.invalidate()
+
+def test_path_tag_most_significant(virtual_fields):
+    from pyretic.core.runtime import virtual_field
+    virtual_field.fields.clear()
+    pathcomp.init(10)
+    # fields declared after the path tag still come before it
+    virtual_field(name="acl", values=["permit", "deny"])
+    assert virtual_field.fields.keys() == ['acl', 'path_tag']
+    deny = virtual_field.compress({'acl': 'deny'})
+    assert deny == 2
+    # ... so growing the path tag leaves their numbers alone
+    pathcomp.__reserve_tags__(20)
+    assert virtual_field.fields.keys() == ['acl', 'path_tag']
+    assert virtual_field.compress({'acl': 'deny'}) == deny
+    assert virtual_field.expand(virtual_field.map_to_vlan(2 + 3 * 15)) == {
+        'acl': 'deny', 'path_tag': 14}
+
+def test_path_compile_layout_change(virtual_fields):
+    from pyretic.core.runtime import virtual_field
+    pathcomp.init(1022)
+    a1 = atom(match(srcip=ip1))
+    pols = pathcomp.compile(a1)
+    # the same encoding but a different layout: fragments are rebuilt
+    layout = virtual_field.layout
+    virtual_field(name="acl", values=["permit", "deny"])
+    assert virtual_field.layout == layout + 1
+    new_pols = pathcomp.compile(a1)
+    assert not pols[0] is new_pols[0]
+    assert not pols[2] is new_pols[2]
+    # re-declaring a field the same way doesn't change the layout
+    virtual_field(name="acl", values=["permit", "deny"])
+    assert virtual_field.layout == layout + 1
+    for (x, y) in zip(new_pols, pathcomp.compile(a1)):
+        assert x is y
+
+def test_path_compile_without_path_tag(virtual_fields):
+    from pyretic.core.runtime import virtual_field, NUM_PATH_TAGS
+    virtual_field.fields.clear()
+    in_cg.clear()
+    out_cg.clear()
+    # compiling works without init(), up to the default number of tags
+    pathcomp.compile(atom(match(srcip=ip1)))
+    assert not 'path_tag' in virtual_field.fields
+    with pytest.raises(RuntimeError):
+        pathcomp.__reserve_tags__(NUM_PATH_TAGS + 1)
+
 def test_empty_paths():
     in_cg.clear()
     out_cg.clear()
@@ -0,0 +1,71 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.lib.path import classifier_utils
+from pyretic.lib.predicate_dd import *
+
+import itertools
+
+ip1 = IPAddr('10.0.0.1')
+ip2 = IPAddr('10.0.0.2')
+
+def test_dd_hash_consing():
+    m1 = match(srcip='10.0.0.0/8')
+    m2 = match(srcip='10.0.0.0/9') | match(srcip='10.128.0.0/9')
+    assert dd_from_pred(m1) is dd_from_pred(m2)
+    assert dd_from_pred(m1 & ~m2) is DD_FALSE
+    assert dd_from_pred(~m1 | m2) is DD_TRUE
+    assert dd_from_pred(match(switch=1) & match(switch=2)) is DD_FALSE
+    assert ~~dd_from_pred(m1) is dd_from_pred(m1)
+
+def test_dd_nodes_freed():
+    import gc
+    dd_apply_memo.clear()
+    dd_negate_memo.clear()
+    gc.collect()
+    size = len(dd_nodes)
+    dds = [dd_from_pred(match(switch=s, dstport=s)) for s in range(50)]
+    assert len(dd_nodes) > size
+    del dds
+    dd_apply_memo.clear()
+    dd_negate_memo.clear()
+    gc.collect()
+    assert len(dd_nodes) <= size
+
+def test_dd_overlap_mode_matches_classifiers():
+    preds = [identity, drop,
+             match(srcip=ip1), match(srcip='10.0.0.0/24'), match(switch=1),
+             match(srcip=ip1, switch=2), ~match(inport=2) & match(switch=1),
+             match(srcip='10.0.0.0/24') | match(inport=3),
+             match(dstip=ip2) & match(srcip='10.0.0.0/25'),
+             match(srcip=ip2) | match(srcip=ip1)]
+    for (p1, p2) in itertools.product(preds, preds):
+        expected = classifier_utils.get_overlap_mode(p1, p2)
+        d1 = dd_from_pred(p1)
+        assert dd_overlap_mode(d1, dd_from_pred(p2)) == expected
+        assert d1 is dd_from_classifier(p1.compile())
@@ -0,0 +1,272 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.core.packet import *
+from pyretic.core.classifier import Rule, Classifier
+
+from utils import FakeClock
+
+import pytest
+
+### LimitFilter ###
+
+def limit_pkt(srcport):
+    return Packet({'srcport': srcport, 'dstport': 80})
+
+def test_limit_filter_incremental():
+    from pyretic.lib.query import LimitFilter
+    lf = LimitFilter(2, ['srcport'])
+    for p in [1, 1, 2, 3, 3, 2]:
+        lf.update_policy(limit_pkt(p))
+    assert lf.done.keys() == [match(srcport=1), match(srcport=3),
+                              match(srcport=2)]
+    assert lf.eval(limit_pkt(3)) == set()
+    assert lf.eval(limit_pkt(4)) == {limit_pkt(4)}
+    # each group blocked prepends one rule dropping it
+    assert lf.compile() == Classifier(
+        [Rule(pred, set()) for pred in reversed(lf.done.keys())] +
+        [Rule(identity, {identity})])
+    assert not lf.seen
+
+def test_limit_filter_no_group_by():
+    from pyretic.lib.query import LimitFilter
+    lf = LimitFilter(2)
+    for p in [1, 2, 1]:
+        lf.update_policy(limit_pkt(p))
+    # once any packet's fields are seen twice, all packets are blocked
+    assert lf.done.keys() == [match()]
+    assert lf.eval(limit_pkt(3)) == set()
+    lf.update_policy(limit_pkt(2))
+    assert lf.done.keys() == [match()]
+
+def test_limit_filter_ttl():
+    from pyretic.lib.query import LimitFilter
+    clock = FakeClock()
+    lf = LimitFilter(1, ['srcport'], ttl=10, clock=clock)
+    lf.update_policy(limit_pkt(1))
+    clock.now += 5
+    lf.update_policy(limit_pkt(2))
+    assert lf.eval(limit_pkt(1)) == set()
+    clock.now += 6
+    lf.expire()
+    assert lf.done.keys() == [match(srcport=2)]
+    assert lf.eval(limit_pkt(1)) == {limit_pkt(1)}
+    assert lf.eval(limit_pkt(2)) == set()
+    clock.now += 10
+    lf.expire()
+    assert lf.policy == identity
+
+def test_limit_filter_ttl_timer():
+    from pyretic.core.util import TimerWheel
+    from pyretic.core.runtime import PollingService
+    from pyretic.lib.query import LimitFilter
+    clock = FakeClock()
+    poller = PollingService(TimerWheel(tick=0.1, clock=clock, start=False),
+                            start=False)
+    lf = LimitFilter(1, ['srcport'], ttl=10, clock=clock, poller=poller)
+    lf.update_policy(limit_pkt(1))
+    assert lf.eval(limit_pkt(1)) == set()
+    # the group is let through again with no further packets
+    clock.now += 20
+    poller.timer.advance()
+    assert not lf.done
+    assert lf.eval(limit_pkt(1)) == {limit_pkt(1)}
+    lf.stop()
+    assert not poller.groups
+
+def test_limit_filter_ttl_collected():
+    import gc
+    import weakref
+    from pyretic.core.util import TimerWheel
+    from pyretic.core.runtime import PollingService
+    from pyretic.lib.query import LimitFilter
+    clock = FakeClock()
+    poller = PollingService(TimerWheel(tick=0.1, clock=clock, start=False),
+                            start=False)
+    lf = LimitFilter(1, ['srcport'], ttl=10, clock=clock, poller=poller)
+    ref = weakref.ref(lf)
+    del lf
+    gc.collect()
+    # the poller doesn't keep the filter alive, nor its poll once it's gone
+    assert ref() is None
+    assert not poller.groups
+
+def test_limit_filter_max_groups():
+    from pyretic.lib.query import LimitFilter
+    lf = LimitFilter(2, ['srcport'], max_groups=2)
+    for p in [1, 2, 3]:
+        lf.update_policy(limit_pkt(p))
+    assert lf.seen.keys() == [match(srcport=2), match(srcport=3)]
+    for p in [2, 3, 4, 4]:
+        lf.update_policy(limit_pkt(p))
+    # the group blocked first is evicted, and let through again
+    assert lf.done.keys() == [match(srcport=3), match(srcport=4)]
+    assert lf.eval(limit_pkt(2)) == {limit_pkt(2)}
+    assert lf.compile() == (~union(lf.done.keys())).compile()
+
+### Approximate counts ###
+
+def test_count_min_sketch():
+    from pyretic.lib.query import count_min_sketch
+    sketch = count_min_sketch(epsilon=0.01, delta=0.01)
+    assert (sketch.width, sketch.depth) == (272, 5)
+    truth = {}
+    for i in range(2000):
+        key = ('srcport', i % 300)
+        truth[key] = truth.get(key, 0) + 1
+        sketch.add(key)
+    for (key, count) in truth.items():
+        assert count <= sketch.estimate(key) <= count + 0.01 * sketch.total + 5
+
+def test_approx_counts():
+    from pyretic.lib.query import approx_counts
+    q = approx_counts(group_by=['srcport'], top_k=2)
+    reported = []
+    q.register_callback(reported.append)
+    for (p, n) in [(1, 5), (2, 1), (3, 9)]:
+        for i in range(n):
+            q.fb.eval(Packet({'srcport': p, 'header_len': 4,
+                              'payload_len': 6}))
+            q.fb.apply()
+    q.pull_stats()
+    assert reported == [{match(srcport=1).map: [5, 50],
+                         match(srcport=3).map: [9, 90]}]
+
+def test_approx_counts_heavy_hitters_survive():
+    from pyretic.lib.query import approx_counts
+    q = approx_counts(group_by=['srcport'], top_k=2)
+    q.add_counts((('srcport', 1),), 50, 500)
+    q.add_counts((('srcport', 2),), 10, 100)
+    assert q.heavy_min == 10
+    # a burst of small groups doesn't push out the heavy hitters
+    for p in range(3, 103):
+        q.add_counts((('srcport', p),), 1, 10)
+    assert set(q.get_counts().keys()) == {match(srcport=1).map,
+                                          match(srcport=2).map}
+    # ... but a group that outgrows one of them does
+    q.add_counts((('srcport', 3),), 20, 200)
+    assert set(q.get_counts().keys()) == {match(srcport=1).map,
+                                          match(srcport=3).map}
+    assert q.heavy_min == 21
+
+### Windowed aggregates ###
+
+def test_aggregate_fwd_bucket_windows():
+    from pyretic.core.util import TimerWheel
+    from pyretic.core.runtime import PollingService
+    from pyretic.lib.query import count_packets
+    clock = FakeClock()
+    poller = PollingService(TimerWheel(tick=0.1, clock=clock, start=False),
+                            start=False)
+    tumbling = count_packets(1, poller=poller)
+    sliding = count_packets(1, ['srcport'], window=2, retention=2,
+                            poller=poller)
+    reports = ([], [])
+    tumbling.register_callback(reports[0].append)
+    sliding.register_callback(reports[1].append)
+    for n in [3, 1, 0]:
+        for i in range(n):
+            pkt = Packet({'srcport': 1})
+            tumbling.eval(pkt)
+            sliding.eval(pkt)
+        clock.now += 1
+        poller.timer.advance()
+    assert reports[0] == [3, 1, 0]
+    m = match(srcport=1)
+    assert reports[1] == [{m: 3}, {m: 4}, {m: 1}]
+    assert [s for (_, s) in sliding.history] == [{m: 4}, {m: 1}]
+    # snapshots handed out are not touched by later packets
+    sliding.eval(Packet({'srcport': 1}))
+    assert reports[1][-1] == {m: 1}
+
+### Multi-pattern regexp queries ###
+
+def payload_pkt(srcport, payload):
+    return Packet({'srcport': srcport, 'dstport': 80, 'raw': payload})
+
+def test_multi_regexp_query():
+    from pyretic.lib.query import MultiRegexpQuery
+    q = MultiRegexpQuery(["(?P<verb>GET|POST) (?P<path>\S+)", "HTTP/1\.[01]",
+                          r"(a)\1"])
+    hits = []
+    verbs = []
+    q.register_callback(lambda pkt, i, m: hits.append((i, m.group(0))))
+    q.register_callback(lambda pkt, m: verbs.append(m.group('verb')), 0)
+    q.eval(payload_pkt(1, 'GET /index HTTP/1.1 aa'))
+    q.apply()
+    assert hits == [(0, 'GET /index'), (1, 'HTTP/1.1'), (2, 'aa')]
+    assert verbs == ['GET']
+    assert q.separate == [2]
+
+def test_multi_regexp_query_spans_packets():
+    from pyretic.lib.query import MultiRegexpQuery
+    q = MultiRegexpQuery(window=16, max_flows=1)
+    hits = []
+    q.add_pattern("secret", lambda pkt, m: hits.append(pkt['srcport']))
+    for (port, payload) in [(1, 'top se'), (1, 'cret!'), (1, 'ok'),
+                            (2, 'secr'), (3, 'x'), (2, 'et')]:
+        q.eval(payload_pkt(port, payload))
+        q.apply()
+    # reported once, with the packet completing it; flow 2 was evicted
+    assert hits == [1]
+    assert q.flows.keys() == [q.flow_of(payload_pkt(2, ''))]
+
+def test_multi_regexp_query_resumes_after_matches():
+    from pyretic.lib.query import MultiRegexpQuery
+    q = MultiRegexpQuery(["a+"], window=16)
+    hits = []
+    q.register_callback(lambda pkt, m: hits.append(m.group(0)), 0)
+    for payload in ['xaa', 'a', 'b', 'ya']:
+        q.eval(payload_pkt(1, payload))
+        q.apply()
+    # matches reaching the end of a packet are held, as they may grow
+    assert hits == ['aaa']
+    q.flush()
+    assert hits == ['aaa', 'a']
+    q.flush()
+    assert hits == ['aaa', 'a']
+
+def test_multi_regexp_query_overlapping():
+    from pyretic.lib.query import MultiRegexpQuery
+    import re
+    # every pattern is reported, as with separate RegexpQuery objects
+    for second in ['GET', re.compile('GET', re.S | re.I)]:
+        q = MultiRegexpQuery(['GET /', second])
+        hits = []
+        q.register_callback(lambda pkt, i, m: hits.append((i, m.group(0))))
+        q.eval(payload_pkt(1, 'GET /x GET'))
+        q.apply()
+        assert hits == [(0, 'GET /'), (1, 'GET'), (1, 'GET')]
+
+def test_multi_regexp_query_transport_payload():
+    from pyretic.lib.query import MultiRegexpQuery
+    ip = chr(0x45) + '\x00' * 8 + chr(6) + '\x00' * 10
+    tcp = '\x00' * 12 + chr(5 << 4) + '\x00' * 7
+    pkt = Packet({'raw': 'e' * 14 + ip + tcp + 'GET /', 'header_len': 14,
+                  'ethtype': 0x800})
+    assert MultiRegexpQuery.transport_payload(pkt) == 'GET /'
@@ -544,6 +544,104 @@ def test_dot_vector():
         f.close()
         # output = subprocess.check_output(['dot', '-Tx11', fname])
 
+def test_hash_consing():
+    a = re_symbol('a')
+    a1 = re_symbol('a', metadata='ingress')
+    b = re_symbol('b')
+    e1 = (a ^ b) | +b
+    e2 = (a1 ^ b) | +b
+    # structurally equal expressions share an ident, whatever their metadata
+    assert e1.ident == e2.ident
+    assert e1 == e2 and hash(e1) == hash(e2)
+    assert (a ^ b).ident != (b ^ a).ident
+    assert e1.null and not (a ^ b).null and (~a).null
+    # derivatives are memoized on structure
+    assert deriv(e1, a) is deriv(e2, a)
+    assert deriv(e1, a) == b
+
+def test_hash_consing_frees_structures():
+    import gc
+    gc.collect()
+    size = len(re_structures)
+    exprs = [re_symbol(chr(200 + i)) ^ re_symbol(chr(201 + i))
+             for i in range(20)]
+    assert len(re_structures) > size
+    ident = exprs[0].ident
+    del exprs
+    gc.collect()
+    assert len(re_structures) <= size
+    # a structure built again gets a fresh ident
+    assert (re_symbol(chr(200)) ^ re_symbol(chr(201))).ident != ident
+
+def test_dfa_no_recursion_per_state():
+    """ DFA construction must not use a stack frame per discovered state. """
+    import inspect
+    import sys
+    a = re_symbol('a')
+    def counter(p):
+        r = a
+        for i in range(p-1):
+            r = r ^ a
+        return +r
+    # a single chain of lcm(2, 3, 5, 7) = 210 states on the symbol 'a'
+    e = counter(2) | counter(3) | counter(5) | counter(7)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack()) + 150)
+    try:
+        dfa = makeDFA(e, 'a')
+        vdfa = makeDFA_vector([e, counter(2)], 'a')
+    finally:
+        sys.setrecursionlimit(limit)
+    assert dfa.all_states.get_num_states() == 210
+    assert vdfa.all_states.get_num_states() == 210
+    assert dfa.accepts('a' * 14)
+    assert not dfa.accepts('a' * 13)
+
+def test_dfa_minimize_vector():
+    import itertools
+    a = re_symbol('a')
+    b = re_symbol('b')
+    c = re_symbol('c')
+    # the states after 'a' and 'b' are equivalent, but not structurally equal
+    e1 = (a ^ (c ^ +c)) | (b ^ (+c ^ c))
+    e2 = +a
+    symlist = 'abc'
+    dfa = makeDFA_vector([e1, e2], symlist)
+    min_dfa = minimizeDFA_vector(dfa)
+    assert (min_dfa.all_states.get_num_states() ==
+            dfa.all_states.get_num_states() - 1)
+    assert min_dfa.init_state == dfa.init_state
+    assert min_dfa.all_states.re_map[min_dfa.init_state] == 0
+    for n in range(6):
+        for s in itertools.product(symlist, repeat=n):
+            s = ''.join(s)
+            assert dfa.accepts(s) == min_dfa.accepts(s)
+    (q, rest) = min_dfa.run('ac')
+    assert min_dfa.all_states.get_accepting_exps_ordinal(q) == [0]
+    # nothing to merge: the same DFA comes back
+    dfa2 = makeDFA_vector([e2], symlist)
+    assert minimizeDFA_vector(dfa2) is dfa2
+
+def test_dfa_vector_lazy_components():
+    a1 = re_symbol('a', metadata='ingress')
+    a2 = re_symbol('a', metadata='egress')
+    b = re_symbol('b')
+    e1 = a1 ^ b
+    e2 = (a2 ^ b) | +b
+    dfa = makeDFA_vector([e1, e2], 'ab')
+    tt = dfa.transition_table
+    # the product is built without any per-component DFAs
+    assert tt.component_dfas_cache == [None, None]
+    assert dfa.accepts('ab') and dfa.accepts('bb') and not dfa.accepts('ba')
+    assert tt.get_metadata(dfa.init_state, 'a') == (['ingress'], ['egress'])
+    assert not None in tt.component_dfas_cache
+    assert tt.component_dfas[0].accepts('ab')
+    # minimized tables share the components that were already built
+    min_dfa = minimizeDFA_vector(dfa)
+    if not min_dfa is dfa:
+        assert (min_dfa.transition_table.component_dfas_cache is
+                tt.component_dfas_cache)
+
 # Just in case: keep these here to run unit tests in vanilla python
 if __name__ == "__main__":
     test_normal_forms()
@@ -558,6 +656,10 @@ if __name__ == "__main__":
     test_dfa_metadata()
     test_dfa_vector()
     test_dot_vector()
+    test_hash_consing()
+    test_dfa_no_recursion_per_state()
+    test_dfa_minimize_vector()
+    test_dfa_vector_lazy_components()
 
     print "If this message is printed without errors before it, we're good."
     print "Also ensure all unit tests are listed above this line in the source."
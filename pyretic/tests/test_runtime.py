@@ -0,0 +1,351 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.core.packet import Packet
+from pyretic.core.runtime import CountBucketRegistry, StatsScheduler, rule_cookie
+
+from utils import FakeClock
+
+import pytest
+
+def flow_stat(switch_match, priority, cookie, packets, bytes):
+    return {'match': dict(switch_match), 'priority': priority,
+            'cookie': cookie, 'packet_count': packets, 'byte_count': bytes}
+
+def waiting_bucket(switch):
+    b = CountBucket()
+    counts = []
+    b.register_callback(counts.append)
+    b.increment_max_num_callbacks()
+    b.add_outstanding_switch_query(switch)
+    return (b, counts)
+
+### Flow stats dispatch ###
+
+def test_bucket_registry_dispatch():
+    registry = CountBucketRegistry()
+    (b1, counts1) = waiting_bucket(1)
+    (b2, counts2) = waiting_bucket(1)
+    m1 = {'switch': 1, 'srcport': 80}
+    m2 = {'switch': 1, 'srcport': 22}
+    c1 = rule_cookie.make(1, registry.get_tag([b1]))
+    c2 = rule_cookie.make(1, registry.get_tag([b1, b2]))
+    assert registry.add(m1, 100, c1, [b1]) == 0
+    assert registry.add(m2, 99, c2, [b2, b1]) == 1
+    assert len(registry) == 2
+    assert registry.get_tag([b2, b1]) == rule_cookie.tag(c2)
+    stats = [flow_stat({'srcport': 80}, 100, c1, 5, 500),
+             flow_stat({'srcport': 22}, 99, c2, 2, 120),
+             flow_stat({'srcport': 22}, 99, 0, 7, 700), # another version
+             flow_stat({}, 0, 1, 9, 900)]
+    registry.dispatch(1, stats, [b1, b2])
+    assert counts1 == [[7, 620]]
+    assert counts2 == [[2, 120]]
+    assert sorted(registry.bucket_matches(b1)) == sorted([m1, m2])
+
+def test_bucket_registry_remove():
+    registry = CountBucketRegistry()
+    (b, counts) = waiting_bucket(1)
+    m = {'switch': 1, 'srcport': 80}
+    cookie = rule_cookie.make(1, registry.get_tag([b]))
+    registry.add(m, 100, cookie, [b])
+    registry.delete(m, 100, cookie)
+    assert registry.switch_rules(b, 1) == [(m, cookie, False)]
+    for (bucket, existing) in registry.remove(1, 100, cookie):
+        bucket.handle_flow_removed(3, 30, existing)
+    assert len(registry) == 0
+    assert registry.remove(1, 100, cookie) == []
+    # the tag goes with the last of its rules, and the rule id is reused
+    assert not registry.tag_buckets
+    registry.dispatch(1, [flow_stat({'srcport': 80}, 100, cookie, 5, 50)],
+                      [b])
+    assert counts == [[3, 30]]
+    assert registry.add(m, 90, rule_cookie.make(2, 1), [b]) == 0
+
+def test_bucket_registry_existing_rules():
+    registry = CountBucketRegistry()
+    (b1, counts1) = waiting_bucket(1)
+    m = {'switch': 1, 'srcport': 80}
+    cookie = rule_cookie.make(1, registry.get_tag([b1]))
+    registry.add(m, 100, cookie, [b1])
+    # a new bucket comes to count the rule, without its counts so far,
+    # which it reads (like pull_existing_stats) without calling back
+    b2 = CountBucket()
+    counts2 = []
+    b2.register_callback(counts2.append)
+    b2.add_outstanding_switch_query(1)
+    registry.add(m, 100, cookie, [b1, b2], installed=True)
+    assert registry.bucket_matches(b1, existing_only=True) == []
+    assert registry.bucket_matches(b2, existing_only=True) == [m]
+    assert registry.switch_rules(b2, 1) == [(m, cookie, False)]
+    registry.dispatch(1, [flow_stat({'srcport': 80}, 100, cookie, 4, 40)],
+                      [b1, b2])
+    assert counts1 == [[4, 40]]
+    assert counts2 == []
+    assert registry.switch_rules(b2, 1) == [(m, cookie, True)]
+    b2.increment_max_num_callbacks()
+    b2.add_outstanding_switch_query(1)
+    registry.dispatch(1, [flow_stat({'srcport': 80}, 100, cookie, 6, 60)],
+                      [b2])
+    assert counts2 == [[2, 20]]
+    # the old tag went with its only rule
+    assert registry.tag_buckets.keys() == [registry.get_tag([b1, b2])]
+
+### Stats scheduling ###
+
+def make_scheduler():
+    sent = []
+    clock = FakeClock()
+    sched = StatsScheduler(lambda s: sent.append(('flow', s)),
+                           lambda s, m, i: sent.append(('aggregate', s, i)),
+                           epoch=1, requery=10, clock=clock)
+    return (sched, sent, clock)
+
+def test_stats_scheduler_one_request_per_epoch():
+    (sched, sent, clock) = make_scheduler()
+    (b1, b2, b3) = (CountBucket(), CountBucket(), CountBucket())
+    assert sched.pull(1, b1) is None
+    assert sched.pull(1, b2) is None
+    assert sent == [('flow', 1)]
+    key = StatsScheduler.flow_key(1)
+    assert sched.handle_reply(key, ['stats']) == [b1, b2]
+    # later pulls in the same epoch are fed from the snapshot
+    clock.now += 0.5
+    assert sched.pull(1, b3) == (key, ['stats'])
+    assert sent == [('flow', 1)]
+    # ... until the epoch is over, or the rules change
+    clock.now += 1
+    assert sched.pull(1, b3) is None
+    assert sent == [('flow', 1)] * 2
+    sched.handle_reply(key, ['stats'])
+    sched.invalidate(1)
+    assert sched.pull(1, b3) is None
+    assert len(sent) == 3
+
+def test_stats_scheduler_aggregate():
+    (sched, sent, clock) = make_scheduler()
+    (b1, b2) = (CountBucket(), CountBucket())
+    m = {'switch': 1, 'srcport': 80}
+    assert sched.pull(1, b1, m) is None
+    assert sent == [('aggregate', 1, 1)]
+    (key, buckets) = sched.handle_request_reply(1, {'packet_count': 4,
+                                                      'byte_count': 40})
+    assert key == StatsScheduler.aggregate_key(1, m)
+    assert buckets == [b1]
+    assert sched.pull(1, b2, m) == (key, {'packet_count': 4,
+                                          'byte_count': 40})
+    assert sched.handle_request_reply(7, {}) == (None, [])
+
+def test_aggregate_match():
+    rules = [({'switch': 1, 'srcip': '10.0.0.1', 'dstport': p}, 1, True)
+             for p in [22, 80]]
+    flows = [m for (m, _, _) in rules]
+    defaults = [{'switch': 1}, {'switch': 1, 'ethtype': 0x88cc}]
+    assert StatsScheduler.aggregate_match(rules, defaults + flows) == \
+        {'switch': 1, 'srcip': '10.0.0.1'}
+    # another flow from the same source isn't the bucket's
+    other = {'switch': 1, 'srcip': '10.0.0.1', 'dstport': 443}
+    assert StatsScheduler.aggregate_match(rules, defaults + flows + [other]) \
+        is None
+    assert StatsScheduler.aggregate_match([], [{'switch': 2}]) is None
+    deleted = [(rules[0][0], 1, False)] + rules[1:]
+    assert StatsScheduler.aggregate_match(deleted, defaults + flows) is None
+
+def test_bucket_aggregate_stats():
+    (b, counts) = waiting_bucket(1)
+    b.add_outstanding_switch_query(2)
+    b.handle_aggregate_stats(1, 4, 40)
+    assert counts == []
+    b.handle_aggregate_stats(2, 1, 10)
+    assert counts == [[5, 50]]
+
+### Scoped flow stats ###
+
+def test_rule_cookie():
+    cookie = rule_cookie.make(7, 3)
+    assert rule_cookie.version(cookie) == 7
+    assert rule_cookie.tag(cookie) == 3
+    assert rule_cookie.make(7) == 7
+
+def test_stats_scope():
+    rules = [({'switch': 1, 'srcip': '10.0.0.1', 'dstport': 22},
+              rule_cookie.make(1, 2), True),
+             ({'switch': 1, 'srcip': '10.0.0.1', 'dstport': 80},
+              rule_cookie.make(1, 5), True)]
+    flows = [m for (m, _, _) in rules]
+    others = [{'switch': 1, 'dstport': p} for p in range(5)]
+    assert StatsScheduler.stats_scope(rules, flows + others) == \
+        ({'switch': 1, 'srcip': '10.0.0.1'}, frozenset([2, 5]))
+    # a bucket covering most of a switch's flows is better served in full
+    assert StatsScheduler.stats_scope(rules, flows + others[:1]) is None
+    assert StatsScheduler.stats_scope([], [{'switch': 2}]) is None
+
+def test_stats_scheduler_scoped():
+    (sched, sent, clock) = make_scheduler()
+    sched.request_scoped_flow_stats = \
+        lambda s, m, tags, i: sent.append(('scoped', s, tags, i))
+    (b1, b2) = (CountBucket(), CountBucket())
+    scope = ({'switch': 1, 'srcport': 80}, frozenset([2]))
+    assert sched.pull(1, b1, None, scope) is None
+    assert sent == [('scoped', 1, frozenset([2]), 1)]
+    stats = [flow_stat({'switch': 1, 'srcport': 80}, 10, 1 << 33, 3, 30)]
+    (key, buckets) = sched.handle_request_reply(1, stats)
+    assert key == StatsScheduler.scoped_key(1, scope[0], scope[1])
+    assert buckets == [b1]
+    assert sched.pull(1, b2, None, scope) == (key, stats)
+    # full flow stats on their way serve scoped pulls too
+    assert sched.pull(1, b2) is None
+    assert sched.pull(1, b1, None, ({}, frozenset([4]))) is None
+    assert sent[1:] == [('flow', 1)]
+
+### Counter-only buckets ###
+
+def test_counter_only_bucket():
+    import threading
+    b = CountBucket(counter_only=True)
+    pkt = Packet({'payload_len': 10})
+    def count():
+        for i in range(100):
+            b.eval(pkt)
+    threads = [threading.Thread(target=count) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not b.bucket
+    b.apply()
+    assert (b.packet_count_persistent, b.byte_count_persistent) == (400, 4000)
+    b.eval(pkt)
+    b.apply()
+    b.apply()
+    assert (b.packet_count_persistent, b.byte_count_persistent) == (401, 4010)
+
+def test_counter_only_bucket_concurrent_apply():
+    import threading
+    b = CountBucket(counter_only=True)
+    pkt = Packet({'payload_len': 10})
+    done = []
+    def count():
+        for i in range(1000):
+            b.eval(pkt)
+    def fold():
+        while not done:
+            b.apply()
+    counters = [threading.Thread(target=count) for i in range(4)]
+    folders = [threading.Thread(target=fold) for i in range(4)]
+    for t in counters + folders:
+        t.start()
+    for t in counters:
+        t.join()
+    done.append(True)
+    for t in folders:
+        t.join()
+    b.apply()
+    # concurrent folds never count the same packets twice
+    assert (b.packet_count_persistent, b.byte_count_persistent) == (4000,
+                                                                    40000)
+
+def test_bucket_apply_counts_retained_packets():
+    b = CountBucket()
+    b.eval(Packet({'payload_len': 10, 'srcport': 1}))
+    b.eval(Packet({'payload_len': 20, 'srcport': 2}))
+    b.apply()
+    assert not b.bucket
+    assert (b.packet_count_persistent, b.byte_count_persistent) == (2, 30)
+
+### Polling ###
+
+def test_stats_scheduler_batch():
+    (sched, sent, clock) = make_scheduler()
+    sched.request_scoped_flow_stats = \
+        lambda s, m, tags, i: sent.append(('scoped', s, i))
+    (b1, b2, b3) = (CountBucket(), CountBucket(), CountBucket())
+    sched.start_batch()
+    assert sched.pull(1, b1, {'srcport': 80}) is None
+    assert sched.pull(1, b2, None, ({'srcport': 22}, frozenset([1]))) is None
+    assert sched.pull(2, b3, {'srcport': 80}) is None
+    assert sent == []
+    sched.finish_batch()
+    # switch 1 got two requests, sent as one for its full flow stats
+    assert sent == [('flow', 1), ('aggregate', 2, 3)]
+    key = StatsScheduler.flow_key(1)
+    assert sched.handle_reply(key, []) == [b1, b2]
+    assert sched.handle_request_reply(1, []) == (None, [])
+
+def test_polling_service_aligned_batches():
+    from pyretic.core.util import TimerWheel
+    from pyretic.core.runtime import PollingService
+    clock = FakeClock()
+    clock.now = 100.3
+    poller = PollingService(TimerWheel(tick=0.1, clock=clock, start=False),
+                            start=False)
+    events = []
+    poller.set_batch_hooks(lambda: events.append('start'),
+                           lambda: events.append('finish'))
+    h1 = poller.register(1, lambda: events.append(1))
+    clock.now = 100.6
+    poller.register(1, lambda: events.append(2))
+    clock.now = 100.9
+    poller.timer.advance()
+    assert events == []
+    # both polls run at the next whole second, in one batch
+    clock.now = 101.0
+    poller.timer.advance()
+    assert events == ['start', 1, 2, 'finish']
+    poller.unregister(h1)
+    clock.now = 102.0
+    poller.timer.advance()
+    assert events[4:] == ['start', 2, 'finish']
+
+def test_polling_service_worker():
+    from pyretic.core.util import TimerWheel
+    from pyretic.core.runtime import PollingService
+    clock = FakeClock()
+    workers = []
+    # the worker is never started: batches are run with run_batch below
+    poller = PollingService(TimerWheel(tick=0.1, clock=clock, start=False),
+                            start_worker=workers.append)
+    runs = []
+    poller.register(1, lambda: runs.append(clock.now))
+    fired = []
+    poller.timer.schedule(1.5, lambda: fired.append(True))
+    # a pending batch holds up neither the wheel nor its other timers
+    clock.now += 1
+    poller.timer.advance()
+    clock.now += 1
+    poller.timer.advance()
+    assert fired == [True]
+    assert runs == []
+    # ... and the next batch of its period is skipped while it is pending
+    clock.now += 1
+    poller.timer.advance()
+    assert poller.pending.keys() == [1]
+    poller.run_batch()
+    assert len(runs) == 1
+    assert not poller.pending
+    assert workers == [poller.run_worker]
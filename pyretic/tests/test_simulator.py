@@ -0,0 +1,99 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.core.network import *
+from pyretic.core.runtime import virtual_field, tag_encoding
+from pyretic.lib.simulator import simulator
+
+import copy
+import pytest
+
+def line_topology(n):
+    """ Switches 1..n, each with host port 1, linked in a line on ports 2/3. """
+    topo = Topology()
+    for s in range(1, n+1):
+        topo.add_switch(s)
+        for p in [1, 2, 3]:
+            topo.add_port(s, p, True, True, [])
+    for s in range(1, n):
+        topo.add_link(Location(s, 3), Location(s+1, 2))
+    return topo
+
+def to_right(n):
+    """ Forward everything towards switch n, out of host port 1 there. """
+    pol = match(switch=n) >> modify(outport=1)
+    for s in range(1, n):
+        pol += match(switch=s) >> modify(outport=3)
+    return pol
+
+fields = ['switch', 'inport', 'srcip', 'dstip']
+
+def test_simulator_paths_and_captures():
+    pol = to_right(3) + (match(switch=2, srcip='10.0.0.1') >> FwdBucket())
+    sim = simulator(pol.compile(), line_topology(3))
+    [r1, r2] = sim.run(fields, [(1, 1, '10.0.0.1', '10.0.0.3'),
+                                (1, 1, '10.0.0.2', '10.0.0.3')])
+    assert len(r1.paths) == 1
+    assert [(p['switch'], p['inport']) for p in r1.paths[0][:-1]] == \
+        [(1, 1), (2, 2), (3, 2)]
+    assert r1.paths[0][-1]['outport'] == 1
+    # buckets forward to the controller in compiled classifiers
+    assert [(p['switch'], q) for (p, q) in r1.captures] == [(2, Controller)]
+    assert len(r2.paths) == 1
+    assert r2.captures == []
+    # table lookups are shared by packets with the same headers
+    lookups = len(sim.step_cache)
+    sim.run(fields, [(1, 1, '10.0.0.2', '10.0.0.3')] * 10)
+    assert len(sim.step_cache) == lookups
+
+def test_simulator_hop_limit():
+    # switch 2 bounces packets back to switch 1, which egresses and forwards
+    pol = ((match(switch=1) >> (modify(outport=1) + modify(outport=3))) +
+           (match(switch=2) >> modify(outport=2)))
+    sim = simulator(pol.compile(), line_topology(2), max_hops=4)
+    [r] = sim.run(fields, [(1, 1, '10.0.0.1', '10.0.0.2')])
+    assert r.truncated
+    assert [len(p) for p in r.paths] == [2, 4, 6]
+
+def test_simulator_tags():
+    old = (copy.copy(virtual_field.fields), virtual_field.layout,
+           tag_encoding.current, tag_encoding.version)
+    try:
+        virtual_field(name="path_tag", values=range(0, 10), type="integer")
+        pol = ((match(switch=1) >> modify(outport=3, path_tag=4)) +
+               (match(switch=2, path_tag=4) >> modify(outport=1,
+                                                      path_tag=None)))
+        sim = simulator(pol.compile(), line_topology(2))
+        [r] = sim.run(fields, [(1, 1, '10.0.0.1', '10.0.0.2')])
+        assert len(r.paths) == 1
+        assert r.get_tags(r.paths[0]) == [None, 4, None]
+    finally:
+        virtual_field.fields.clear()
+        virtual_field.fields.update(old[0])
+        virtual_field.layout = old[1]
+        (tag_encoding.current, tag_encoding.version) = old[2:]
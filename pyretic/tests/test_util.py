@@ -0,0 +1,54 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from utils import FakeClock
+
+import pytest
+
+### Timer wheel ###
+
+def test_timer_wheel():
+    from pyretic.core.util import TimerWheel
+    clock = FakeClock()
+    wheel = TimerWheel(tick=0.1, num_slots=8, clock=clock, start=False)
+    fired = []
+    wheel.schedule(0.5, lambda: fired.append('once'))
+    t = wheel.schedule(0.3, lambda: fired.append('periodic'), 0.3)
+    clock.now += 0.35
+    wheel.advance()
+    assert fired == ['periodic']
+    clock.now += 0.2
+    wheel.advance()
+    assert fired == ['periodic', 'once']
+    # a late advance runs a periodic timer once, and keeps its period
+    clock.now += 2.0
+    wheel.advance()
+    assert fired == ['periodic', 'once', 'periodic']
+    wheel.cancel(t)
+    clock.now += 1.0
+    wheel.advance()
+    assert len(fired) == 3
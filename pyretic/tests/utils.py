@@ -1,4 +1,4 @@
-'''Utilities for system-wide mininet tests.'''
+'''Utilities for system-wide mininet tests, and fakes for unit tests.'''
 
 from argparse import ArgumentParser
 import difflib, filecmp, os, shlex, shutil, signal, subprocess, sys, tempfile, time
@@ -29,6 +29,16 @@ def init():
     return InitEnv(benchmark_dir, test_dir)
 
 
+### Fakes
+
+class FakeClock(object):
+    """ A clock for unit tests, which only moves when `now` is set. """
+    def __init__(self):
+        self.now = 100.0
+    def __call__(self):
+        return self.now
+
+
 ### Utility functions
 
 class TestCase():